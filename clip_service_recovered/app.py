@@ -6,173 +6,3383 @@ import numpy as np
 import os
 from PIL import Image
 import time
-from functools import lru_cache
 from transformers import CLIPProcessor, CLIPModel
 import json
+import io
+import threading
+import queue
+import hashlib
+import sqlite3
+import shutil
+import weakref
+import uuid
+import unicodedata
+import fcntl
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash  # optional: hash nhanh hơn blake2b
+except ImportError:
+    xxhash = None
+
+try:
+    import onnxruntime  # optional: INFERENCE_BACKEND=onnx
+except ImportError:
+    onnxruntime = None
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# === Đường dẫn ===
-INDEX_PATH = "faiss_index_3d_products_clip.idx"
-PATHS_PATH = "product_paths_clip.npy"
-METADATA_PATH = "product_metadata.json"
-STORAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "product_images")
-os.makedirs(STORAGE_DIR, exist_ok=True)
+# === Đường dẫn ===
+DATA_DIR = os.environ.get("DATA_DIR", ".")  # thư mục chứa index, log và metadata
+os.makedirs(DATA_DIR, exist_ok=True)
+INDEX_PATH = os.path.join(DATA_DIR, "faiss_index_3d_products_clip.idx")
+DELTA_INDEX_PATH = os.path.join(DATA_DIR, "faiss_index_3d_products_clip_delta.idx")  # row mới chưa gộp vào base
+PATHS_PATH = os.path.join(DATA_DIR, "product_paths_clip.npy")  # định dạng cũ (pickle), chỉ dùng để migrate
+PATH_TABLE_PATH = os.path.join(DATA_DIR, "product_paths_clip.strtab")
+ROWS_PATH = os.path.join(DATA_DIR, "product_rows_clip.npy")  # chỉ dùng khi migrate index cũ
+DELETED_PATH = os.path.join(DATA_DIR, "product_deleted_clip.npy")
+EMBEDDINGS_PATH = os.path.join(DATA_DIR, "product_embeddings_clip.f32")
+METADATA_PATH = os.path.join(DATA_DIR, "product_metadata.json")  # định dạng cũ, chỉ dùng để migrate
+METADATA_DB_PATH = os.path.join(DATA_DIR, "product_metadata.sqlite")
+MUTATION_LOG_PATH = os.path.join(DATA_DIR, "index_mutations.log")
+CHECKPOINT_PATH = os.path.join(DATA_DIR, "index_checkpoint.json")
+TEXT_QUERY_LOG_PATH = os.path.join(DATA_DIR, "text_queries.sqlite")  # số lần tìm của từng query text
+SYNC_MANIFEST_PATH = os.path.join(DATA_DIR, "storage_manifest.sqlite")  # trạng thái file lần /reload trước
+INDEX_MMAP = os.environ.get("INDEX_MMAP", "1") != "0"  # mmap base index thay vì đọc hết vào RAM
+STORAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "product_images")
+os.makedirs(STORAGE_DIR, exist_ok=True)
+
+# === Cấu hình tối ưu ===
+torch.backends.cudnn.benchmark = True
+if DEVICE.type == 'cuda':
+    torch.cuda.empty_cache()
+
+# Số thread mỗi process: chạy N worker (gunicorn) thì nên để N × TORCH_THREADS ≈ số core
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 4))
+FAISS_THREADS = int(os.environ.get("FAISS_THREADS", 0))  # 0 = mặc định của OpenMP
+FAISS_DEFAULT_THREADS = faiss.omp_get_max_threads()
+SERVE_PREFORK = os.environ.get("SERVE_PREFORK") == "1"  # chạy dưới gunicorn preload (xem gunicorn.conf.py)
+# build_index.py import module này để dùng lại các hàm: không nạp / replay / checkpoint DATA_DIR
+OFFLINE_TOOL = os.environ.get("CLIP_OFFLINE_TOOL") == "1"
+
+def configure_threads(torch_threads, faiss_threads):
+    if DEVICE.type != 'cuda':
+        torch.set_num_threads(torch_threads)
+    faiss.omp_set_num_threads(faiss_threads or FAISS_DEFAULT_THREADS)
+
+# Master của gunicorn chỉ nạp model/index rồi fork: giữ 1 thread để thread pool OpenMP
+# không được tạo trước khi fork (worker sẽ treo); worker đặt lại trong init_worker_process
+if SERVE_PREFORK:
+    configure_threads(1, 1)
+else:
+    configure_threads(TORCH_THREADS, FAISS_THREADS)
+
+TIMEOUT_SECONDS = 30
+FEATURE_DIM = 512  # CLIP ViT-B/32
+
+# Batch inference cho /add-batch: số ảnh mỗi forward pass và số thread decode/preprocess
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 32))
+PREPROCESS_WORKERS = int(os.environ.get("PREPROCESS_WORKERS", 4))
+
+# Micro-batching cho /search: gom tối đa N query hoặc chờ tối đa M ms rồi chạy một batch
+SEARCH_BATCH_MAX_SIZE = int(os.environ.get("SEARCH_BATCH_MAX_SIZE", 16))
+SEARCH_BATCH_MAX_WAIT_MS = float(os.environ.get("SEARCH_BATCH_MAX_WAIT_MS", 5))
+
+# Embedding cache theo hash nội dung ảnh (RAM LRU + tầng SQLite trên đĩa tùy chọn)
+EMBED_CACHE_SIZE = int(os.environ.get("EMBED_CACHE_SIZE", 10000))
+EMBED_CACHE_TTL_SECONDS = float(os.environ.get("EMBED_CACHE_TTL_SECONDS", 0))  # 0 = không hết hạn
+EMBED_CACHE_DISK_PATH = os.environ.get("EMBED_CACHE_DISK_PATH", "")  # rỗng = tắt tầng đĩa
+EMBED_CACHE_DISK_SIZE = int(os.environ.get("EMBED_CACHE_DISK_SIZE", 200000))
+EMBED_MODEL_TAG = "clip-vit-base-patch32"
+
+# Cache embedding text theo query đã chuẩn hóa; lúc khởi động tính sẵn giá trị các trường
+# TEXT_VOCAB_FIELDS của catalog và TEXT_PRECOMPUTE_TOP_QUERIES query được tìm nhiều nhất
+TEXT_CACHE_SIZE = int(os.environ.get("TEXT_CACHE_SIZE", 10000))
+TEXT_PRECOMPUTE_TOP_QUERIES = int(os.environ.get("TEXT_PRECOMPUTE_TOP_QUERIES", 1000))
+TEXT_VOCAB_FIELDS = [f.strip() for f in os.environ.get("TEXT_VOCAB_FIELDS", "category,style").split(",") if f.strip()]
+
+# === Lazy loading CLIP model ===
+clip_processor = None
+clip_model = None
+clip_encoder = None  # backend chạy vision/text tower (xem load_clip_encoder)
+model_load_lock = threading.Lock()
+
+# === Product metadata storage ===
+class MetadataStore:
+    """
+    Metadata sản phẩm trong SQLite (WAL mode), mỗi ảnh một row, có index theo
+    product_id / filename / category. Dùng như dict {image_path: metadata};
+    mỗi lần ghi chỉ ghi một row thay vì ghi lại toàn bộ file JSON.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = self._connect()
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS products (
+                path TEXT PRIMARY KEY,
+                product_id TEXT,
+                filename TEXT,
+                category TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_products_product_id ON products(product_id);
+            CREATE INDEX IF NOT EXISTS idx_products_filename ON products(filename);
+            CREATE INDEX IF NOT EXISTS idx_products_category ON products(category);
+        """)
+        self.conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def close(self):
+        """Đóng kết nối trước khi fork (kết nối SQLite không được dùng chung giữa các process)"""
+        with self.lock:
+            self.conn.close()
+
+    def reopen(self):
+        with self.lock:
+            self.conn = self._connect()
+
+    @staticmethod
+    def _row(path, metadata):
+        product_id = metadata.get('product_id')
+        category = metadata.get('category')
+        return (
+            path,
+            str(product_id) if product_id not in (None, '') else None,
+            os.path.basename(path),
+            str(category) if category not in (None, '') else None,
+            json.dumps(metadata, ensure_ascii=False, default=str),
+        )
+
+    def get(self, path, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM products WHERE path = ?", (path,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def get_many(self, paths):
+        """{path: metadata} cho nhiều path, một truy vấn mỗi 500 path"""
+        result = {}
+        paths = list(paths)
+        with self.lock:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT path, data FROM products WHERE path IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                result.update((path, json.loads(data)) for path, data in rows)
+        return result
+
+    def __getitem__(self, path):
+        metadata = self.get(path)
+        if metadata is None:
+            raise KeyError(path)
+        return metadata
+
+    def __setitem__(self, path, metadata):
+        self.update_many([(path, metadata)])
+
+    def __delitem__(self, path):
+        self.delete_many([path])
+
+    def delete_many(self, paths):
+        with self.lock:
+            self.conn.executemany("DELETE FROM products WHERE path = ?", [(path,) for path in paths])
+            self.conn.commit()
+
+    def __contains__(self, path):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM products WHERE path = ?", (path,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+    def update_many(self, items):
+        """Ghi nhiều row trong một transaction"""
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO products (path, product_id, filename, category, data) VALUES (?, ?, ?, ?, ?)",
+                [self._row(path, metadata) for path, metadata in items],
+            )
+            self.conn.commit()
+
+    def items(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT path, data FROM products").fetchall()
+        return [(path, json.loads(data)) for path, data in rows]
+
+    def product_ids(self):
+        """{path: product_id} cho mọi row có product_id (không cần parse JSON)"""
+        with self.lock:
+            return dict(self.conn.execute("SELECT path, product_id FROM products WHERE product_id IS NOT NULL"))
+
+    def paths_for_product(self, product_id):
+        with self.lock:
+            return [r[0] for r in self.conn.execute("SELECT path FROM products WHERE product_id = ?", (str(product_id),))]
+
+    def paths_for_filename(self, filename):
+        with self.lock:
+            return [r[0] for r in self.conn.execute("SELECT path FROM products WHERE filename = ?", (filename,))]
+
+    def distinct_values(self, key):
+        """Các giá trị khác nhau của metadata[key] (list được trả nguyên là list)"""
+        json_path = f'$."{key}"'
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT json_type(data, ?), json_extract(data, ?) FROM products",
+                (json_path, json_path),
+            ).fetchall()
+        return [json.loads(value) if kind in ('array', 'object') else value
+                for kind, value in rows if kind is not None]
+
+    def paths_for_category(self, category):
+        with self.lock:
+            return [r[0] for r in self.conn.execute("SELECT path FROM products WHERE category = ?", (str(category),))]
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM products")
+            self.conn.commit()
+
+    def replace_all(self, items):
+        """Thay toàn bộ metadata trong một transaction (build_index.py)"""
+        with self.lock:
+            self.conn.execute("DELETE FROM products")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO products (path, product_id, filename, category, data) VALUES (?, ?, ?, ?, ?)",
+                [self._row(path, metadata) for path, metadata in items],
+            )
+            self.conn.commit()
+
+def load_models_if_needed():
+    global clip_processor, clip_model, clip_encoder
+    if clip_encoder is not None:
+        return
+    with model_load_lock:
+        if clip_processor is None or clip_model is None:
+            print("🔄 Đang tải mô hình CLIP...")
+            try:
+                clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+                clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(DEVICE).eval()
+                print("✅ Đã tải xong mô hình CLIP")
+            except Exception as e:
+                print(f"❌ Lỗi khi tải mô hình CLIP: {e}")
+                raise
+        if clip_encoder is None:
+            clip_encoder = load_clip_encoder()
+            if CLIP_QUANTIZE == "int8":
+                clip_encoder = int8_encoder_if_accurate(clip_encoder)
+
+def preload_models():
+    print("⏳ Preloading CLIP model in background...")
+    try:
+        load_models_if_needed()
+        print("✅ CLIP model preloaded successfully!")
+        precompute_text_embeddings()
+    except Exception as e:
+        print(f"❌ Error preloading models: {e}")
+
+# === Inference backend ===
+# INFERENCE_BACKEND=torch chạy CLIP eager. onnx (ONNX Runtime) / torchscript export vision và
+# text tower một lần vào MODEL_CACHE_DIR rồi chạy bản đã tối ưu cho CPU. Backend chỉ được
+# dùng khi vector đã normalize khớp bản eager, không thì quay về torch.
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", os.path.join(DATA_DIR, "model_cache"))
+BACKEND_MAX_DRIFT = 1e-4  # sai lệch tối đa mỗi phần tử vector so với eager
+
+class ClipVisionTower(torch.nn.Module):
+    """= CLIPModel.get_image_features, chỉ giữ phần vision (để export / lượng tử hóa riêng)"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.vision_model = model.vision_model
+        self.visual_projection = model.visual_projection
+
+    def forward(self, pixel_values):
+        return self.visual_projection(self.vision_model(pixel_values=pixel_values)[1])
+
+class ClipTextTower(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+def example_inputs(model, texts, batch_size, seed):
+    """Input mẫu cố định để trace/export và so khớp backend"""
+    size = model.config.vision_config.image_size
+    pixel_values = torch.randn(batch_size, 3, size, size, generator=torch.Generator().manual_seed(seed))
+    text = clip_processor(text=texts, return_tensors="pt", padding=True)
+    return pixel_values, text["input_ids"], text["attention_mask"]
+
+def cached_artifact(name, export, load):
+    """Nạp artifact đã export trong MODEL_CACHE_DIR; chưa có hoặc không đọc được thì export lại"""
+    path = os.path.join(MODEL_CACHE_DIR, f"{EMBED_MODEL_TAG}-{name}")
+    if os.path.exists(path):
+        try:
+            return load(path)
+        except Exception as e:
+            print(f"⚠️ Không đọc được {path}, export lại: {e}")
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    start_time = time.time()
+    atomic_write(path, export)
+    print(f"📦 Đã export {path} ({time.time() - start_time:.1f}s)")
+    return load(path)
+
+class TorchEncoder:
+    """CLIP eager PyTorch. Các backend trả feature chưa normalize dạng torch.Tensor"""
+    name = "torch"
+    fork_safe = True
+
+    def __init__(self, model):
+        self.model = model
+
+    def image_features(self, pixel_values):
+        with torch.inference_mode():
+            return self.model.get_image_features(pixel_values=pixel_values.to(DEVICE))
+
+    def text_features(self, input_ids, attention_mask):
+        with torch.inference_mode():
+            return self.model.get_text_features(input_ids=input_ids.to(DEVICE), attention_mask=attention_mask.to(DEVICE))
+
+class TorchScriptEncoder:
+    """Vision/text tower trace sang TorchScript, freeze + optimize_for_inference khi nạp"""
+    name = "torchscript"
+    fork_safe = True
+
+    def __init__(self, model):
+        pixel_values, input_ids, attention_mask = example_inputs(model, ["a chair", "a modern wooden table"], 2, 0)
+
+        def export(tower, inputs):
+            return lambda path: torch.jit.save(torch.jit.freeze(torch.jit.trace(tower, inputs)), path)
+
+        self.vision = cached_artifact("vision.pt", export(ClipVisionTower(model).eval(), (pixel_values,)), self.load)
+        self.text = cached_artifact("text.pt", export(ClipTextTower(model).eval(), (input_ids, attention_mask)), self.load)
+
+    @staticmethod
+    def load(path):
+        return torch.jit.optimize_for_inference(torch.jit.load(path))
+
+    def image_features(self, pixel_values):
+        with torch.no_grad():
+            return self.vision(pixel_values)
+
+    def text_features(self, input_ids, attention_mask):
+        with torch.no_grad():
+            return self.text(input_ids, attention_mask)
+
+class OnnxEncoder:
+    """Vision/text tower export sang ONNX (batch và độ dài text động), chạy bằng ONNX Runtime"""
+    name = "onnx"
+    fork_safe = False  # thread pool của session không còn sau fork: worker tự dựng lại
+
+    def __init__(self, model):
+        pixel_values, input_ids, attention_mask = example_inputs(model, ["a chair", "a modern wooden table"], 2, 0)
+
+        def export(tower, inputs, input_names, output_name, dynamic_axes):
+            def write(path):
+                # Xuất qua buffer: trọng số nằm trong một file (không tách file .data bên cạnh)
+                buffer = io.BytesIO()
+                torch.onnx.export(
+                    tower.eval(), inputs, buffer,
+                    input_names=input_names, output_names=[output_name],
+                    dynamic_axes=dict(dynamic_axes, **{output_name: {0: "batch"}}),
+                    opset_version=17,
+                )
+                with open(path, 'wb') as f:
+                    f.write(buffer.getvalue())
+            return write
+
+        self.vision = cached_artifact("vision.onnx", export(
+            ClipVisionTower(model), (pixel_values,), ["pixel_values"], "image_embeds",
+            {"pixel_values": {0: "batch"}},
+        ), self.session)
+        self.text = cached_artifact("text.onnx", export(
+            ClipTextTower(model), (input_ids, attention_mask), ["input_ids", "attention_mask"], "text_embeds",
+            {"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}},
+        ), self.session)
+
+    @staticmethod
+    def session(path):
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = torch.get_num_threads()  # = TORCH_THREADS trong worker
+        return onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def image_features(self, pixel_values):
+        return torch.from_numpy(self.vision.run(None, {"pixel_values": pixel_values.numpy()})[0])
+
+    def text_features(self, input_ids, attention_mask):
+        inputs = {"input_ids": input_ids.numpy(), "attention_mask": attention_mask.numpy()}
+        return torch.from_numpy(self.text.run(None, inputs)[0])
+
+INFERENCE_BACKENDS = {"torch": TorchEncoder, "torchscript": TorchScriptEncoder, "onnx": OnnxEncoder}
+
+def normalized_features(features):
+    """L2 normalize (cosine similarity) -> numpy float32 (n, 512)"""
+    features = features / features.norm(dim=-1, keepdim=True)
+    return features.cpu().numpy().astype(np.float32)
+
+def encoder_drift(encoder, reference):
+    """Sai lệch lớn nhất giữa vector đã normalize của hai backend (shape khác lúc export)"""
+    pixel_values, input_ids, attention_mask = example_inputs(clip_model, ["sofa"], 3, 1)
+    drift = 0.0
+    for run in (lambda e: e.image_features(pixel_values), lambda e: e.text_features(input_ids, attention_mask)):
+        diff = normalized_features(run(encoder)) - normalized_features(run(reference))
+        drift = max(drift, float(np.abs(diff).max()))
+    return drift
+
+def load_clip_encoder():
+    """Dựng backend theo INFERENCE_BACKEND; lỗi hoặc lệch so với eager thì dùng torch"""
+    eager = TorchEncoder(clip_model)
+    backend = INFERENCE_BACKEND
+    if backend == "torch":
+        return eager
+    if backend not in INFERENCE_BACKENDS:
+        print(f"⚠️ INFERENCE_BACKEND={backend} không hợp lệ, dùng torch")
+        return eager
+    if DEVICE.type == 'cuda':
+        print(f"⚠️ Backend {backend} chỉ dùng cho CPU, dùng torch trên GPU")
+        return eager
+    if backend == "onnx" and onnxruntime is None:
+        print("⚠️ Chưa cài onnxruntime, dùng torch")
+        return eager
+    try:
+        encoder = INFERENCE_BACKENDS[backend](clip_model)
+        drift = encoder_drift(encoder, eager)
+    except Exception as e:
+        print(f"❌ Lỗi dựng backend {backend}, dùng torch: {e}")
+        return eager
+    if drift > BACKEND_MAX_DRIFT:
+        print(f"⚠️ Backend {backend} lệch {drift:.1e} so với eager, dùng torch")
+        return eager
+    print(f"✅ Inference backend: {backend} (lệch tối đa {drift:.1e})")
+    return encoder
+
+# === INT8 cho image encoder ===
+# CLIP_QUANTIZE=int8: lượng tử hóa động INT8 các nn.Linear của vision tower (text tower giữ
+# nguyên). Chỉ bật khi check_quantization trên ảnh của catalog hiện tại đạt ngưỡng; có thể
+# chạy thử trước bằng POST /quantization-check mà không cần bật.
+CLIP_QUANTIZE = os.environ.get("CLIP_QUANTIZE", "none")  # none | int8
+QUANTIZE_CHECK_SAMPLES = int(os.environ.get("QUANTIZE_CHECK_SAMPLES", 200))
+QUANTIZE_MIN_COSINE = float(os.environ.get("QUANTIZE_MIN_COSINE", 0.99))  # cosine trung bình int8 vs fp32
+QUANTIZE_MIN_TOPK_OVERLAP = float(os.environ.get("QUANTIZE_MIN_TOPK_OVERLAP", 0.9))  # top-10 trùng trung bình
+QUANTIZE_CHECK_MIN_IMAGES = 20
+
+quantization_report = None  # kết quả check_quantization gần nhất
+
+class Int8ImageEncoder:
+    """Vision tower với nn.Linear INT8 (lượng tử hóa động, chạy trên CPU); text dùng backend gốc"""
+
+    def __init__(self, base, model):
+        self.base = base
+        self.name = f"{base.name}+int8"
+        self.fork_safe = base.fork_safe
+        self.vision = torch.ao.quantization.quantize_dynamic(
+            ClipVisionTower(model).eval(), {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    def image_features(self, pixel_values):
+        with torch.inference_mode():
+            return self.vision(pixel_values)
+
+    def text_features(self, input_ids, attention_mask):
+        return self.base.text_features(input_ids, attention_mask)
+
+def timed_image_embeddings(encoder, paths):
+    """Embedding đã normalize của các ảnh và thời gian encoder chạy (không tính decode)"""
+    pixel_values = pixel_batch([image for image in preprocess_pool.map(preprocess_image, paths) if image is not None])
+    start_time = time.time()
+    vectors = np.vstack([
+        normalized_features(encoder.image_features(pixel_values[i:i + EMBED_BATCH_SIZE]))
+        for i in range(0, len(pixel_values), EMBED_BATCH_SIZE)
+    ])
+    return vectors, time.time() - start_time
+
+def live_top_k(snap, vectors, k):
+    """Top-k row còn sống cho mỗi query (bỏ tombstone chưa compact)"""
+    _, I = search_index(snap, vectors, k)
+    return [[int(i) for i in row if snap.is_live(i)][:k] for row in I]
+
+def check_quantization(base, candidate, k=10):
+    """
+    So embedding INT8 với fp32 trên ảnh mẫu của catalog: cosine giữa hai vector của cùng
+    ảnh và độ trùng top-k khi search catalog bằng từng vector; đo luôn tốc độ hai encoder.
+    """
+    snap = snapshot
+    row_ids = snap.live_row_ids()
+    row_ids = np.random.default_rng(0).permutation(row_ids)
+    paths = [p for p in (snap.paths[i] for i in row_ids) if os.path.exists(p)][:QUANTIZE_CHECK_SAMPLES]
+    report = {"mode": "int8", "images": len(paths), "checked_at": time.time()}
+    if len(paths) < QUANTIZE_CHECK_MIN_IMAGES:
+        report.update(passed=False, reason=f"cần ít nhất {QUANTIZE_CHECK_MIN_IMAGES} ảnh trong catalog")
+        return report
+
+    fp32, fp32_seconds = timed_image_embeddings(base, paths)
+    int8, int8_seconds = timed_image_embeddings(candidate, paths)
+    cosine = np.einsum('ij,ij->i', fp32, int8)
+    overlaps = [
+        len(set(a) & set(b)) / max(1, len(a))
+        for a, b in zip(live_top_k(snap, fp32, k), live_top_k(snap, int8, k))
+    ]
+    report.update(
+        mean_cosine=round(float(cosine.mean()), 5),
+        min_cosine=round(float(cosine.min()), 5),
+        top_k=k,
+        topk_overlap=round(float(np.mean(overlaps)), 4),
+        fp32_ms_per_image=round(fp32_seconds * 1000 / len(paths), 2),
+        int8_ms_per_image=round(int8_seconds * 1000 / len(paths), 2),
+        speedup=round(fp32_seconds / max(int8_seconds, 1e-9), 2),
+    )
+    report["passed"] = (report["mean_cosine"] >= QUANTIZE_MIN_COSINE
+                        and report["topk_overlap"] >= QUANTIZE_MIN_TOPK_OVERLAP)
+    return report
+
+def int8_encoder_if_accurate(base):
+    """Bật INT8 nếu kiểm tra trên catalog đạt ngưỡng (worker sau fork dùng lại kết quả của master)"""
+    global quantization_report
+    if DEVICE.type == 'cuda':
+        print("⚠️ CLIP_QUANTIZE=int8 chỉ dùng cho CPU, bỏ qua trên GPU")
+        return base
+    try:
+        candidate = Int8ImageEncoder(base, clip_model)
+        if quantization_report is None:
+            quantization_report = check_quantization(base, candidate)
+    except Exception as e:
+        print(f"❌ Lỗi lượng tử hóa INT8, giữ fp32: {e}")
+        return base
+    if not quantization_report["passed"]:
+        print(f"⚠️ INT8 chưa đạt ngưỡng chính xác, giữ fp32: {quantization_report}")
+        return base
+    print(f"✅ Đã bật INT8 cho image encoder: {quantization_report}")
+    return candidate
+
+# === Embedding store ===
+class EmbeddingStore:
+    """
+    Ma trận embedding float32 append-only lưu trên đĩa (memory-mapped).
+    Row id = số thứ tự dòng trong file, không bao giờ thay đổi hay tái sử dụng,
+    nên rebuild / retrain / delete chỉ cần đọc vector từ đây, không chạy lại CLIP.
+    """
+
+    def __init__(self, path, dim=FEATURE_DIM):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * np.dtype(np.float32).itemsize
+        self.lock = threading.Lock()
+        self._view = None
+        self._view_inode = None
+        self._rows = 0
+        if os.path.exists(path):
+            size = os.path.getsize(path)
+            if size % self.row_bytes:
+                # Dòng cuối bị ghi dở (crash giữa chừng) -> cắt bỏ
+                print(f"⚠️ {path}: bỏ {size % self.row_bytes} bytes ghi dở")
+                os.truncate(path, size - size % self.row_bytes)
+            self._rows = size // self.row_bytes
+
+    def __len__(self):
+        return self._rows
+
+    def append(self, vectors):
+        """Ghi thêm vector vào cuối file, trả về row id của chúng"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self.lock:
+            with open(self.path, 'ab') as f:
+                # Đọc cỡ file thật (process khác có thể đã append; gọi trong write_lock)
+                size = f.seek(0, os.SEEK_END)
+                if size % self.row_bytes:
+                    f.truncate(size - size % self.row_bytes)
+                start = size // self.row_bytes
+                f.write(vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._rows = start + len(vectors)
+            self._view = None
+        return np.arange(start, start + len(vectors), dtype=np.int64)
+
+    def refresh(self):
+        """Cập nhật số row theo file trên đĩa (process khác append, hoặc build_index.py thay file)"""
+        with self.lock:
+            try:
+                st = os.stat(self.path)
+                rows, inode = st.st_size // self.row_bytes, st.st_ino
+            except FileNotFoundError:
+                rows, inode = 0, None
+            if rows != self._rows or (self._view is not None and inode != self._view_inode):
+                self._rows = rows
+                self._view = None
+
+    def matrix(self):
+        """View memmap (read-only) của toàn bộ ma trận"""
+        with self.lock:
+            if self._rows == 0:
+                return np.zeros((0, self.dim), dtype=np.float32)
+            if self._view is None:
+                self._view_inode = os.stat(self.path).st_ino
+                self._view = np.memmap(self.path, dtype=np.float32, mode='r', shape=(self._rows, self.dim))
+            return self._view
+
+    def get(self, row_ids):
+        """Lấy vector theo row id (copy ra RAM)"""
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        if len(row_ids) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.ascontiguousarray(self.matrix()[row_ids])
+
+    def reset(self):
+        with self.lock:
+            self._view = None
+            self._rows = 0
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+# === String table cho paths ===
+PATH_TABLE_MAGIC = b"PATHTAB1"
+
+class PathTable:
+    """
+    Danh sách path append-only theo row id. Phần đã checkpoint là string table
+    memory-mapped (header, offsets int64[n+1], blob utf-8 - không pickle) nên mở tức thì
+    và các process dùng chung page cache; path thêm sau checkpoint nằm trong `tail`.
+    """
+
+    def __init__(self, paths=()):
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._blob = np.zeros(0, dtype=np.uint8)
+        self._count = 0
+        self.overrides = {}  # row trong phần mmap được ghi lại khi replay log
+        self.tail = list(paths)
+
+    @classmethod
+    def open(cls, path):
+        table = cls()
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        if data[:8].tobytes() != PATH_TABLE_MAGIC:
+            raise ValueError(f"{path}: không phải path table")
+        count = int(data[8:16].view(np.int64)[0])
+        blob_start = 16 + 8 * (count + 1)
+        table._offsets = data[16:blob_start].view(np.int64)
+        table._blob = data[blob_start:]
+        table._count = count
+        return table
+
+    def __len__(self):
+        return self._count + len(self.tail)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i >= self._count:
+            return self.tail[i - self._count]
+        path = self.overrides.get(i)
+        if path is None:
+            path = self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes().decode('utf-8')
+        return path
+
+    def __setitem__(self, i, path):
+        if i >= self._count:
+            self.tail[i - self._count] = path
+        else:
+            self.overrides[i] = path
+
+    def extend(self, paths):
+        self.tail.extend(paths)
+
+    def write(self, path, n_rows):
+        """Ghi n_rows path đầu thành string table; phần mmap chưa bị sửa được chép nguyên blob"""
+        head = self._count if not self.overrides and n_rows >= self._count else 0
+        encoded = [p.encode('utf-8') for p in self[head:n_rows]]
+        head_bytes = int(self._offsets[head])
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        offsets = np.concatenate([self._offsets[:head + 1], head_bytes + np.cumsum(lengths)])
+        with open(path, 'wb') as f:
+            f.write(PATH_TABLE_MAGIC)
+            f.write(np.int64(n_rows).tobytes())
+            f.write(offsets.tobytes())
+            f.write(self._blob[:head_bytes].tobytes())
+            f.write(b''.join(encoded))
+
+def fsync_dir(path):
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomic_write(path, write):
+    """
+    Ghi ra file tạm rồi os.replace: file đích luôn là bản cũ hoặc bản mới trọn vẹn.
+    write(tmp_path) tự ghi file tạm (tên tạm giữ nguyên đuôi file cho np.save).
+    """
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.tmp{ext}"
+    write(tmp_path)
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(path))
+
+class FileLock:
+    """
+    flock trên một file trong DATA_DIR: khóa giữa các worker process dùng chung DATA_DIR.
+    flock gắn với open file description nên kèm thêm lock trong process cho các thread,
+    và process con phải reopen() sau khi fork.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def acquire(self, shared=False, blocking=True):
+        if not self.local.acquire(blocking):
+            return False
+        try:
+            fcntl.flock(self.fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            self.local.release()
+            return False
+        except BaseException:
+            self.local.release()
+            raise
+        return True
+
+    def release(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.local.release()
+
+    @contextmanager
+    def hold(self, shared=False):
+        self.acquire(shared)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def reopen(self):
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+class MutationLog:
+    """
+    Write-ahead log cho thao tác ghi index: mỗi thao tác là một dòng JSON có lsn tăng
+    dần, fsync trước khi áp dụng vào bộ nhớ và được replay khi khởi động.
+    Vector đã nằm trong embedding store (fsync khi append) nên log chỉ ghi row id.
+    Nhiều process cùng ghi (trong write_lock) và tail log của nhau qua read_new().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lsn = 0  # lsn cuối đã áp dụng vào bộ nhớ
+        self.file = None
+        self.read_inode = None  # vị trí đã đọc tới: (inode, offset) của file log
+        self.read_offset = 0
+
+    def _open(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'ab')
+        st = os.fstat(self.file.fileno())
+        self.read_inode, self.read_offset = st.st_ino, st.st_size
+
+    def replay(self, after_lsn=0):
+        """Đọc các thao tác có lsn > after_lsn; cắt bỏ dòng cuối ghi dở (crash giữa chừng)"""
+        self.lsn = after_lsn
+        records = []
+        if os.path.exists(self.path):
+            valid_bytes = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line) if line.endswith(b'\n') else None
+                    except ValueError:
+                        record = None
+                    if record is None:
+                        break
+                    valid_bytes += len(line)
+                    self.lsn = max(self.lsn, record["lsn"])
+                    if record["lsn"] > after_lsn:
+                        records.append(record)
+            if valid_bytes < os.path.getsize(self.path):
+                print(f"⚠️ Bỏ phần ghi dở ở cuối {self.path}")
+                with open(self.path, 'r+b') as f:
+                    f.truncate(valid_bytes)
+        self._open()
+        return records
+
+    def changed(self):
+        """Log có dữ liệu chưa đọc (process khác vừa ghi, hoặc đã được thay bằng file mới)"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (st.st_ino, st.st_size) != (self.read_inode, self.read_offset)
+
+    def read_new(self):
+        """
+        Đọc các thao tác trọn vẹn được ghi sau lần đọc trước, chỉ trả về lsn > self.lsn.
+        Gọi trong write_lock: không ai đang ghi dở nên phần thừa cuối file là rác -> cắt bỏ.
+        """
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, 'r+b') as f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.read_inode:
+                self.read_inode, self.read_offset = st.st_ino, 0
+            f.seek(self.read_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self.read_offset += len(line)
+                record = json.loads(line)
+                if record["lsn"] > self.lsn:
+                    records.append(record)
+            if self.read_offset < st.st_size:
+                print(f"⚠️ Bỏ phần ghi dở ở cuối {self.path}")
+                f.truncate(self.read_offset)
+        return records
+
+    def append(self, op, **fields):
+        if os.fstat(self.file.fileno()).st_ino != self.read_inode:
+            self._open()  # process khác đã checkpoint (thay file log)
+        self.lsn += 1
+        record = dict(fields, op=op, lsn=self.lsn)
+        self.file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.read_offset = self.file.tell()
+        return self.lsn
+
+    def size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def truncate_through(self, lsn):
+        """Bỏ các thao tác đã nằm trong checkpoint (lsn <= lsn), giữ phần ghi sau đó"""
+        with open(self.path, 'rb') as f:
+            remaining = [line for line in f if json.loads(line)["lsn"] > lsn]
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.writelines(remaining)
+
+        atomic_write(self.path, write)
+        self._open()
+
+    def reset(self):
+        atomic_write(self.path, lambda tmp_path: open(tmp_path, 'wb').close())
+        self.lsn = 0
+        self._open()
+
+    def reopen(self):
+        """Mở lại file sau khi fork, giữ nguyên vị trí đã đọc"""
+        self.file.close()
+        self.file = open(self.path, 'ab')
+
+def reconstruct_all_vectors(idx):
+    """Đọc lại toàn bộ vector đang nằm trong FAISS index (dùng để migrate index cũ)"""
+    if idx.ntotal == 0:
+        return np.zeros((0, idx.d), dtype=np.float32)
+    ivf = faiss.try_extract_index_ivf(idx)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return idx.reconstruct_n(0, idx.ntotal)
+
+# === ID-mapped index ===
+# Mọi vector trong index mang id = row id trong embedding store (int64, ổn định).
+# Flat: IndexIDMap2(IndexFlatIP). IVF: id gốc của IndexIVF + DirectMap hashtable
+# (IndexIDMap2 bọc IVF trả sai id sau remove_ids).
+def new_flat_index():
+    """Index rỗng mặc định: IndexFlatIP bọc IndexIDMap2"""
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(FEATURE_DIM))
+
+def is_id_mapped(idx):
+    if isinstance(idx, faiss.IndexIDMap2):
+        return True
+    ivf = faiss.try_extract_index_ivf(idx)
+    return ivf is not None and ivf.direct_map.type == faiss.DirectMap.Hashtable
+
+def core_index(idx):
+    """Index lõi bên trong các lớp bọc IndexIDMap2 / IndexPreTransform (OPQ)"""
+    idx = faiss.downcast_index(idx)
+    while isinstance(idx, (faiss.IndexIDMap2, faiss.IndexPreTransform)):
+        idx = faiss.downcast_index(idx.index)
+    return idx
+
+def index_type_name(idx=None):
+    """Tên index lõi (OPQ: index sau phép xoay, kiểu nén xem index_codec)"""
+    return type(core_index(snapshot.base if idx is None else idx)).__name__
+
+def index_codec(idx):
+    """Kiểu nén vector của index: none | sq8 | fp16 | pq | opq"""
+    wrapped = faiss.downcast_index(idx.index) if isinstance(idx, faiss.IndexIDMap2) else idx
+    if isinstance(wrapped, faiss.IndexPreTransform):
+        return "opq"
+    core = core_index(idx)
+    if isinstance(core, faiss.IndexHNSW):
+        core = faiss.downcast_index(core.storage)
+    if isinstance(core, (faiss.IndexIVFPQ, faiss.IndexPQ)):
+        return "pq"
+    if isinstance(core, (faiss.IndexIVFScalarQuantizer, faiss.IndexScalarQuantizer)):
+        return "fp16" if core.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "none"
+
+def index_bytes_per_vector(idx):
+    """Ước lượng RAM mỗi vector của index: mã vector + id (+ cạnh tầng 0 của HNSW)"""
+    core = core_index(idx)
+    if isinstance(core, faiss.IndexIVF):
+        return core.code_size + 8
+    id_bytes = 8 if isinstance(idx, faiss.IndexIDMap2) else 0
+    if isinstance(core, faiss.IndexHNSW):
+        return faiss.downcast_index(core.storage).sa_code_size() + 4 * core.hnsw.nb_neighbors(0) + id_bytes
+    return core.sa_code_size() + id_bytes
+
+mmapped_indexes = weakref.WeakSet()  # index có code vector là view của file
+IO_FLAG_MMAP_IFC = getattr(faiss, "IO_FLAG_MMAP_IFC", None)  # không có trong các bản faiss-cpu cũ
+
+def read_index_mmap(path):
+    """
+    Đọc index với code vector memory-mapped (chỉ đọc, dùng chung page cache giữa các process).
+    faiss cũ không có IO_FLAG_MMAP_IFC: đọc bình thường vào RAM.
+    """
+    if not INDEX_MMAP or IO_FLAG_MMAP_IFC is None:
+        return faiss.read_index(path)
+    idx = faiss.read_index(path, IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    mmapped_indexes.add(idx)
+    return idx
+
+def clone_writable(idx):
+    """Bản sao sửa được; clone_index của index mmap vẫn trỏ vào file nên phải qua serialize"""
+    if idx in mmapped_indexes:
+        return faiss.deserialize_index(faiss.serialize_index(idx))
+    return faiss.clone_index(idx)
+
+def id_selector(idx, ids):
+    """IDSelector cho remove_ids (DirectMap hashtable của IVF chỉ nhận IDSelectorArray)"""
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    if faiss.try_extract_index_ivf(idx) is not None:
+        sel = faiss.IDSelectorArray(len(ids), faiss.swig_ptr(ids))
+    else:
+        sel = faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+    sel.ids_ref = ids  # giữ mảng sống cùng selector
+    return sel
+
+def index_ids(idx):
+    """Toàn bộ id trong index IndexIDMap2"""
+    return faiss.vector_to_array(idx.id_map).astype(np.int64)
+
+def ids_in_index(idx, ids):
+    """Lọc các id đang có trong index (IndexIDMap2 hoặc IVF DirectMap hashtable)"""
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(ids) == 0 or idx.ntotal == 0:
+        return ids[:0]
+    if isinstance(idx, faiss.IndexIDMap2):
+        return ids[np.isin(ids, index_ids(idx))]
+    direct_map = faiss.try_extract_index_ivf(idx).direct_map
+    present = []
+    for row_id in ids:
+        try:
+            direct_map.get(int(row_id))
+            present.append(row_id)
+        except RuntimeError:
+            pass
+    return np.asarray(present, dtype=np.int64)
+
+def migrate_positional_index(idx, paths):
+    """Chuyển index cũ (id = vị trí) sang index id-mapped theo row id"""
+    rows = None
+    if os.path.exists(ROWS_PATH):
+        rows = np.load(ROWS_PATH).astype(np.int64)
+        if len(rows) != idx.ntotal or (len(rows) and rows.max() >= len(embedding_store)):
+            rows = None
+    if rows is None:
+        # Index cũ chưa có embedding store -> lấy vector từ index một lần duy nhất
+        print("🔄 Khởi tạo embedding store từ FAISS index...")
+        rows = embedding_store.append(reconstruct_all_vectors(idx))
+
+    new_paths = PathTable([''] * len(embedding_store))
+    deleted = np.ones(len(embedding_store), dtype=bool)
+    for pos, row in enumerate(rows):
+        if pos < len(paths):
+            new_paths[row] = str(paths[pos])
+            deleted[row] = False
+    rows = rows[~deleted[rows]]
+
+    vectors = embedding_store.get(rows)
+    ivf = faiss.try_extract_index_ivf(idx)
+    if ivf is not None:
+        # Giữ nguyên quantizer đã train, chỉ nạp lại vector với id mới
+        idx.reset()
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        idx.add_with_ids(vectors, rows)
+        new_idx = idx
+    else:
+        new_idx = new_flat_index()
+        new_idx.add_with_ids(vectors, rows)
+    print(f"✅ Đã chuyển index sang id-mapped ({len(rows)} vectors)")
+    return new_idx, new_paths, deleted
+
+# === Index snapshot (RCU) ===
+# Request đọc lấy `snapshot` hiện tại đúng một lần rồi làm việc trên đó không cần lock:
+# không field nào của snapshot bị sửa tại chỗ. Writer giữ write_lock, dựng snapshot kế
+# tiếp bên cạnh rồi gán lại biến `snapshot` (phép gán là atomic).
+# Index = base (Flat/IVF, lớn) + delta (IndexFlat nhỏ chứa các row mới thêm). Thêm/xóa
+# row chỉ clone delta; base chỉ được dựng lại ở background (gộp delta, compaction, IVF).
+DELTA_MAX_VECTORS = int(os.environ.get("DELTA_MAX_VECTORS", 2048))
+# Base nén (SQ/PQ) trả điểm xấp xỉ: lấy k·INDEX_RERANK_FACTOR ứng viên rồi chấm lại bằng
+# embedding gốc trong store (0 = tắt re-rank)
+INDEX_RERANK_FACTOR = int(os.environ.get("INDEX_RERANK_FACTOR", 4))
+
+class IndexSnapshot:
+    """Phiên bản bất biến của index, paths và bitmap tombstone"""
+
+    def __init__(self, base, delta, paths, deleted, pending=(), delta_start=None, version=0, base_version=0):
+        self.base = base                # chứa các row id < delta_start
+        self.delta = delta              # chứa các row id >= delta_start
+        self.paths = paths              # PathTable append-only, chỉ đọc paths[:n_rows]
+        self.deleted = deleted          # bitmap row đã xóa
+        self.n_rows = len(deleted)
+        self.pending = tuple(pending)   # row đã xóa nhưng còn trong base, chờ compaction
+        self.delta_start = self.n_rows if delta_start is None else delta_start
+        self.version = version
+        self.base_version = base_version
+
+    def evolve(self, **changes):
+        """Snapshot kế tiếp với các field được thay"""
+        fields = {
+            "base": self.base,
+            "delta": self.delta,
+            "paths": self.paths,
+            "deleted": self.deleted,
+            "pending": self.pending,
+            "delta_start": self.delta_start,
+        }
+        fields.update(changes)
+        base_version = self.base_version + (fields["base"] is not self.base)
+        return IndexSnapshot(version=self.version + 1, base_version=base_version, **fields)
+
+    @property
+    def ntotal(self):
+        return self.base.ntotal + self.delta.ntotal
+
+    def is_live(self, i):
+        return 0 <= i < self.n_rows and not self.deleted[i]
+
+    def live_row_ids(self):
+        return np.flatnonzero(~self.deleted).astype(np.int64)
+
+    def live_count(self):
+        return self.n_rows - int(self.deleted.sum())
+
+class DataLock:
+    """
+    Lock ghi dùng chung giữa các thread và các worker process: RLock trong process + flock
+    trên DATA_DIR. Lần acquire ngoài cùng gọi on_acquire (sync_with_disk) để writer luôn
+    làm việc trên trạng thái mới nhất mà các process khác đã ghi xuống đĩa.
+    """
+
+    def __init__(self, path):
+        self.local = threading.RLock()
+        self.file_lock = FileLock(path)
+        self.depth = 0
+        self.on_acquire = None
+
+    def __enter__(self):
+        self.local.acquire()
+        if self.depth == 0:
+            try:
+                self.file_lock.acquire()
+            except BaseException:
+                self.local.release()
+                raise
+        self.depth += 1
+        if self.depth == 1 and self.on_acquire is not None:
+            try:
+                self.on_acquire()
+            except BaseException:
+                self.__exit__(None, None, None)
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            self.file_lock.release()
+        self.local.release()
+
+write_lock = DataLock(os.path.join(DATA_DIR, "index.lock"))  # tuần tự hóa mọi thao tác ghi
+rebuild_lock = threading.Lock()   # chỉ một lần dựng lại base tại một thời điểm
+checkpoint_lock = FileLock(os.path.join(DATA_DIR, "checkpoint.lock"))  # EX khi ghi checkpoint, SH khi nạp lại
+maintenance_leader_lock = FileLock(os.path.join(DATA_DIR, "maintenance.lock"))  # worker giữ lock chạy bảo trì
+
+def publish(new_snapshot):
+    global snapshot
+    snapshot = new_snapshot
+
+def merge_topk(results, k):
+    """Gộp kết quả search của base và delta, giữ k score cao nhất mỗi query"""
+    results = [(D, I) for D, I in results if D.shape[1] > 0]
+    if len(results) == 1:
+        return results[0]
+    D = np.hstack([D for D, _ in results])
+    I = np.hstack([I for _, I in results])
+    order = np.argsort(-D, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+
+def rerank_exact(vectors, ids, k):
+    """Chấm lại điểm các ứng viên bằng embedding gốc trong store, giữ k cao nhất mỗi query"""
+    valid = ids >= 0
+    candidates = embedding_store.get(np.where(valid, ids, 0).ravel()).reshape(*ids.shape, -1)
+    scores = np.einsum('qd,qcd->qc', vectors, candidates)
+    scores[~valid] = -np.finfo(np.float32).max  # như FAISS khi thiếu kết quả
+    order = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+def search_candidates(idx, vectors, k, params=None):
+    """Search một index; index nén thì lấy dư ứng viên rồi re-rank chính xác"""
+    if INDEX_RERANK_FACTOR <= 0 or index_codec(idx) == "none":
+        return idx.search(vectors, min(k, idx.ntotal), params=params)
+    _, I = idx.search(vectors, min(k * INDEX_RERANK_FACTOR, idx.ntotal), params=params)
+    return rerank_exact(vectors, I, k)
+
+def search_snapshot(snap, vectors, k, base_params=None, delta_params=None):
+    results = []
+    for idx, params in ((snap.base, base_params), (snap.delta, delta_params)):
+        if min(k, idx.ntotal) > 0:
+            results.append(search_candidates(idx, vectors, k, params))
+    if not results:
+        return np.zeros((len(vectors), 0), dtype=np.float32), np.zeros((len(vectors), 0), dtype=np.int64)
+    return merge_topk(results, k)
+
+# === Load index và metadata ===
+print("🔄 Đang tải FAISS index và metadata...")
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+if not OFFLINE_TOOL and not any(os.path.exists(path) for path in (INDEX_PATH, EMBEDDINGS_PATH, MUTATION_LOG_PATH)):
+    # DATA_DIR mới: lấy index/paths/metadata cũ nằm cạnh app.py (image build sẵn) làm dữ liệu ban đầu
+    for path in (INDEX_PATH, PATH_TABLE_PATH, PATHS_PATH, METADATA_PATH):
+        legacy_path = os.path.join(APP_DIR, os.path.basename(path))
+        if os.path.exists(legacy_path) and os.path.abspath(legacy_path) != os.path.abspath(path):
+            shutil.copy(legacy_path, path)
+
+embedding_store = EmbeddingStore(EMBEDDINGS_PATH)
+saved_base_version = None  # base_version của base đã nằm trên đĩa (None = cần ghi)
+index_tuning = {}  # loại index + tham số search đã tune (xem optimize_index_if_needed)
+loaded_base_id = None  # base_id trong checkpoint ứng với base đang phục vụ
+checkpoint_generation = None  # đổi mỗi lần /reset
+
+# Load metadata (trước index: replay log ghi đè lên metadata đã migrate)
+product_metadata = MetadataStore(METADATA_DB_PATH)
+
+def migrate_legacy_metadata():
+    """Migrate một lần từ product_metadata.json cũ"""
+    if len(product_metadata) == 0 and os.path.exists(METADATA_PATH):
+        with open(METADATA_PATH, 'r', encoding='utf-8') as f:
+            product_metadata.update_many(json.load(f).items())
+        print(f"✅ Đã chuyển metadata từ {METADATA_PATH} sang {METADATA_DB_PATH}")
+
+if not OFFLINE_TOOL:
+    migrate_legacy_metadata()
+    print(f"✅ Đã tải metadata cho {len(product_metadata)} sản phẩm")
+
+mutation_log = MutationLog(MUTATION_LOG_PATH)
+
+def read_checkpoint():
+    if not os.path.exists(CHECKPOINT_PATH):
+        return {}
+    with open(CHECKPOINT_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_checkpoint(checkpoint):
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+
+    atomic_write(CHECKPOINT_PATH, write)
+
+def disk_signature(path):
+    """(inode, cỡ, mtime) để phát hiện file bị process khác ghi/thay; None nếu chưa có"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def replay_mutation(record, paths, deleted, apply_metadata=True):
+    """Áp dụng lại một thao tác trong log lên paths/tombstone/metadata; trả về bitmap deleted mới"""
+    end = max(record["rows"]) + 1 if record["rows"] else 0
+    if end > len(paths):
+        paths.extend([''] * (end - len(paths)))
+    if end > len(deleted):
+        deleted = np.concatenate([deleted, np.ones(end - len(deleted), dtype=bool)])
+    if record["op"] == "add":
+        for row_id, path in zip(record["rows"], record["paths"]):
+            paths[row_id] = path
+            deleted[row_id] = False
+        deleted[record["replaced"]] = True
+        if apply_metadata:
+            product_metadata.update_many(zip(record["paths"], record["metadata"]))
+    elif record["op"] == "delete":
+        deleted[record["rows"]] = True
+        if apply_metadata:
+            for path in record["paths"]:
+                if path in product_metadata:
+                    del product_metadata[path]
+    return deleted
+
+def load_snapshot(checkpoint, previous=None, apply_metadata=True):
+    """
+    Dựng snapshot từ các file checkpoint + replay các thao tác sau đó trong mutation log.
+    apply_metadata=False khi worker nạp lại: metadata SQLite đã được process ghi cập nhật.
+    Trả về (snapshot, base_saved); base_saved=False khi base chưa nằm trên đĩa (vừa migrate).
+    """
+    delta = new_flat_index()
+    base_saved = False
+    if os.path.exists(INDEX_PATH) and (os.path.exists(PATH_TABLE_PATH) or os.path.exists(PATHS_PATH)):
+        base = read_index_mmap(INDEX_PATH)
+        # image_paths[row_id] = đường dẫn ảnh (kể cả row đã xóa)
+        if os.path.exists(PATH_TABLE_PATH):
+            image_paths = PathTable.open(PATH_TABLE_PATH)
+        else:
+            image_paths = PathTable(str(p) for p in np.load(PATHS_PATH, allow_pickle=True))
+        if is_id_mapped(base):
+            deleted_rows = np.load(DELETED_PATH) if os.path.exists(DELETED_PATH) else np.zeros(len(image_paths), dtype=bool)
+            if os.path.exists(DELTA_INDEX_PATH):
+                delta = faiss.read_index(DELTA_INDEX_PATH)
+            base_saved = True
+        else:
+            base, image_paths, deleted_rows = migrate_positional_index(faiss.read_index(INDEX_PATH), image_paths)
+        print(f"✅ Đã tải index với {len(image_paths) - int(deleted_rows.sum())} sản phẩm")
+    else:
+        base = new_flat_index()  # CLIP uses 512-dim features
+        image_paths = PathTable()
+        deleted_rows = np.zeros(0, dtype=bool)
+        print("✅ Tạo index mới (CLIP 512-dim)")
+
+    # Replay các thao tác sau checkpoint cuối (log chỉ chứa thao tác đã fsync trọn vẹn)
+    replayed = mutation_log.replay(checkpoint.get("lsn", 0))
+    for record in replayed:
+        deleted_rows = replay_mutation(record, image_paths, deleted_rows, apply_metadata)
+    if replayed:
+        print(f"🔁 Đã replay {len(replayed)} thao tác từ {MUTATION_LOG_PATH}")
+
+    # Row có trong store nhưng không có trong log/checkpoint (crash trước khi ghi log) -> coi như đã xóa
+    embedding_store.refresh()
+    if len(image_paths) < len(embedding_store):
+        image_paths.extend([''] * (len(embedding_store) - len(image_paths)))
+    if len(deleted_rows) < len(image_paths):
+        deleted_rows = np.concatenate([deleted_rows, np.ones(len(image_paths) - len(deleted_rows), dtype=bool)])
+
+    # Đối chiếu index với paths/tombstone: delta bỏ row đã xóa hoặc đã có trong base (crash
+    # giữa lúc ghi checkpoint), row còn sống chưa có trong index (replay từ log) được thêm vào delta
+    delta_ids = index_ids(delta)
+    stale = np.union1d(delta_ids[deleted_rows[delta_ids]], ids_in_index(base, delta_ids))
+    if len(stale):
+        delta.remove_ids(id_selector(delta, stale))
+        delta_ids = np.setdiff1d(delta_ids, stale)
+    pending = ids_in_index(base, np.flatnonzero(deleted_rows))
+    live_ids = np.flatnonzero(~deleted_rows).astype(np.int64)
+    if base.ntotal - len(pending) + len(delta_ids) != len(live_ids):
+        missing = np.setdiff1d(live_ids, delta_ids)
+        missing = np.setdiff1d(missing, ids_in_index(base, missing))
+        delta.add_with_ids(embedding_store.get(missing), missing)
+        delta_ids = index_ids(delta)
+        print(f"🔁 Đã thêm lại {len(missing)} vectors chưa có trong index")
+
+    versions = {} if previous is None else {
+        "version": previous.version + 1,
+        "base_version": previous.base_version + 1,
+    }
+    new_snapshot = IndexSnapshot(
+        base, delta, image_paths, deleted_rows,
+        pending=[int(i) for i in pending],
+        delta_start=int(delta_ids.min()) if len(delta_ids) else len(deleted_rows),
+        **versions,
+    )
+    return new_snapshot, base_saved
+
+# === Tombstone & lookup maps ===
+# snapshot.deleted: bitmap row đã xóa (search bỏ qua ngay lập tức).
+# snapshot.pending: row đã xóa nhưng vẫn còn trong base, chờ compaction dựng lại base.
+# Lookup maps chỉ được sửa trong write_lock; set id của product là frozenset thay mới
+# mỗi lần sửa nên request đọc không bao giờ thấy set đang bị sửa.
+COMPACT_MIN_TOMBSTONES = 256
+COMPACT_INTERVAL_SECONDS = 300
+# Checkpoint khi log đủ lớn hoặc đủ lâu kể từ checkpoint trước (và log không rỗng)
+CHECKPOINT_LOG_BYTES = int(os.environ.get("CHECKPOINT_LOG_BYTES", 4 * 1024 * 1024))
+CHECKPOINT_INTERVAL_SECONDS = float(os.environ.get("CHECKPOINT_INTERVAL_SECONDS", 60))
+
+filename_to_id = {}
+product_to_ids = {}
+product_of_row = {}  # row id -> product_id (metadata có thể đã bị process khác xóa)
+
+def index_row_keys(row_id, path, product_id=None):
+    filename_to_id[os.path.basename(path)] = row_id
+    if product_id is None:
+        product_id = product_metadata.get(path, {}).get('product_id')
+    if product_id:
+        key = str(product_id)
+        product_of_row[row_id] = key
+        product_to_ids[key] = product_to_ids.get(key, frozenset()) | {row_id}
+
+def unindex_row_keys(row_id, path):
+    if filename_to_id.get(os.path.basename(path)) == row_id:
+        del filename_to_id[os.path.basename(path)]
+    key = product_of_row.pop(row_id, None)
+    ids = product_to_ids.get(key)
+    if ids is not None:
+        ids = ids - {row_id}
+        if ids:
+            product_to_ids[key] = ids
+        else:
+            del product_to_ids[key]
+
+def rebuild_lookup_maps(snap):
+    filename_to_id.clear()
+    product_to_ids.clear()
+    product_of_row.clear()
+    product_ids = product_metadata.product_ids()
+    for row_id in snap.live_row_ids():
+        path = snap.paths[row_id]
+        index_row_keys(int(row_id), path, product_ids.get(path, ''))
+
+def drop_rows(snap, deleted, delta, row_ids):
+    """
+    Tombstone row_ids trên bản nháp `deleted` của snapshot kế tiếp.
+    Row trong delta bị remove ngay (trên bản clone), row trong base chờ compaction.
+    Trả về (delta, pending) mới.
+    """
+    pending = list(snap.pending)
+    in_delta = []
+    for row_id in row_ids:
+        unindex_row_keys(row_id, snap.paths[row_id])
+        deleted[row_id] = True
+        if row_id >= snap.delta_start:
+            in_delta.append(row_id)
+        else:
+            pending.append(row_id)
+    if in_delta:
+        if delta is snap.delta:
+            delta = faiss.clone_index(delta)
+        delta.remove_ids(id_selector(delta, in_delta))
+    return delta, pending
+
+def apply_add(row_ids, vectors, paths, metadatas, replaced):
+    """Áp dụng thao tác thêm row đã ghi log: publish snapshot kế tiếp (không ghi metadata)"""
+    snap = snapshot
+    # Row có trong store trước row_ids nhưng không có trong log (process khác crash trước khi
+    # ghi log) -> coi như đã xóa
+    gap = int(row_ids[0]) - snap.n_rows if len(row_ids) else 0
+    delta = faiss.clone_index(snap.delta)
+    delta.add_with_ids(vectors, row_ids)
+    snap.paths.extend([''] * gap + list(paths))
+    deleted = np.concatenate([snap.deleted, np.ones(gap, dtype=bool), np.zeros(len(paths), dtype=bool)])
+    filename_to_id.update({os.path.basename(path): int(row_id) for row_id, path in zip(row_ids, paths)})
+    delta, pending = drop_rows(snap, deleted, delta, replaced)
+
+    append_attribute_rows([{}] * gap + list(metadatas))
+    for row_id, path, metadata in zip(row_ids, paths, metadatas):
+        index_row_keys(int(row_id), path, metadata.get('product_id', ''))
+    publish(snap.evolve(delta=delta, deleted=deleted, pending=pending))
+
+def apply_delete(row_ids):
+    snap = snapshot
+    deleted = snap.deleted.copy()
+    delta, pending = drop_rows(snap, deleted, snap.delta, row_ids)
+    publish(snap.evolve(delta=delta, deleted=deleted, pending=pending))
+
+def apply_logged_mutation(record):
+    """Áp dụng một thao tác do process khác ghi vào log (metadata SQLite đã được ghi sẵn)"""
+    row_ids = np.asarray(record["rows"], dtype=np.int64)
+    if record["op"] == "add":
+        apply_add(row_ids, embedding_store.get(row_ids), record["paths"], record["metadata"], record["replaced"])
+    elif record["op"] == "delete":
+        apply_delete([int(i) for i in row_ids])
+
+def add_rows(vectors, paths, metadatas):
+    """Thêm row mới (ảnh trùng tên file thay thế row cũ): ghi log trước, rồi publish snapshot kế tiếp"""
+    with write_lock:
+        row_ids = embedding_store.append(vectors)
+        new_ids = {}
+        replaced = []
+        for row_id, path in zip(row_ids, paths):
+            name = os.path.basename(path)
+            old_id = new_ids.get(name, filename_to_id.get(name))
+            if old_id is not None:
+                replaced.append(int(old_id))
+            new_ids[name] = int(row_id)
+        mutation_log.append(
+            "add", rows=[int(i) for i in row_ids], paths=list(paths), metadata=list(metadatas), replaced=replaced
+        )
+        product_metadata.update_many(zip(paths, metadatas))
+        apply_add(row_ids, vectors, paths, metadatas, replaced)
+    return row_ids
+
+def delete_paths(paths):
+    """
+    Soft-delete các path đang có trong index (mỗi tên file chỉ có một row sống), một bản ghi
+    log cho cả nhóm; trả về các path đã xóa
+    """
+    with write_lock:
+        snap = snapshot
+        rows = {}
+        for path in paths:
+            row_id = filename_to_id.get(os.path.basename(path))
+            if row_id is not None and snap.is_live(row_id) and snap.paths[row_id] == path:
+                rows[row_id] = path
+        if not rows:
+            return []
+        removed_paths = list(rows.values())
+        mutation_log.append("delete", rows=[int(i) for i in rows], paths=removed_paths)
+        product_metadata.delete_many(removed_paths)
+        apply_delete(list(rows))
+    return removed_paths
+
+def delete_row(filename):
+    """Soft-delete O(1) theo tên file; trả về path đã xóa hoặc None nếu không có"""
+    with write_lock:
+        snap = snapshot
+        row_id = filename_to_id.get(filename)
+        if row_id is None or not snap.is_live(row_id):
+            return None
+        return delete_paths([snap.paths[row_id]])[0]
+
+if OFFLINE_TOOL:
+    snapshot = IndexSnapshot(new_flat_index(), new_flat_index(), PathTable(), np.zeros(0, dtype=bool))
+else:
+    with write_lock:
+        startup_checkpoint = read_checkpoint()
+        snapshot, base_saved = load_snapshot(startup_checkpoint)
+    saved_base_version = 0 if base_saved else None
+    index_tuning = startup_checkpoint.get("tuning", {})
+    loaded_base_id = startup_checkpoint.get("base_id")
+    checkpoint_generation = startup_checkpoint.get("generation")
+    del startup_checkpoint, base_saved
+rebuild_lookup_maps(snapshot)
+
+def search_index(snap, vectors, k):
+    """Search snapshot, lấy dư thêm số tombstone chưa compact để vẫn đủ k row còn sống"""
+    return search_snapshot(snap, vectors, k + len(snap.pending))
+
+# === Pre-filtered search theo thuộc tính ===
+# Mỗi thuộc tính dùng trong filters có một cột int32 (row id -> mã giá trị), tạo lười
+# ở lần filter đầu tiên và cập nhật khi thêm row. Filter -> bitmap row khớp ->
+# IDSelectorBitmap cho FAISS, hoặc brute-force trên embedding store khi rất ít row khớp.
+# Cột được nối dài trước khi publish snapshot nên luôn phủ hết các row của snapshot.
+ATTR_MISSING = -1  # row không có key: vẫn khớp filter (giữ nguyên ngữ nghĩa cũ)
+PREFILTER_BRUTE_FORCE_MAX = int(os.environ.get("PREFILTER_BRUTE_FORCE_MAX", 4096))
+
+attribute_columns = {}
+
+def attribute_value_key(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+
+def attribute_code(column, metadata, key):
+    if key not in metadata:
+        return ATTR_MISSING
+    return column["vocab"].setdefault(attribute_value_key(metadata[key]), len(column["vocab"]))
+
+def attribute_column(key):
+    """Cột mã thuộc tính cho key, tạo từ metadata store ở lần dùng đầu tiên"""
+    column = attribute_columns.get(key)
+    if column is not None:
+        return column
+    with write_lock:
+        column = attribute_columns.get(key)
+        if column is None:
+            snap = snapshot
+            column = {"vocab": {}, "codes": np.full(snap.n_rows, ATTR_MISSING, dtype=np.int32)}
+            row_of_path = {snap.paths[row_id]: row_id for row_id in snap.live_row_ids()}
+            for path, metadata in product_metadata.items():
+                row_id = row_of_path.get(path)
+                if row_id is not None:
+                    column["codes"][row_id] = attribute_code(column, metadata, key)
+            attribute_columns[key] = column
+    return column
+
+def append_attribute_rows(metadatas):
+    """Thêm mã thuộc tính cho các row mới vào mọi cột đã tạo"""
+    for key, column in attribute_columns.items():
+        codes = [attribute_code(column, metadata, key) for metadata in metadatas]
+        column["codes"] = np.concatenate([column["codes"], np.asarray(codes, dtype=np.int32)])
+
+def filter_mask(snap, filters):
+    """Bitmap row còn sống khớp mọi filter"""
+    mask = ~snap.deleted
+    for key, value in filters.items():
+        column = attribute_column(key)
+        code = column["vocab"].get(attribute_value_key(value))
+        codes = column["codes"][:len(mask)]
+        mask = mask[:len(codes)]  # cột tạo sau /reset ngắn hơn snapshot cũ
+        if code is None:
+            mask = mask & (codes == ATTR_MISSING)
+        else:
+            mask = mask & ((codes == code) | (codes == ATTR_MISSING))
+    return mask
+
+def filtered_search(snap, vectors, k, filters):
+    """
+    Search chỉ trên các row khớp filters, luôn trả đủ k kết quả nếu đủ row khớp.
+    Ít row khớp -> tính chính xác trên embedding store; nhiều -> FAISS + IDSelectorBitmap.
+    """
+    mask = filter_mask(snap, filters)
+    row_ids = np.flatnonzero(mask).astype(np.int64)
+    k = min(k, len(row_ids))
+    if k <= 0:
+        return np.zeros((len(vectors), 0), dtype=np.float32), np.zeros((len(vectors), 0), dtype=np.int64)
+
+    if len(row_ids) <= PREFILTER_BRUTE_FORCE_MAX:
+        scores = vectors @ embedding_store.get(row_ids).T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top_scores, order, axis=1), row_ids[np.take_along_axis(top, order, axis=1)]
+
+    bitmap = np.packbits(mask, bitorder='little')
+    selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+    ivf = faiss.try_extract_index_ivf(snap.base)
+    # Filter càng hẹp thì càng cần probe nhiều list / duyệt rộng hơn để vẫn đủ k kết quả
+    selectivity = max(len(row_ids) / max(1, snap.ntotal), 1e-6)
+    if ivf is not None:
+        nprobe = min(ivf.nlist, int(np.ceil(ivf.nprobe / selectivity)))
+        base_params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+    elif index_family(snap.base) == "hnsw":
+        ef_search = max(hnsw_of(snap.base).efSearch, k)
+        base_params = faiss.SearchParametersHNSW(sel=selector, efSearch=int(min(ef_search / selectivity, ef_search * 16)))
+    else:
+        base_params = faiss.SearchParameters(sel=selector)
+    return search_snapshot(snap, vectors, k, base_params, faiss.SearchParameters(sel=selector))
+
+def search_vectors(snap, vectors, k, filters=None):
+    if filters:
+        return filtered_search(snap, vectors, k, filters)
+    return search_index(snap, vectors, k)
+
+# === Hậu xử lý kết quả search ===
+# Dùng chung cho mọi endpoint: lọc tombstone / threshold bằng mask trên cả ma trận (D, I),
+# dedup theo mã product_id (cột thuộc tính 'product_id') bằng np.unique, cắt top_k bằng
+# argpartition; metadata chỉ được đọc cho các row cuối cùng được trả về.
+def live_hits(snap, D, I, threshold=None):
+    """Mask (n, k): kết quả trỏ tới row còn sống (và đạt threshold nếu có)"""
+    hits = (I >= 0) & (I < snap.n_rows)
+    if threshold is not None:
+        hits &= D >= threshold
+    hits[hits] = ~snap.deleted[I[hits]]
+    return hits
+
+def product_keys(row_ids):
+    """Khóa dedup của từng row: mã product_id; row không có product_id là một sản phẩm riêng"""
+    codes = attribute_column('product_id')["codes"]
+    keys = np.full(len(row_ids), ATTR_MISSING, dtype=np.int64)
+    inside = row_ids < len(codes)  # cột tạo sau /reset ngắn hơn snapshot cũ
+    keys[inside] = codes[row_ids[inside]]
+    missing = keys == ATTR_MISSING
+    keys[missing] = -1 - row_ids[missing]
+    return keys
+
+def rank_hits(snap, D, I, top_k, threshold=None, dedup=False, exclude=None):
+    """
+    [(row ids, scores)] top_k của từng query, điểm giảm dần. dedup: mỗi product_id chỉ giữ
+    ảnh điểm cao nhất; exclude: row id không trả về (chính sản phẩm đang query).
+    """
+    hits = live_hits(snap, D, I, threshold)
+    if exclude is not None:
+        hits &= I != exclude
+    keys = np.zeros(I.shape, dtype=np.int64)
+    if dedup:
+        keys[hits] = product_keys(I[hits])
+    ranked = []
+    for hit, scores, row_ids, row_keys in zip(hits, D, I, keys):
+        keep = np.flatnonzero(hit)
+        if dedup and len(keep):
+            order = keep[np.lexsort((-scores[keep], row_keys[keep]))]  # theo khóa, điểm giảm dần
+            _, first = np.unique(row_keys[order], return_index=True)
+            keep = np.sort(order[first])
+        if len(keep) > top_k:
+            keep = np.sort(keep[np.argpartition(-scores[keep], top_k - 1)[:top_k]])
+        keep = keep[np.argsort(-scores[keep], kind='stable')]
+        ranked.append((row_ids[keep], scores[keep]))
+    return ranked
+
+def hit_results(snap, ranked):
+    """[(path, score, metadata)] của từng query; metadata đọc một lần cho mọi row được trả về"""
+    paths = [[snap.paths[i] for i in row_ids] for row_ids, _ in ranked]
+    metadata_of = product_metadata.get_many({path for query_paths in paths for path in query_paths})
+    return [
+        [(path, float(score), metadata_of.get(path, {})) for path, score in zip(query_paths, scores)]
+        for query_paths, (_, scores) in zip(paths, ranked)
+    ]
+
+def result_dicts(hits, ranked=False):
+    """Kết quả dạng /search-by-text; ranked=True thêm original_score + rank như /search"""
+    results = []
+    for path, score, metadata in hits:
+        result = {"path": path, "score": score, "metadata": metadata}
+        if ranked:
+            result.update(original_score=score, rank=len(results) + 1)
+        results.append(result)
+    return results
+
+# === Hàm tiền xử lý ảnh cho CLIP ===
+# Thay cho clip_processor(images=...) từng ảnh: cùng các bước của CLIPImageProcessor (resize
+# bicubic cạnh ngắn, center crop, rescale + normalize) nhưng JPEG được giải mã thẳng ở độ
+# phân giải nhỏ (draft), ảnh lớn khác (render PNG 4K) được thu nhỏ bằng reduce() trước khi
+# resize, và normalize làm một lần cho cả batch vào tensor cấp sẵn.
+PREPROCESS_REDUCING_GAP = 3.0  # Image.resize(reducing_gap): >= 3 gần như không khác resize đầy đủ
+
+def preprocess_image(image_path):
+    """
+    Decode + resize + center crop ảnh sản phẩm 3D cho CLIP (đường dẫn hoặc file-like trong
+    bộ nhớ) -> uint8 (crop, crop, 3), None nếu lỗi. Cần clip_processor đã nạp.
+    """
+    config = clip_processor.image_processor
+    size, crop = config.size["shortest_edge"], config.crop_size["height"]
+    try:
+        with Image.open(image_path) as image:
+            width, height = image.size
+            # Cùng công thức kích thước với CLIPImageProcessor
+            if width <= height:
+                target = (size, int(size * height / width))
+            else:
+                target = (int(size * width / height), size)
+            if image.format == "JPEG":
+                image.draft("RGB", target)  # giải mã ở 1/2, 1/4, 1/8 nếu vẫn >= target
+            image = image.convert("RGB").resize(target, Image.BICUBIC, reducing_gap=PREPROCESS_REDUCING_GAP)
+        top, left = (target[1] - crop) // 2, (target[0] - crop) // 2
+        return np.asarray(image.crop((left, top, left + crop, top + crop)))
+    except Exception as e:
+        source = image_path if isinstance(image_path, str) else "upload"
+        print(f"❌ Lỗi preprocess ảnh {source}: {e}")
+        return None
+
+def pixel_batch(images):
+    """Các ảnh uint8 từ preprocess_image -> pixel_values (n, 3, crop, crop) đã normalize"""
+    config = clip_processor.image_processor
+    mean = torch.tensor(config.image_mean, dtype=torch.float32).view(1, 3, 1, 1)
+    std = torch.tensor(config.image_std, dtype=torch.float32).view(1, 3, 1, 1)
+    crop = config.crop_size["height"]
+    batch = torch.empty((len(images), 3, crop, crop), dtype=torch.float32)
+    pixels = batch.numpy()
+    for i, image in enumerate(images):
+        pixels[i] = image.transpose(2, 0, 1)
+    return batch.mul_(config.rescale_factor).sub_(mean).div_(std)
+
+def load_upload_image(file):
+    """Đọc ảnh upload thẳng từ request stream vào bộ nhớ, không ghi file tạm"""
+    return io.BytesIO(file.read())
+
+# === Embedding cache theo nội dung ảnh ===
+def content_hash(data):
+    """Hash nhanh của bytes ảnh (xxh3-128 nếu có xxhash, ngược lại blake2b-128)"""
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def read_image_bytes(image_source):
+    if isinstance(image_source, io.BytesIO):
+        return image_source.getvalue()
+    with open(image_source, 'rb') as f:
+        return f.read()
+
+class EmbeddingCache:
+    """
+    Cache vector CLIP theo hash nội dung ảnh: LRU trong RAM (có TTL) và tầng
+    SQLite trên đĩa tùy chọn để giữ cache qua các lần restart.
+    Chỉ cache kết quả thành công, ảnh lỗi không bao giờ được cache.
+    """
+
+    def __init__(self, max_size, ttl_seconds=0, disk_path="", disk_size=0):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.disk_size = disk_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk = None
+        self.disk_path = disk_path
+        self.disk_writes = 0
+        if disk_path:
+            self.disk = self._connect_disk()
+            self.disk.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, created REAL)"
+            )
+            self.disk.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_created ON embeddings(created)")
+            self.disk.commit()
+
+    def _connect_disk(self):
+        disk = sqlite3.connect(self.disk_path, check_same_thread=False)
+        disk.execute("PRAGMA journal_mode=WAL")
+        return disk
+
+    def close(self):
+        with self.lock:
+            if self.disk is not None:
+                self.disk.close()
+
+    def reopen(self):
+        with self.lock:
+            if self.disk is not None:
+                self.disk = self._connect_disk()
+
+    def __contains__(self, key):
+        """Key có trong RAM (không tính vào hit/miss)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and not self._expired(entry[1])
+
+    def _expired(self, created):
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not self._expired(entry[1]):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+            if self.disk is not None:
+                row = self.disk.execute("SELECT vector, created FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._expired(row[1]):
+                    vector = np.frombuffer(row[0], dtype=np.float32).copy()
+                    self._put_memory(key, vector, row[1])
+                    self.disk_hits += 1
+                    return vector
+            self.misses += 1
+            return None
+
+    def put(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        created = time.time()
+        with self.lock:
+            self._put_memory(key, vector, created)
+            if self.disk is not None:
+                self.disk.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, created) VALUES (?, ?, ?)",
+                    (key, vector.tobytes(), created),
+                )
+                self.disk.commit()
+                self.disk_writes += 1
+                if self.disk_size and self.disk_writes % 1000 == 0:
+                    self._prune_disk()
+
+    def _put_memory(self, key, vector, created):
+        self.entries[key] = (vector, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _prune_disk(self):
+        total = self.disk.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if total > self.disk_size:
+            self.disk.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY created LIMIT ?)",
+                (total - self.disk_size,),
+            )
+            self.disk.commit()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0,
+            "disk_tier": self.disk is not None,
+        }
+
+embedding_cache = EmbeddingCache(EMBED_CACHE_SIZE, EMBED_CACHE_TTL_SECONDS, EMBED_CACHE_DISK_PATH, EMBED_CACHE_DISK_SIZE)
+
+def embedding_cache_key(data):
+    load_models_if_needed()  # vector INT8 và fp32 không dùng chung cache
+    tag = EMBED_MODEL_TAG + ("-int8" if isinstance(clip_encoder, Int8ImageEncoder) else "")
+    return f"{tag}:{content_hash(data)}"
+
+# === Hàm trích xuất đặc trưng CLIP ===
+def extract_feature_clip(image_path):
+    """Trích xuất đặc trưng CLIP cho ảnh sản phẩm 3D (cache theo nội dung ảnh)"""
+    try:
+        data = read_image_bytes(image_path)
+    except Exception as e:
+        print(f"❌ Lỗi đọc ảnh {image_path}: {e}")
+        return np.zeros(512, dtype=np.float32)
+    
+    key = embedding_cache_key(data)
+    vec = embedding_cache.get(key)
+    if vec is not None:
+        return vec
+    
+    vec = extract_feature_from_image(io.BytesIO(data))
+    if vec is None:
+        return np.zeros(512, dtype=np.float32)
+    embedding_cache.put(key, vec)
+    return vec
+
+def extract_feature_from_image(image_path):
+    """Trích xuất đặc trưng CLIP (không cache) từ đường dẫn hoặc buffer ảnh, None nếu lỗi"""
+    start_time = time.time()
+    try:
+        load_models_if_needed()
+        
+        image = preprocess_image(image_path)
+        if image is None:
+            return None
+        
+        result = embed_pixel_batch(pixel_batch([image]))[0]
+        
+        elapsed = time.time() - start_time
+        print(f"⚡ CLIP feature extraction: {elapsed:.2f}s")
+        return result
+    except Exception as e:
+        print(f"❌ Lỗi trích xuất đặc trưng CLIP: {e}")
+        return None
+
+# === Batch inference pipeline ===
+preprocess_pool = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="clip-preprocess")
+
+def embed_pixel_batch(pixel_values):
+    """Một forward pass CLIP cho cả batch, L2 normalize hàng loạt"""
+    return normalized_features(clip_encoder.image_features(pixel_values))
+
+def iter_feature_batches(paths, batch_size=EMBED_BATCH_SIZE):
+    """
+    Trích xuất đặc trưng CLIP theo batch.
+    Thread pool decode/resize batch kế tiếp trong lúc CLIP chạy batch hiện tại.
+    Yield (paths thành công, vectors (n, 512), paths lỗi) cho từng batch.
+    """
+    return iter_feature_chunks(paths[i:i + batch_size] for i in range(0, len(paths), batch_size))
+
+def iter_feature_chunks(chunks):
+    """Như iter_feature_batches, nhận iterator các batch path (có thể tới dần, xem IngestJob)"""
+    load_models_if_needed()
+    chunks = iter(chunks)
+
+    def submit(chunk):
+        return [preprocess_pool.submit(preprocess_image, path) for path in chunk] if chunk else []
+
+    chunk = next(chunks, None)
+    next_futures = submit(chunk)
+    while chunk is not None:
+        futures = next_futures
+        next_chunk = next(chunks, None)
+        next_futures = submit(next_chunk)
+
+        start_time = time.time()
+        ok_paths, images, failed_paths = [], [], []
+        for path, future in zip(chunk, futures):
+            try:
+                image = future.result()
+            except Exception as e:
+                print(f"❌ Lỗi preprocess ảnh {path}: {e}")
+                image = None
+            if image is None:
+                failed_paths.append(path)
+            else:
+                ok_paths.append(path)
+                images.append(image)
+
+        if images:
+            vectors = embed_pixel_batch(pixel_batch(images))
+        else:
+            vectors = np.zeros((0, FEATURE_DIM), dtype=np.float32)
+        elapsed = time.time() - start_time
+        print(f"⚡ CLIP batch extraction: {len(ok_paths)} ảnh, {elapsed:.2f}s")
+        yield ok_paths, vectors, failed_paths
+        chunk = next_chunk
+
+def embed_query_images(datas):
+    """
+    Vector CLIP cho nhiều ảnh query (bytes): lấy từ embedding cache, ảnh chưa gặp được decode
+    song song và embed theo batch. Trả (vectors (n, 512), mask ảnh embed được).
+    """
+    vectors = np.zeros((len(datas), FEATURE_DIM), dtype=np.float32)
+    ok = np.zeros(len(datas), dtype=bool)
+    keys = [embedding_cache_key(data) for data in datas]
+    missing = []
+    for n, key in enumerate(keys):
+        vec = embedding_cache.get(key)
+        if vec is None:
+            missing.append(n)
+        else:
+            vectors[n], ok[n] = vec, True
+
+    images = list(preprocess_pool.map(preprocess_image, [io.BytesIO(datas[n]) for n in missing]))
+    decoded = [n for n, image in zip(missing, images) if image is not None]
+    images = [image for image in images if image is not None]
+    for i in range(0, len(decoded), EMBED_BATCH_SIZE):
+        vectors[decoded[i:i + EMBED_BATCH_SIZE]] = embed_pixel_batch(pixel_batch(images[i:i + EMBED_BATCH_SIZE]))
+    for n in decoded:
+        ok[n] = True
+        embedding_cache.put(keys[n], vectors[n])
+    return vectors, ok
+
+# === Hàm trích xuất text features ===
+text_embedding_cache = EmbeddingCache(TEXT_CACHE_SIZE)
+text_precomputed = 0  # số query đã tính sẵn lúc khởi động
+
+def normalize_text_query(text):
+    """
+    Chuẩn hóa như tokenizer CLIP (NFC, gộp khoảng trắng, chữ thường): hai query cùng chuẩn
+    hóa thì cùng token nên cùng embedding, dùng chung một entry cache.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).lower().split())
+
+def text_cache_key(query):
+    return f"{EMBED_MODEL_TAG}:text:{query}"
+
+def embed_texts(texts):
+    """Một forward pass text tower cho cả list query -> (n, 512) đã normalize"""
+    load_models_if_needed()
+    inputs = clip_processor(text=texts, return_tensors="pt", padding=True)
+    return normalized_features(clip_encoder.text_features(inputs["input_ids"], inputs["attention_mask"]))
+
+def extract_text_feature(text):
+    """Trích xuất đặc trưng từ text query (cache theo query đã chuẩn hóa)"""
+    query = normalize_text_query(text)
+    key = text_cache_key(query)
+    vec = text_embedding_cache.get(key)
+    if vec is not None:
+        return vec
+    try:
+        vec = embed_texts([query])[0]
+    except Exception as e:
+        print(f"❌ Lỗi trích xuất text features: {e}")
+        return np.zeros(512, dtype=np.float32)
+    text_embedding_cache.put(key, vec)
+    return vec
+
+def extract_text_features(texts):
+    """Đặc trưng của nhiều text query (n, 512): lấy từ cache, phần còn lại embed theo batch"""
+    queries = [normalize_text_query(text) for text in texts]
+    vectors = np.zeros((len(queries), FEATURE_DIM), dtype=np.float32)
+    missing = []
+    for n, query in enumerate(queries):
+        vec = text_embedding_cache.get(text_cache_key(query))
+        if vec is None:
+            missing.append(n)
+        else:
+            vectors[n] = vec
+    for i in range(0, len(missing), EMBED_BATCH_SIZE):
+        rows = missing[i:i + EMBED_BATCH_SIZE]
+        vectors[rows] = embed_texts([queries[n] for n in rows])
+        for n in rows:
+            text_embedding_cache.put(text_cache_key(queries[n]), vectors[n])
+    return vectors
+
+class TextQueryLog:
+    """
+    Số lần tìm của từng query text (đã chuẩn hóa) trong SQLite, dùng để chọn query tính sẵn
+    lúc khởi động. Đếm trong RAM rồi ghi gộp mỗi FLUSH_SECONDS, không ghi đĩa mỗi request.
+    """
+    FLUSH_SECONDS = 30
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = Counter()
+        self.flushed_at = time.time()
+        self.conn = self._connect()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS text_queries (query TEXT PRIMARY KEY, count INTEGER NOT NULL, last_seen REAL)"
+        )
+        self.conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.conn.close()
+
+    def reopen(self):
+        with self.lock:
+            self.conn = self._connect()
+
+    def record(self, query):
+        with self.lock:
+            self.pending[query] += 1
+            if time.time() - self.flushed_at >= self.FLUSH_SECONDS:
+                self._flush()
+
+    def _flush(self):
+        now = time.time()
+        if self.pending:
+            self.conn.executemany(
+                "INSERT INTO text_queries (query, count, last_seen) VALUES (?, ?, ?) "
+                "ON CONFLICT(query) DO UPDATE SET count = count + excluded.count, last_seen = excluded.last_seen",
+                [(query, count, now) for query, count in self.pending.items()],
+            )
+            self.conn.commit()
+            self.pending.clear()
+        self.flushed_at = now
+
+    def top(self, n):
+        with self.lock:
+            self._flush()
+            return [r[0] for r in self.conn.execute("SELECT query FROM text_queries ORDER BY count DESC LIMIT ?", (n,))]
+
+text_query_log = TextQueryLog(TEXT_QUERY_LOG_PATH)
+
+def text_vocabulary():
+    """Giá trị text của các trường TEXT_VOCAB_FIELDS trong catalog (đã chuẩn hóa)"""
+    terms = set()
+    for field in TEXT_VOCAB_FIELDS:
+        for value in product_metadata.distinct_values(field):
+            for term in (value if isinstance(value, list) else [value]):
+                if isinstance(term, str):
+                    terms.add(normalize_text_query(term))
+    terms.discard("")
+    return terms
+
+def precompute_text_embeddings():
+    """Embed sẵn query phổ biến và từ vựng catalog vào text cache, theo batch"""
+    global text_precomputed
+    start_time = time.time()
+    try:
+        queries = list(dict.fromkeys(text_query_log.top(TEXT_PRECOMPUTE_TOP_QUERIES) + sorted(text_vocabulary())))
+        queries = [q for q in queries[:TEXT_CACHE_SIZE] if text_cache_key(q) not in text_embedding_cache]
+        for i in range(0, len(queries), EMBED_BATCH_SIZE):
+            chunk = queries[i:i + EMBED_BATCH_SIZE]
+            for query, vec in zip(chunk, embed_texts(chunk)):
+                text_embedding_cache.put(text_cache_key(query), vec)
+                text_precomputed += 1
+    except Exception as e:
+        print(f"❌ Lỗi tính sẵn text embedding: {e}")
+        return
+    print(f"✅ Text cache: tính sẵn {len(queries)} query ({time.time() - start_time:.2f}s)")
+
+# === Micro-batching scheduler cho /search ===
+class SearchBatcher:
+    """
+    Gom các query /search đồng thời thành một batch: một forward pass CLIP
+    và một index.search cho cả batch, rồi trả kết quả về từng request đang chờ.
+    Chỉ một thread chạy CLIP nên các request không tranh nhau torch threads.
+    """
+
+    def __init__(self, max_batch_size, max_wait_ms):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.batches = 0
+        self.queries = 0
+
+    def search(self, image, k, filters=None):
+        """
+        Block tới khi batch chứa query này chạy xong; trả về (snapshot, vector, D, I) của query.
+        k = 0 (không filters): chỉ embed, D và I là None.
+        """
+        self._ensure_started()
+        item = {"image": image, "k": k, "filters": filters, "done": threading.Event()}
+        self.queue.put(item)
+        item["done"].wait()
+        if "error" in item:
+            raise item["error"]
+        return item["result"]
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="search-batcher", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch):
+        try:
+            vectors = embed_pixel_batch(pixel_batch([item["image"] for item in batch]))
+            snap = snapshot  # cả batch search trên cùng một snapshot
+            plain = [n for n, item in enumerate(batch) if not item["filters"] and item["k"] > 0]
+            if plain:
+                D, I = search_index(snap, vectors[plain], max(batch[n]["k"] for n in plain))
+                for row, n in enumerate(plain):
+                    batch[n]["result"] = (snap, vectors[n:n + 1], D[row:row + 1], I[row:row + 1])
+            for n, item in enumerate(batch):
+                if item["filters"]:
+                    D, I = filtered_search(snap, vectors[n:n + 1], item["k"], item["filters"])
+                    item["result"] = (snap, vectors[n:n + 1], D, I)
+                elif item["k"] == 0:
+                    item["result"] = (snap, vectors[n:n + 1], None, None)  # chỉ cần vector (search theo sản phẩm)
+            self.batches += 1
+            self.queries += len(batch)
+        except Exception as e:
+            for item in batch:
+                item["error"] = e
+        finally:
+            for item in batch:
+                item["done"].set()
+
+search_batcher = SearchBatcher(SEARCH_BATCH_MAX_SIZE, SEARCH_BATCH_MAX_WAIT_MS)
+
+# === Bulk import: hàng đợi job cho /add-batch ===
+# Mỗi process một thread ingest chạy lần lượt từng job nên các batch không tranh nhau; hàng
+# đợi có giới hạn, đầy thì /add-batch trả 429. File vào pipeline ngay khi được ghi xong, mỗi
+# batch được thêm vào index ngay sau khi embed. Giữa các batch, ingest nhường CLIP cho query
+# /search đang chờ và giữ tốc độ dưới INGEST_MAX_IMAGES_PER_SECOND. Trạng thái job được ghi
+# ra DATA_DIR/jobs để worker nào cũng trả lời được /jobs/<id>.
+INGEST_QUEUE_MAX_JOBS = int(os.environ.get("INGEST_QUEUE_MAX_JOBS", 4))
+INGEST_MAX_IMAGES_PER_SECOND = float(os.environ.get("INGEST_MAX_IMAGES_PER_SECOND", 0))  # 0 = không giới hạn
+INGEST_SEARCH_YIELD_SECONDS = 0.05  # chờ tối đa mỗi lần nhường /search
+JOBS_DIR = os.path.join(DATA_DIR, "jobs")
+JOB_RETENTION_SECONDS = 24 * 3600
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+class IngestJob:
+    """
+    Một lần /add-batch (hoặc /reload): nhận path ảnh đã lưu qua inbox, theo dõi tiến độ và lỗi
+    từng file. before_embed(paths) (chạy trong thread import) trả về các path cần embed, số
+    còn lại tính là skipped; on_added(paths, row_ids) được gọi sau mỗi batch đã thêm vào index,
+    on_failed(paths) với các file không đọc được.
+    """
+
+    def __init__(self, total, metadata_mapping, on_added=None, before_embed=None, on_failed=None):
+        self.id = uuid.uuid4().hex
+        self.metadata_mapping = metadata_mapping
+        self.on_added = on_added
+        self.before_embed = before_embed
+        self.on_failed = on_failed
+        self.inbox = queue.Queue()  # path ảnh đã lưu, None = hết input
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.status = "queued"
+        self.total = total
+        self.processed = 0
+        self.added = 0
+        self.skipped = 0
+        self.failures = []
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.saved_at = 0
+
+    def feed(self, path):
+        self.inbox.put(path)
+
+    def fail_file(self, filename, error):
+        with self.lock:
+            self.processed += 1
+            self.failures.append({"file": filename, "error": error})
+
+    def close_input(self):
+        self.inbox.put(None)
+
+    def chunks(self, size):
+        """Batch path khi tới dần: chờ path đầu tiên, lấy thêm các path đã có sẵn (tối đa size)"""
+        while True:
+            path = self.inbox.get()
+            if path is None:
+                return
+            chunk = [path]
+            while len(chunk) < size:
+                try:
+                    path = self.inbox.get_nowait()
+                except queue.Empty:
+                    break
+                if path is None:
+                    self.inbox.put(None)
+                    break
+                chunk.append(path)
+            if self.before_embed is not None:
+                kept = self.before_embed(chunk)
+                if len(kept) < len(chunk):
+                    with self.lock:
+                        self.processed += len(chunk) - len(kept)
+                        self.skipped += len(chunk) - len(kept)
+                chunk = kept
+            if chunk:
+                yield chunk
+
+    def progress(self, added, failed_paths):
+        with self.lock:
+            self.processed += added + len(failed_paths)
+            self.added += added
+            self.failures.extend({"file": os.path.basename(path), "error": "Không đọc được ảnh"} for path in failed_paths)
+        self.save()
+
+    def set_status(self, status, error=None):
+        with self.lock:
+            self.status = status
+            self.error = error
+            if status == "running":
+                self.started_at = time.time()
+            elif status in ("done", "failed"):
+                self.finished_at = time.time()
+        self.save(force=True)
+
+    def to_dict(self):
+        with self.lock:
+            elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "total": self.total,
+                "processed": self.processed,
+                "added": self.added,
+                "skipped": self.skipped,
+                "failed": len(self.failures),
+                "failures": list(self.failures),
+                "progress": round(self.processed / self.total, 4) if self.total else 0,
+                "images_per_second": round(self.processed / elapsed, 2) if elapsed > 0 else 0,
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+    def save(self, force=False):
+        """Ghi trạng thái ra JOBS_DIR (tối đa mỗi giây một lần trừ khi force)"""
+        if not force and time.time() - self.saved_at < 1:
+            return
+        with self.save_lock:
+            self.saved_at = time.time()
+            state = self.to_dict()
+
+            def write(tmp_path):
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(state, f)
+
+            atomic_write(os.path.join(JOBS_DIR, f"{self.id}.json"), write)
+
+class IngestQueue:
+    """Hàng đợi job có giới hạn + một thread ingest (tạo lười, nên cũng chạy được sau fork)"""
+
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.pending = queue.Queue()
+        self.jobs = OrderedDict()  # job của process này, mới nhất ở cuối
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, job):
+        """Nhận job vào hàng đợi; False nếu đã đủ max_jobs job chưa xong"""
+        with self.lock:
+            if sum(j.status in ("queued", "running") for j in self.jobs.values()) >= self.max_jobs:
+                return False
+            self.jobs[job.id] = job
+            while len(self.jobs) > 100 and next(iter(self.jobs.values())).status in ("done", "failed"):
+                self.jobs.popitem(last=False)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="ingest", daemon=True)
+                self.thread.start()
+        prune_job_files()
+        job.save(force=True)
+        self.pending.put(job)
+        return True
+
+    def get(self, job_id):
+        """Trạng thái job: của process này, hoặc file do worker khác ghi; None nếu không có"""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        try:
+            with open(os.path.join(JOBS_DIR, f"{os.path.basename(job_id)}.json"), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _run(self):
+        while True:
+            run_ingest_job(self.pending.get())
+
+ingest_queue = IngestQueue(INGEST_QUEUE_MAX_JOBS)
+
+def prune_job_files():
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    for name in os.listdir(JOBS_DIR):
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def throttle_ingest(job):
+    """Giữa hai batch: nhường query /search đang chờ, rồi giữ tốc độ <= INGEST_MAX_IMAGES_PER_SECOND"""
+    deadline = time.monotonic() + INGEST_SEARCH_YIELD_SECONDS
+    while not search_batcher.queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    if INGEST_MAX_IMAGES_PER_SECOND > 0:
+        delay = job.started_at + job.processed / INGEST_MAX_IMAGES_PER_SECOND - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+def run_ingest_job(job):
+    """Embed các ảnh của job theo batch khi chúng tới, thêm từng batch vào index ngay"""
+    job.set_status("running")
+    try:
+        for batch_paths, batch_vectors, failed_paths in iter_feature_chunks(job.chunks(EMBED_BATCH_SIZE)):
+            metadatas = []
+            for save_path in batch_paths:
+                metadata = dict(job.metadata_mapping.get(os.path.basename(save_path), {}))
+                metadata['image_path'] = save_path
+                metadatas.append(metadata)
+            if batch_paths:
+                row_ids = add_rows(batch_vectors, batch_paths, metadatas)
+                if job.on_added is not None:
+                    job.on_added(batch_paths, row_ids)
+                request_maintenance()
+            if failed_paths and job.on_failed is not None:
+                job.on_failed(failed_paths)
+            job.progress(len(batch_paths), failed_paths)
+            throttle_ingest(job)
+    except Exception as e:
+        print(f"❌ Lỗi import job {job.id}: {e}")
+        job.set_status("failed", error=str(e))
+        return
+    job.set_status("done")
+    stats = job.to_dict()
+    print(f"✅ Import job {job.id}: thêm {stats['added']}/{stats['total']} ảnh, {stats['images_per_second']} ảnh/s")
+
+# === Đồng bộ thư mục ảnh (/reload) ===
+# Manifest lưu (cỡ, mtime, hash nội dung, row) của từng file ở lần đồng bộ trước. /reload chỉ
+# stat các file: file mới hoặc đổi cỡ/mtime được giao cho job import, file đã mất thì tombstone.
+# Job hash nội dung trước khi embed: file chỉ đổi mtime (hash như cũ) thì bỏ qua. Row được thêm
+# qua API sau lần đồng bộ trước (row khác row trong manifest) được nhận luôn, không embed lại.
+# File import lỗi được ghi với row = FAILED_ROW và bỏ qua cho tới khi đổi cỡ/mtime.
+# Xóa hàng loạt (thư mục ảnh trống/không mount, hoặc quá RELOAD_MAX_DELETE_FRACTION số ảnh)
+# bị từ chối trừ khi gửi {"allow_mass_delete": true}.
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+FAILED_ROW = -1
+RELOAD_MAX_DELETE_FRACTION = float(os.environ.get("RELOAD_MAX_DELETE_FRACTION", 0.2))
+RELOAD_MIN_GUARDED_DELETES = 20  # dưới mức này không tính tỷ lệ (catalog nhỏ)
+
+class SyncManifest:
+    """Trạng thái file trong STORAGE_DIR ở lần /reload trước, trong SQLite"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = self._connect()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash TEXT, row INTEGER NOT NULL)"
+        )
+        self.conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def reopen(self):
+        with self.lock:
+            self.conn = self._connect()
+
+    def entries(self):
+        """{path: (size, mtime_ns, hash, row)}"""
+        with self.lock:
+            return {row[0]: row[1:] for row in self.conn.execute("SELECT path, size, mtime_ns, hash, row FROM files")}
+
+    def record(self, items):
+        """Ghi (path, size, mtime_ns, hash, row) trong một transaction"""
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO files (path, size, mtime_ns, hash, row) VALUES (?, ?, ?, ?, ?)", items)
+            self.conn.commit()
+
+    def remove(self, paths):
+        with self.lock:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in paths])
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM files")
+            self.conn.commit()
+
+sync_manifest = SyncManifest(SYNC_MANIFEST_PATH)
+
+def storage_images(root=STORAGE_DIR):
+    """Path các file ảnh trong thư mục (cả thư mục con), sắp xếp theo path"""
+    paths = []
+    for directory, _, files in os.walk(root):
+        paths.extend(os.path.join(directory, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+def diff_storage():
+    """
+    So STORAGE_DIR với manifest và index, chỉ bằng stat (không đọc nội dung file). Trả về dict:
+    added / modified {path: (size, mtime_ns, hash cũ, row)} giao cho job import, removed [path]
+    cần tombstone, stale [path] bỏ khỏi manifest, adopted [(path, size, mtime_ns, hash, row)]
+    chỉ cần ghi manifest, unchanged / failed (số file; failed = lần trước import lỗi, chưa đổi),
+    stored (số row còn sống thuộc thư mục).
+    """
+    snap = snapshot
+    entries = sync_manifest.entries()
+    live = {snap.paths[row_id]: int(row_id) for row_id in snap.live_row_ids()}
+    diff = {"added": {}, "modified": {}, "removed": [], "stale": [], "adopted": [], "unchanged": 0, "failed": 0}
+    on_disk = set()
+    filenames = set()
+    for path in storage_images():
+        on_disk.add(path)
+        name = os.path.basename(path)
+        if name in filenames:
+            continue  # index tra ảnh theo tên file: chỉ lấy ảnh đầu tiên
+        filenames.add(name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        row_id, entry = live.get(path), entries.get(path)
+        if row_id is None:
+            if entry is not None and entry[3] == FAILED_ROW and entry[:2] == (st.st_size, st.st_mtime_ns):
+                diff["failed"] += 1
+            else:
+                diff["added"][path] = (st.st_size, st.st_mtime_ns, None, None)
+        elif entry is None or entry[3] != row_id:
+            diff["adopted"].append((path, st.st_size, st.st_mtime_ns, None, row_id))
+        elif entry[:2] == (st.st_size, st.st_mtime_ns):
+            diff["unchanged"] += 1
+        else:
+            diff["modified"][path] = (st.st_size, st.st_mtime_ns, entry[2], row_id)
+    prefix = os.path.join(STORAGE_DIR, "")
+    # /add nhận mọi tên file: row có path ngoài IMAGE_EXTENSIONS chỉ bị xóa khi file thật sự mất
+    stored = [path for path in live if path.startswith(prefix)]
+    diff["removed"] = [path for path in stored if path not in on_disk and not os.path.exists(path)]
+    diff["stale"] = [path for path in entries if path not in on_disk]
+    diff["stored"] = len(stored)
+    return diff
+
+def mass_delete_reason(diff):
+    """Lý do từ chối /reload vì xóa quá nhiều ảnh, None nếu được phép"""
+    removed = len(diff["removed"])
+    if removed and not (os.path.isdir(STORAGE_DIR) and os.listdir(STORAGE_DIR)):
+        return f"Thư mục ảnh {STORAGE_DIR} trống hoặc không tồn tại, /reload sẽ xóa {removed} ảnh"
+    if removed > max(RELOAD_MIN_GUARDED_DELETES, diff["stored"] * RELOAD_MAX_DELETE_FRACTION):
+        return f"/reload sẽ xóa {removed}/{diff['stored']} ảnh (quá {RELOAD_MAX_DELETE_FRACTION:.0%})"
+    return None
+
+def sync_job_hooks(stats):
+    """
+    (before_embed, on_added, on_failed) cho job /reload. before_embed hash nội dung trong thread
+    import: file đổi mtime nhưng hash như manifest chỉ được ghi lại manifest, không embed.
+    on_added ghi manifest (kèm hash) cho các file đã embed xong. on_failed ghi cỡ/mtime hiện tại
+    của file lỗi để lần sau bỏ qua: file mới với row = FAILED_ROW, file đổi nội dung giữ hash và
+    row cũ (index vẫn giữ vector cũ).
+    """
+    digests = {}
+
+    def before_embed(paths):
+        kept, touched = [], []
+        for path in paths:
+            size, mtime_ns, old_digest, row_id = stats[path]
+            try:
+                digest = content_hash(read_image_bytes(path))
+            except OSError:
+                kept.append(path)  # bước embed báo lỗi file
+                continue
+            if row_id is not None and digest == old_digest:
+                touched.append((path, size, mtime_ns, digest, row_id))
+            else:
+                digests[path] = digest
+                kept.append(path)
+        if touched:
+            sync_manifest.record(touched)
+        return kept
+
+    def on_added(paths, row_ids):
+        sync_manifest.record([
+            (path, *stats[path][:2], digests.get(path), int(row_id)) for path, row_id in zip(paths, row_ids)
+        ])
+
+    def on_failed(paths):
+        items = []
+        for path in paths:
+            size, mtime_ns, old_digest, row_id = stats[path]
+            if row_id is None:
+                items.append((path, size, mtime_ns, digests.get(path), FAILED_ROW))
+            else:
+                items.append((path, size, mtime_ns, old_digest, row_id))
+        sync_manifest.record(items)
+
+    return before_embed, on_added, on_failed
+
+# === Dựng lại base index (background) ===
+def rebuild_base(build, keep_pending=False):
+    """
+    Dựng base mới bên cạnh (không giữ write_lock) từ snapshot lúc bắt đầu, rồi publish
+    kèm các row thêm/xóa trong lúc dựng: row mới vào delta, row mới xóa vào pending.
+    build(snap) phải trả về index chứa đúng các row còn sống của snap, hoặc (keep_pending)
+    vẫn chứa các row trong snap.pending (giữ tombstone, search tiếp tục lọc bỏ).
+    """
+    with rebuild_lock:
+        start = snapshot
+        new_base = build(start)
+        with write_lock:
+            current = snapshot
+            if current.paths is not start.paths:
+                return False  # /reset trong lúc dựng
+            new_rows = np.arange(start.n_rows, current.n_rows, dtype=np.int64)
+            new_rows = new_rows[~current.deleted[start.n_rows:]]
+            delta = new_flat_index()
+            delta.add_with_ids(embedding_store.get(new_rows), new_rows)
+            pending = np.flatnonzero(current.deleted[:start.n_rows] & ~start.deleted)
+            if keep_pending:
+                pending = np.union1d(pending, np.asarray(start.pending, dtype=np.int64))
+            publish(current.evolve(
+                base=new_base,
+                delta=delta,
+                pending=[int(i) for i in pending],
+                delta_start=start.n_rows,
+            ))
+        return True
+
+def merged_base(snap, drop_pending=True):
+    """
+    Base + delta - pending trên bản clone, snapshot đang phục vụ không bị đụng tới.
+    drop_pending=False: chỉ gộp delta, tombstone vẫn nằm trong base (xem compact_index).
+    """
+    if drop_pending and snap.pending and index_family(snap.base) == "hnsw":
+        # HNSW không hỗ trợ remove_ids: dựng lại với cùng tham số
+        return build_base("hnsw", snap.live_row_ids(), ef_search=hnsw_of(snap.base).efSearch, codec=index_codec(snap.base))
+    new_base = clone_writable(snap.base)
+    if drop_pending and snap.pending:
+        new_base.remove_ids(id_selector(new_base, snap.pending))
+    row_ids = index_ids(snap.delta)
+    if len(row_ids):
+        new_base.add_with_ids(embedding_store.get(row_ids), row_ids)
+    return new_base
+
+# === Chọn loại index và tự tune tham số search ===
+# Base được dựng lại ở background khi catalog đổi cỡ: Flat (chính xác) khi nhỏ, HNSW rồi IVF
+# khi lớn dần. nprobe/efSearch được chọn nhỏ nhất đạt INDEX_RECALL_TARGET, đo recall@10 trên
+# một mẫu query giữ riêng (không dùng để train) so với kết quả chính xác từ embedding store.
+# INDEX_CODEC nén vector trong HNSW/IVF (SQ8 4x, fp16 2x, PQ/OPQ 2048/INDEX_PQ_M lần);
+# điểm được chấm lại chính xác từ embedding store (xem search_candidates). Kiểu nén không đạt
+# INDEX_RECALL_TARGET thì bị loại và dựng lại với kiểu nén nhẹ hơn (CODEC_FALLBACK).
+INDEX_FAMILY = os.environ.get("INDEX_FAMILY", "auto")  # auto | hnsw | ivf (dùng khi vượt INDEX_FLAT_MAX)
+INDEX_FLAT_MAX = int(os.environ.get("INDEX_FLAT_MAX", 10000))
+INDEX_HNSW_MAX = int(os.environ.get("INDEX_HNSW_MAX", 1000000))
+INDEX_RETRAIN_GROWTH = float(os.environ.get("INDEX_RETRAIN_GROWTH", 2.0))
+INDEX_RECALL_TARGET = float(os.environ.get("INDEX_RECALL_TARGET", 0.95))
+INDEX_TUNE_QUERIES = int(os.environ.get("INDEX_TUNE_QUERIES", 200))
+INDEX_CODEC = os.environ.get("INDEX_CODEC", "none")  # none | sq8 | fp16 | pq | opq
+INDEX_PQ_M = int(os.environ.get("INDEX_PQ_M", 128))  # số byte mã PQ mỗi vector, phải chia hết FEATURE_DIM
+CODEC_FALLBACK = {"opq": "sq8", "pq": "sq8", "sq8": "fp16", "fp16": "none"}
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+TUNE_K = 10
+ADD_CHUNK_ROWS = 65536  # nạp vector từ store theo từng khúc, không copy cả store ra RAM
+
+def index_family(idx):
+    if faiss.try_extract_index_ivf(idx) is not None:
+        return "ivf"
+    if isinstance(core_index(idx), faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+def hnsw_of(idx):
+    return core_index(idx).hnsw
+
+def choose_index_family(n):
+    if n < INDEX_FLAT_MAX:
+        return "flat"
+    if INDEX_FAMILY != "auto":
+        return INDEX_FAMILY
+    return "hnsw" if n < INDEX_HNSW_MAX else "ivf"
+
+def ivf_nlist(n):
+    """~4·sqrt(n) list, mỗi list có ít nhất 39 điểm train (khuyến nghị của FAISS)"""
+    return int(max(1, min(4 * np.sqrt(n), n // 39)))
+
+def index_factory_string(family, n, codec=None):
+    """Chuỗi faiss.index_factory cho family + kiểu nén (mặc định INDEX_CODEC; Flat không nén)"""
+    codec = INDEX_CODEC if codec is None else codec
+    opq = f"OPQ{INDEX_PQ_M}," if codec == "opq" else ""
+    codec = {"none": "Flat", "sq8": "SQ8", "fp16": "SQfp16"}.get(codec, f"PQ{INDEX_PQ_M}")
+    if family == "ivf":
+        return f"{opq}IVF{ivf_nlist(n)},{codec}"
+    return f"IDMap2,{opq}HNSW{HNSW_M}" + ("" if codec == "Flat" else f"_{codec}")
+
+def build_base(family, row_ids, held_out=(), ef_search=None, codec=None):
+    """Dựng index loại `family` chứa row_ids; train (IVF, SQ, PQ) trên các row không nằm trong held_out"""
+    if family == "flat":
+        new_index = new_flat_index()
+    else:
+        new_index = faiss.index_factory(FEATURE_DIM, index_factory_string(family, len(row_ids), codec), faiss.METRIC_INNER_PRODUCT)
+        if family == "ivf":
+            ivf = faiss.extract_index_ivf(new_index)
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+            max_train = 256 * ivf.nlist
+        else:
+            hnsw = hnsw_of(new_index)
+            hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            if ef_search is not None:
+                hnsw.efSearch = ef_search
+            max_train = ADD_CHUNK_ROWS
+        if not new_index.is_trained:
+            train_ids = np.setdiff1d(row_ids, held_out)
+            if len(train_ids) > max_train:
+                train_ids = np.sort(np.random.default_rng(0).choice(train_ids, max_train, replace=False))
+            new_index.train(embedding_store.get(train_ids))
+    for start in range(0, len(row_ids), ADD_CHUNK_ROWS):
+        chunk = row_ids[start:start + ADD_CHUNK_ROWS]
+        new_index.add_with_ids(embedding_store.get(chunk), chunk)
+    return new_index
+
+def exact_neighbors(queries, query_ids, row_ids, k):
+    """Top-k chính xác (bỏ chính query) trên embedding store, duyệt theo từng khúc"""
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(row_ids), ADD_CHUNK_ROWS):
+        chunk = row_ids[start:start + ADD_CHUNK_ROWS]
+        scores = queries @ embedding_store.get(chunk).T
+        scores[chunk[None, :] == query_ids[:, None]] = -np.inf
+        best_scores = np.hstack([best_scores, scores])
+        best_ids = np.hstack([best_ids, np.broadcast_to(chunk, scores.shape)])
+        if best_scores.shape[1] > k:
+            top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(best_scores, top, axis=1)
+            best_ids = np.take_along_axis(best_ids, top, axis=1)
+    return best_ids
+
+def measure_recall(idx, queries, query_ids, truth, k, rerank=True):
+    if rerank:
+        _, I = search_candidates(idx, queries, k + 1)
+    else:
+        _, I = idx.search(queries, k + 1)
+    hits = 0
+    for labels, query_id, expected in zip(I, query_ids, truth):
+        found = [label for label in labels if label != query_id][:k]
+        hits += len(set(found) & set(expected.tolist()))
+    return hits / max(1, truth.size)
+
+def tune_search_params(idx, family, query_ids, row_ids):
+    """Chọn nprobe/efSearch nhỏ nhất đạt INDEX_RECALL_TARGET trên mẫu query giữ riêng"""
+    if family == "flat" or len(query_ids) == 0:
+        return {"param": None, "value": None, "recall": 1.0, "recall_loss": 0.0}
+    k = min(TUNE_K, len(row_ids) - 1)
+    queries = embedding_store.get(query_ids)
+    truth = exact_neighbors(queries, query_ids, row_ids, k)
+    if family == "ivf":
+        ivf = faiss.extract_index_ivf(idx)
+        param = "nprobe"
+        candidates = [v for v in (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024) if v < ivf.nlist] + [ivf.nlist]
+
+        def apply(value):
+            ivf.nprobe = value
+    else:
+        hnsw = hnsw_of(idx)
+        param = "efSearch"
+        candidates = [16, 32, 64, 128, 256, 512, 1024]
+
+        def apply(value):
+            hnsw.efSearch = value
+    for value in candidates:
+        apply(value)
+        recall = measure_recall(idx, queries, query_ids, truth, k)
+        if recall >= INDEX_RECALL_TARGET:
+            break
+    result = {"param": param, "value": value, "recall": round(recall, 4), "recall_loss": round(1 - recall, 4)}
+    if index_codec(idx) != "none":
+        result["recall_without_rerank"] = round(measure_recall(idx, queries, query_ids, truth, k, rerank=False), 4)
+    return result
+
+def tuned_base_builder(family, tuning):
+    """
+    build() cho rebuild_base: dựng index `family` rồi tune; kết quả tune ghi vào `tuning`.
+    Kiểu nén không đạt INDEX_RECALL_TARGET (kể cả ở nprobe/efSearch lớn nhất) bị loại, ghi
+    vào tuning["rejected_codecs"], và index được dựng lại với kiểu nén kế tiếp trong CODEC_FALLBACK.
+    """
+    def build(snap):
+        row_ids = snap.live_row_ids()
+        sample_size = min(INDEX_TUNE_QUERIES, max(0, len(row_ids) - 1))
+        query_ids = np.sort(np.random.default_rng().choice(row_ids, sample_size, replace=False))
+        start_time = time.time()
+        codec = INDEX_CODEC if family != "flat" else "none"
+        rejected = []
+        while True:
+            new_index = build_base(family, row_ids, held_out=query_ids, codec=codec)
+            result = tune_search_params(new_index, family, query_ids, row_ids)
+            if result["recall"] >= INDEX_RECALL_TARGET or codec not in CODEC_FALLBACK:
+                break
+            rejected.append({"codec": codec, "recall": result["recall"], result["param"]: result["value"]})
+            print(f"⚠️ Loại kiểu nén {codec}: recall {result['recall']} < {INDEX_RECALL_TARGET} "
+                  f"({result['param']}={result['value']}), thử {CODEC_FALLBACK[codec]}")
+            codec = CODEC_FALLBACK[codec]
+        tuning.update(result)
+        tuning.update({
+            "requested_codec": INDEX_CODEC,
+            "rejected_codecs": rejected,
+            "family": family,
+            "type": index_type_name(new_index),
+            "codec": index_codec(new_index),
+            "bytes_per_vector": index_bytes_per_vector(new_index),
+            "rows": len(row_ids),
+            "build_seconds": round(time.time() - start_time, 2),
+        })
+        if family == "ivf":
+            tuning["nlist"] = faiss.extract_index_ivf(new_index).nlist
+        return new_index
+    return build
+
+def optimize_index_if_needed():
+    """
+    Dựng lại base khi cỡ catalog đòi loại index khác (Flat -> HNSW/IVF, hoặc về Flat khi
+    nhỏ hẳn lại), khi đã tăng/giảm INDEX_RETRAIN_GROWTH lần kể từ lần train trước hoặc
+    khi INDEX_CODEC khác kiểu nén của base hiện tại.
+    """
+    global index_tuning
+    snap = snapshot
+    n = snap.live_count()
+    family = choose_index_family(n)
+    current = index_family(snap.base)
+    trained_rows = index_tuning.get("rows") or snap.base.ntotal
+    # Kiểu nén đã bị loại vì recall thấp thì không dựng lại chỉ vì base khác INDEX_CODEC
+    requested_codec = index_tuning.get("requested_codec", index_codec(snap.base))
+    if current == "flat":
+        needed = family != "flat"
+    elif family == "flat":
+        needed = n < INDEX_FLAT_MAX // 2
+    else:
+        needed = (n >= trained_rows * INDEX_RETRAIN_GROWTH or n * INDEX_RETRAIN_GROWTH <= trained_rows
+                  or requested_codec != INDEX_CODEC)
+    if not needed:
+        return
+    print(f"🔄 Dựng lại index ({current} -> {family}, {n} vectors)...")
+    try:
+        tuning = {}
+        if rebuild_base(tuned_base_builder(family, tuning)):
+            index_tuning = tuning
+            print(f"✅ Đã tối ưu index: {tuning}")
+            save_index()
+    except Exception as e:
+        print(f"❌ Lỗi tối ưu index: {e}")
+
+def compaction_tombstone_threshold(snap):
+    return max(COMPACT_MIN_TOMBSTONES, snap.ntotal // 10)
+
+def compact_index():
+    """
+    Compaction: gộp delta vào base và bỏ các row đã tombstone khỏi base. Base HNSW chỉ bỏ
+    tombstone (dựng lại cả graph) khi vượt ngưỡng, còn lại chỉ gộp delta: tombstone vẫn
+    bị lọc lúc search.
+    """
+    snap = snapshot
+    drop_pending = (bool(snap.pending) and (index_family(snap.base) != "hnsw"
+                                            or len(snap.pending) >= compaction_tombstone_threshold(snap)))
+    if not drop_pending and snap.delta.ntotal == 0:
+        return 0
+    removed = len(snap.pending) if drop_pending else 0
+    if drop_pending:
+        done = rebuild_base(merged_base)
+    else:
+        done = rebuild_base(lambda snap: merged_base(snap, drop_pending=False), keep_pending=True)
+    if done:
+        save_index()
+        print(f"🧹 Compaction: đã xóa {removed} vectors, gộp {snap.delta.ntotal} vectors từ delta")
+    return removed
+
+def compact_index_if_needed():
+    snap = snapshot
+    if (len(snap.pending) >= compaction_tombstone_threshold(snap)
+            or snap.delta.ntotal >= DELTA_MAX_VECTORS):
+        compact_index()
+
+maintenance_event = threading.Event()
+maintenance_lock = threading.Lock()
+maintenance_thread = None
+
+def request_maintenance():
+    """Báo thread nền kiểm tra optimize/compaction (request không phải chờ dựng index)"""
+    start_maintenance_thread()
+    maintenance_event.set()
+
+def start_maintenance_thread():
+    global maintenance_thread
+    with maintenance_lock:
+        if maintenance_thread is None:
+            maintenance_thread = threading.Thread(target=maintenance_loop, name="index-maintenance", daemon=True)
+            maintenance_thread.start()
+
+def maintenance_loop():
+    """
+    Optimize, compaction và checkpoint chạy nền: khi được báo, và định kỳ. Nhiều worker
+    process: chỉ worker giữ maintenance_leader_lock làm việc này, các worker còn lại chỉ
+    đồng bộ từ đĩa (kể cả nạp base mới mà leader vừa dựng).
+    """
+    last_compaction = time.time()
+    leader = False
+    while True:
+        maintenance_event.wait(SYNC_INTERVAL_SECONDS)
+        maintenance_event.clear()
+        try:
+            leader = leader or maintenance_leader_lock.acquire(blocking=False)
+            sync_with_disk(reload_base=not leader)
+            refresh_product_index()  # index centroid nằm trong RAM từng worker
+            if not leader:
+                load_neighbor_table()
+                continue
+            optimize_index_if_needed()
+            if time.time() - last_compaction >= COMPACT_INTERVAL_SECONDS:
+                compact_index()
+                last_compaction = time.time()
+            else:
+                compact_index_if_needed()
+            checkpoint_if_needed()
+            update_neighbor_table()
+        except Exception as e:
+            print(f"❌ Lỗi bảo trì index: {e}")
+
+save_lock = threading.Lock()
+last_checkpoint_time = time.time()
+
+def save_index():
+    """
+    Checkpoint: ghi snapshot (base chỉ khi đổi, delta, paths, tombstone), mỗi file qua file
+    tạm + os.replace; ghi lsn vào CHECKPOINT_PATH sau cùng rồi bỏ phần log đã checkpoint.
+    Crash giữa chừng: file cũ + replay log từ lsn cũ vẫn ra đúng trạng thái.
+    """
+    global saved_base_version, last_checkpoint_time, loaded_base_id, synced_checkpoint, disk_base_id
+    with save_lock:
+        with write_lock:
+            snap = snapshot
+            lsn = mutation_log.lsn
+        # checkpoint_lock: worker khác không nạp lại giữa lúc các file đang được thay
+        with checkpoint_lock.hold():
+            current = read_checkpoint()
+            if current.get("generation") != checkpoint_generation or current.get("lsn", 0) > lsn:
+                return  # worker khác đã checkpoint trạng thái mới hơn (hoặc /reset)
+            # Ghi base trước delta: crash ở giữa chỉ để lại row trùng, được bỏ khỏi delta khi load
+            if snap.base_version != saved_base_version or current.get("base_id") != loaded_base_id:
+                atomic_write(INDEX_PATH, lambda tmp_path: faiss.write_index(snap.base, tmp_path))
+                saved_base_version = snap.base_version
+                loaded_base_id = uuid.uuid4().hex
+            atomic_write(DELTA_INDEX_PATH, lambda tmp_path: faiss.write_index(snap.delta, tmp_path))
+            atomic_write(PATH_TABLE_PATH, lambda tmp_path: snap.paths.write(tmp_path, snap.n_rows))
+            atomic_write(DELETED_PATH, lambda tmp_path: np.save(tmp_path, snap.deleted))
+            write_checkpoint({
+                "lsn": lsn,
+                "rows": snap.n_rows,
+                "time": time.time(),
+                "tuning": index_tuning,
+                "base_id": loaded_base_id,
+                "generation": checkpoint_generation,
+            })
+            synced_checkpoint = disk_signature(CHECKPOINT_PATH)
+            disk_base_id = loaded_base_id
+            if os.path.exists(PATHS_PATH):
+                os.remove(PATHS_PATH)  # đã có string table thay thế
+        with write_lock:
+            mutation_log.truncate_through(lsn)
+        last_checkpoint_time = time.time()
+    print(f"💾 Checkpoint lsn={lsn}: {snap.live_count()} sản phẩm")
+
+def checkpoint_if_needed():
+    log_size = mutation_log.size()
+    if log_size >= CHECKPOINT_LOG_BYTES or (
+        log_size > 0 and time.time() - last_checkpoint_time >= CHECKPOINT_INTERVAL_SECONDS
+    ):
+        save_index()
+
+if saved_base_version is None and snapshot.n_rows:
+    save_index()  # index vừa migrate hoặc dựng lại toàn bộ từ log: checkpoint ngay
+
+# === Bảng sản phẩm tương tự cho /recommend ===
+# Row i của bảng: RECOMMEND_NEIGHBORS row gần nhất (int32 id + float16 score, giảm dần,
+# -1 = trống), lưu thành một file .npy mmap dùng chung giữa các worker. File có dung lượng dư
+# (tăng gấp đôi khi đầy) và được leader bảo trì sửa tại chỗ; số row đầu đã tính nằm trong file
+# meta JSON đi kèm. Mỗi lượt tối đa NEIGHBOR_UPDATE_ROWS row: row mới được search theo batch rồi
+# chèn ngược vào danh sách của các hàng xóm; row có hàng xóm đã bị xóa được tính lại. Row chưa
+# có trong bảng hoặc thiếu hàng xóm còn sống thì /recommend search trực tiếp.
+RECOMMEND_NEIGHBORS = int(os.environ.get("RECOMMEND_NEIGHBORS", 32))
+NEIGHBOR_UPDATE_ROWS = 20000
+NEIGHBOR_REVERSE_FACTOR = 4
+NEIGHBOR_MIN_CAPACITY = 1024
+NEIGHBOR_MERGE_CHUNK = 4096  # số row đích mỗi lần gộp ngược
+NEIGHBORS_PATH = os.path.join(DATA_DIR, "product_neighbors_clip.npy")
+NEIGHBORS_META_PATH = os.path.join(DATA_DIR, "product_neighbors_clip.json")  # {"rows": số row đã tính}
+NEIGHBOR_DTYPE = np.dtype([("ids", np.int32, RECOMMEND_NEIGHBORS), ("scores", np.float16, RECOMMEND_NEIGHBORS)])
+
+neighbor_table = None  # mảng NEIGHBOR_DTYPE theo row id (mmap chỉ đọc), None = chưa có
+neighbor_rows = 0  # số row đầu của neighbor_table đã được tính
+neighbor_signature = None
+neighbor_writer = None  # (generation, inode, mmap ghi được) của leader
+neighbor_checked_deletions = None  # số row đã xóa lần quét hàng xóm bị xóa gần nhất
+neighbor_update_lock = threading.Lock()  # bảng được sửa tại chỗ: mỗi lúc một lượt cập nhật
+
+def read_neighbor_meta():
+    try:
+        with open(NEIGHBORS_META_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_neighbor_meta(rows):
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"rows": int(rows)}, f)
+
+    atomic_write(NEIGHBORS_META_PATH, write)
+
+def load_neighbor_table():
+    """Nạp (mmap) bảng hàng xóm khi file bảng hoặc file meta đã đổi so với lần nạp trước"""
+    global neighbor_table, neighbor_rows, neighbor_signature
+    table_signature = disk_signature(NEIGHBORS_PATH)
+    inode = table_signature[0] if table_signature is not None else None
+    # Kèm generation: file tạo lại sau /reset có thể trùng inode với file đã xóa
+    signature = (checkpoint_generation, inode, disk_signature(NEIGHBORS_META_PATH))
+    if signature == neighbor_signature:
+        return
+    if inode is None:
+        table = None
+    elif neighbor_table is not None and neighbor_signature[:2] == signature[:2]:
+        table = neighbor_table  # chỉ meta đổi: mmap cũ đã thấy các row sửa tại chỗ
+    else:
+        table = np.load(NEIGHBORS_PATH, mmap_mode='r')
+    if table is not None and table.dtype != NEIGHBOR_DTYPE:
+        table = None
+    meta = read_neighbor_meta()
+    rows = 0 if table is None else min(len(table), meta["rows"] if meta else len(table))  # file cũ: không có meta
+    neighbor_table, neighbor_rows, neighbor_signature = table, rows, signature
+
+def writable_neighbor_table(rows, end):
+    """
+    Leader (giữ checkpoint_lock): mmap ghi được phủ ít nhất `end` row, giữ `rows` row đầu.
+    Đầy thì chép sang file mới dung lượng gấp đôi (O(N) nhưng chỉ log N lần).
+    """
+    global neighbor_writer
+    signature = disk_signature(NEIGHBORS_PATH)
+    table = None
+    if signature is not None:
+        if neighbor_writer is not None and neighbor_writer[:2] == (checkpoint_generation, signature[0]):
+            table = neighbor_writer[2]
+        else:
+            table = np.load(NEIGHBORS_PATH, mmap_mode='r+')
+            if table.dtype != NEIGHBOR_DTYPE:
+                table = None
+    if table is None or len(table) < end:
+        capacity = max(end, NEIGHBOR_MIN_CAPACITY, 2 * (len(table) if table is not None else 0))
+        old = table
+
+        def write(tmp_path):
+            grown = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=NEIGHBOR_DTYPE, shape=(capacity,))
+            grown["ids"], grown["scores"] = -1, -np.inf
+            if old is not None and rows:
+                grown[:rows] = old[:rows]
+            grown.flush()
+
+        write_neighbor_meta(rows)  # meta trước file mới: crash giữa chừng vẫn chỉ thấy `rows` row
+        atomic_write(NEIGHBORS_PATH, write)
+        table = np.load(NEIGHBORS_PATH, mmap_mode='r+')
+        signature = disk_signature(NEIGHBORS_PATH)
+    table[rows:end] = np.array((-1, -np.inf), dtype=NEIGHBOR_DTYPE)  # bỏ dữ liệu cũ của các row sắp tính
+    neighbor_writer = (checkpoint_generation, signature[0], table)
+    return table
+
+def nearest_rows(snap, row_ids, k):
+    """k hàng xóm còn sống (trừ chính nó) của từng row: (ids, scores) dạng (n, k), -1 = trống"""
+    all_ids = np.full((len(row_ids), k), -1, dtype=np.int64)
+    all_scores = np.full((len(row_ids), k), -np.inf, dtype=np.float32)
+    for start in range(0, len(row_ids), 1024):
+        chunk = row_ids[start:start + 1024]
+        D, I = search_index(snap, embedding_store.get(chunk), k + 1)
+        for n, (scores, ids) in enumerate(zip(D, I), start):
+            keep = (ids >= 0) & (ids < snap.n_rows) & (ids != row_ids[n])
+            keep[keep] = ~snap.deleted[ids[keep]]
+            ids, scores = ids[keep][:k], scores[keep][:k]
+            all_ids[n, :len(ids)], all_scores[n, :len(ids)] = ids, scores
+    return all_ids, all_scores
+
+def merge_reverse_neighbors(table, row_ids, ids, scores, old_rows):
+    """
+    Chèn ngược row mới vào danh sách của các row cũ gần nó: gom ứng viên theo row đích (giữ
+    tối đa RECOMMEND_NEIGHBORS ứng viên mỗi row), rồi mỗi khúc row đích một lần concat + sort
+    (2·RECOMMEND_NEIGHBORS cột) với danh sách hiện có.
+    """
+    k = RECOMMEND_NEIGHBORS
+    targets, scores = ids.ravel(), scores.ravel()
+    sources = np.repeat(row_ids, ids.shape[1])
+    keep = (targets >= 0) & (targets < old_rows)
+    targets, scores, sources = targets[keep], scores[keep], sources[keep]
+    if not len(targets):
+        return
+    order = np.lexsort((-scores, targets))
+    targets, scores, sources = targets[order], scores[order], sources[order]
+    rows, starts, counts = np.unique(targets, return_index=True, return_counts=True)
+    group = np.repeat(np.arange(len(rows)), counts)
+    slot = np.arange(len(targets)) - starts[group]
+    keep = slot < k
+    group, slot, scores, sources = group[keep], slot[keep], scores[keep], sources[keep]
+    candidate_ids = np.full((len(rows), k), -1, dtype=np.int64)
+    candidate_scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+    candidate_ids[group, slot], candidate_scores[group, slot] = sources, scores
+
+    for start in range(0, len(rows), NEIGHBOR_MERGE_CHUNK):
+        chunk = rows[start:start + NEIGHBOR_MERGE_CHUNK]
+        entries = table[chunk]
+        current_ids = entries["ids"].astype(np.int64)
+        cand_ids = candidate_ids[start:start + NEIGHBOR_MERGE_CHUNK]
+        cand_scores = candidate_scores[start:start + NEIGHBOR_MERGE_CHUNK].copy()
+        cand_scores[(cand_ids[:, :, None] == current_ids[:, None, :]).any(axis=2)] = -np.inf  # đã có
+        merged_ids = np.hstack([current_ids, cand_ids])
+        merged_scores = np.hstack([entries["scores"].astype(np.float32), cand_scores])
+        top = np.argsort(-merged_scores, axis=1, kind='stable')[:, :k]  # điểm bằng nhau: giữ row đã có
+        top_ids, top_scores = np.take_along_axis(merged_ids, top, axis=1), np.take_along_axis(merged_scores, top, axis=1)
+        top_ids[top_scores == -np.inf] = -1
+        table["ids"][chunk], table["scores"][chunk] = top_ids, top_scores
+
+def update_neighbor_table():
+    """Leader: cập nhật bảng hàng xóm theo snapshot hiện tại, ghi tại chỗ vào file (chạy nền)"""
+    with neighbor_update_lock:
+        _update_neighbor_table()
+
+def _update_neighbor_table():
+    global neighbor_checked_deletions
+    snap = snapshot
+    generation = checkpoint_generation
+    old, old_rows = neighbor_table, neighbor_rows
+    if old is not None and old_rows > snap.n_rows:
+        old, old_rows = None, 0  # bảng của catalog trước /reset
+    if old is None:
+        old_rows = 0
+
+    stale = np.zeros(0, dtype=np.int64)
+    deletions = snap.n_rows - snap.live_count()
+    if old is not None and deletions != neighbor_checked_deletions:
+        ids = np.asarray(old["ids"][:old_rows])
+        gone = (ids >= 0) & snap.deleted[np.clip(ids, 0, None)]
+        stale = np.flatnonzero(gone.any(axis=1) & ~snap.deleted[:old_rows])
+        if len(stale) <= NEIGHBOR_UPDATE_ROWS:
+            neighbor_checked_deletions = deletions  # lượt này tính lại hết, lần sau khỏi quét
+        stale = stale[:NEIGHBOR_UPDATE_ROWS]
+    end = min(snap.n_rows, old_rows + NEIGHBOR_UPDATE_ROWS - len(stale))
+    new_rows = np.arange(old_rows, end, dtype=np.int64)
+    new_rows = new_rows[~snap.deleted[old_rows:end]]
+    if not len(stale) and end == old_rows:
+        return
+
+    start_time = time.time()
+    stale_ids, stale_scores = nearest_rows(snap, stale, RECOMMEND_NEIGHBORS)
+    # Row mới lấy rộng NEIGHBOR_REVERSE_FACTOR lần: row cũ nào gần nó thì nó (gần như luôn)
+    # thuộc top-k của row cũ đó, nên được chèn ngược vào danh sách của row cũ
+    ids, scores = nearest_rows(snap, new_rows, RECOMMEND_NEIGHBORS * NEIGHBOR_REVERSE_FACTOR)
+
+    with checkpoint_lock.hold():
+        if read_checkpoint().get("generation") != generation:
+            return  # /reset trong lúc tính
+        table = writable_neighbor_table(old_rows, end)
+        table["ids"][stale], table["scores"][stale] = stale_ids, stale_scores
+        table["ids"][new_rows] = ids[:, :RECOMMEND_NEIGHBORS]
+        table["scores"][new_rows] = scores[:, :RECOMMEND_NEIGHBORS]
+        merge_reverse_neighbors(table, new_rows, ids, scores, old_rows)
+        table.flush()
+        write_neighbor_meta(end)
+    load_neighbor_table()
+    print(f"🔗 Bảng hàng xóm: {len(new_rows)} row mới, {len(stale)} row tính lại ({time.time() - start_time:.2f}s)")
+
+def similar_rows(snap, row_id, k):
+    """(row ids, scores) của k sản phẩm gần nhất từ bảng, None nếu bảng chưa phủ row này"""
+    table = neighbor_table
+    if table is None or row_id >= neighbor_rows or k > RECOMMEND_NEIGHBORS:
+        return None
+    ids = table[row_id]["ids"].astype(np.int64)
+    live = (ids >= 0) & (ids < snap.n_rows)
+    live[live] = ~snap.deleted[ids[live]]
+    if live.sum() < min(k, snap.live_count() - 1):
+        return None
+    return ids[live][:k], table[row_id]["scores"][live][:k].astype(np.float32)
+
+load_neighbor_table()
+
+# === Sản phẩm nhiều view ===
+# Mỗi sản phẩm 3D có nhiều ảnh render (các row cùng product_id). Mặc định /search xếp hạng
+# theo view rồi dedup ("maxsim", search lại rộng hơn nếu dedup còn thiếu sản phẩm). Hai chế độ
+# theo sản phẩm dùng index centroid (trung bình các view, chuẩn hóa) trong RAM mỗi worker:
+#   two_stage: lấy PRODUCT_SHORTLIST_FACTOR × top_k sản phẩm gần nhất theo centroid rồi chấm lại
+#              chính xác bằng view khớp nhất của từng sản phẩm (cùng thang điểm với maxsim)
+#   centroid:  như two_stage nhưng điểm = cosine với centroid hiện tại của sản phẩm
+# Index centroid được dựng lần đầu khi cần; row thêm sau đó được search trực tiếp (exact) cho
+# tới khi bảo trì dựng lại sau PRODUCT_INDEX_REBUILD_ROWS row mới / bị xóa.
+PRODUCT_SEARCH_MODES = ("maxsim", "two_stage", "centroid")
+PRODUCT_SEARCH_MODE = os.environ.get("PRODUCT_SEARCH_MODE", "maxsim")
+PRODUCT_SHORTLIST_FACTOR = int(os.environ.get("PRODUCT_SHORTLIST_FACTOR", 4))
+PRODUCT_INDEX_REBUILD_ROWS = int(os.environ.get("PRODUCT_INDEX_REBUILD_ROWS", 20000))
+PRODUCT_REFETCH_GROWTH = 4  # maxsim: hệ số tăng k mỗi lần search lại
+
+class ProductIndex:
+    """Index centroid theo sản phẩm, dựng từ các row sống của một snapshot (không đổi sau khi dựng)"""
+
+    def __init__(self, snap):
+        start_time = time.time()
+        rows = snap.live_row_ids()
+        keys = product_keys(rows)
+        order = np.argsort(keys, kind='stable')
+        self.rows = rows[order]
+        self.keys, starts = np.unique(keys[order], return_index=True)  # khóa sản phẩm của từng group
+        self.offsets = np.append(starts, len(rows))
+        self.group_of = {int(key): group for group, key in enumerate(self.keys)}
+        self.watermark = snap.n_rows  # row >= watermark chưa có trong index
+        self.deleted = snap.n_rows - len(rows)
+
+        centroids = np.zeros((len(self.keys), FEATURE_DIM), dtype=np.float32)
+        groups = np.repeat(np.arange(len(self.keys)), np.diff(self.offsets))
+        for start in range(0, len(rows), ADD_CHUNK_ROWS):
+            chunk_groups = groups[start:start + ADD_CHUNK_ROWS]
+            uniq, first = np.unique(chunk_groups, return_index=True)
+            centroids[uniq] += np.add.reduceat(embedding_store.get(self.rows[start:start + ADD_CHUNK_ROWS]), first, axis=0)
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        if len(self.keys) < INDEX_FLAT_MAX:
+            self.index = faiss.IndexFlatIP(FEATURE_DIM)
+        else:
+            self.index = faiss.IndexHNSWFlat(FEATURE_DIM, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        self.index.add(centroids)
+        print(f"🧊 Index centroid: {len(self.keys)} sản phẩm / {len(rows)} view ({time.time() - start_time:.2f}s)")
+
+    def search(self, vectors, k):
+        """Group id (thứ tự sản phẩm) của k centroid gần nhất, -1 = trống"""
+        k = min(k, self.index.ntotal)
+        if k <= 0:
+            return np.zeros((len(vectors), 0), dtype=np.int64)
+        if isinstance(self.index, faiss.IndexHNSWFlat):
+            _, G = self.index.search(vectors, k, params=faiss.SearchParametersHNSW(efSearch=max(64, k)))
+        else:
+            _, G = self.index.search(vectors, k)
+        return G
+
+    def group_rows(self, key):
+        group = self.group_of.get(int(key))
+        if group is None:
+            return np.zeros(0, dtype=np.int64)
+        return self.rows[self.offsets[group]:self.offsets[group + 1]]
 
-# === Cấu hình tối ưu ===
-torch.backends.cudnn.benchmark = True
-if DEVICE.type == 'cuda':
-    torch.cuda.empty_cache()
-else:
-    torch.set_num_threads(4)
+product_index = None  # ProductIndex, None = chưa dựng (chỉ dựng khi có query theo sản phẩm)
+product_index_lock = threading.Lock()
 
-TIMEOUT_SECONDS = 30
+def product_index_for_search():
+    global product_index
+    pindex = product_index
+    if pindex is None:
+        with product_index_lock:
+            if product_index is None:
+                product_index = ProductIndex(snapshot)
+            pindex = product_index
+    return pindex
 
-# === Lazy loading CLIP model ===
-clip_processor = None
-clip_model = None
+def invalidate_product_index():
+    """Row id / mã product_id đã đổi (nạp lại từ đĩa, /reset): dựng lại ở lần dùng tới"""
+    global product_index
+    with product_index_lock:
+        product_index = None
 
-# === Product metadata storage ===
-product_metadata = {}
+def refresh_product_index():
+    """Bảo trì: dựng lại index centroid đang dùng khi đã có đủ row mới hoặc bị xóa từ lần dựng trước"""
+    global product_index
+    pindex, snap = product_index, snapshot
+    if pindex is None:
+        return
+    changed = max(0, snap.n_rows - pindex.watermark) + abs(snap.n_rows - snap.live_count() - pindex.deleted)
+    if changed < PRODUCT_INDEX_REBUILD_ROWS:
+        return
+    new_index = ProductIndex(snap)
+    with product_index_lock:
+        if product_index is pindex:
+            product_index = new_index
 
-def load_models_if_needed():
-    global clip_processor, clip_model
-    
-    if clip_processor is None or clip_model is None:
-        print("🔄 Đang tải mô hình CLIP...")
-        try:
-            clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-            clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(DEVICE).eval()
-            print("✅ Đã tải xong mô hình CLIP")
-        except Exception as e:
-            print(f"❌ Lỗi khi tải mô hình CLIP: {e}")
-            raise
+def product_search(snap, vectors, top_k, threshold=None, mode="two_stage"):
+    """
+    [(row ids, scores)] như rank_hits(dedup=True): mỗi sản phẩm một row (view khớp query nhất).
+    Ứng viên: sản phẩm có centroid gần nhất + sản phẩm của các row mới hơn index centroid.
+    """
+    pindex = product_index_for_search()
+    shortlist = max(1, top_k * PRODUCT_SHORTLIST_FACTOR)
+    G = pindex.search(vectors, shortlist)
+    new_rows = np.arange(min(pindex.watermark, snap.n_rows), snap.n_rows, dtype=np.int64)
+    new_rows = new_rows[~snap.deleted[new_rows]]
+    new_keys = product_keys(new_rows)
+    new_scores = vectors @ embedding_store.get(new_rows).T
 
-def preload_models():
-    print("⏳ Preloading CLIP model in background...")
-    try:
-        load_models_if_needed()
-        print("✅ CLIP model preloaded successfully!")
-    except Exception as e:
-        print(f"❌ Error preloading models: {e}")
+    ranked = []
+    for vec, groups, scores in zip(vectors, G, new_scores):
+        keys = pindex.keys[groups[groups >= 0]]
+        if len(new_rows):
+            best_new = np.argpartition(-scores, min(shortlist, len(scores)) - 1)[:shortlist]
+            keys = np.union1d(keys, new_keys[best_new])
+        # Chấm lại trên mọi view còn sống của các sản phẩm ứng viên
+        rows = np.concatenate([pindex.group_rows(key) for key in keys] + [new_rows[np.isin(new_keys, keys)]])
+        rows = rows[rows < snap.n_rows]
+        rows = rows[~snap.deleted[rows]]
+        view_vectors = embedding_store.get(rows)
+        view_scores = view_vectors @ vec
+        row_keys = product_keys(rows)
+        order = np.lexsort((-view_scores, row_keys))  # theo sản phẩm, view điểm cao trước
+        _, first = np.unique(row_keys[order], return_index=True)
+        best = order[first]
+        if mode == "centroid":
+            sums = np.add.reduceat(view_vectors[order], first, axis=0) if len(first) else view_vectors[:0]
+            product_scores = (sums @ vec) / np.maximum(np.linalg.norm(sums, axis=1), 1e-12)
+        else:
+            product_scores = view_scores[best]
+        ranked.append(rank_hits(snap, product_scores[None].astype(np.float32), rows[best][None], top_k, threshold=threshold)[0])
+    return ranked
 
-# === Load index và metadata ===
-print("🔄 Đang tải FAISS index và metadata...")
-if os.path.exists(INDEX_PATH) and os.path.exists(PATHS_PATH):
-    index = faiss.read_index(INDEX_PATH)
-    image_paths = list(np.load(PATHS_PATH, allow_pickle=True))
-    print(f"✅ Đã tải index với {len(image_paths)} sản phẩm")
-else:
-    index = faiss.IndexFlatIP(512)  # CLIP uses 512-dim features
-    image_paths = []
-    print("✅ Tạo index mới (CLIP 512-dim)")
-
-# Load metadata
-if os.path.exists(METADATA_PATH):
-    with open(METADATA_PATH, 'r', encoding='utf-8') as f:
-        product_metadata = json.load(f)
-    print(f"✅ Đã tải metadata cho {len(product_metadata)} sản phẩm")
-else:
-    product_metadata = {}
+def product_view_hits(snap, vectors, D, I, top_k, threshold=None, filters=None):
+    """
+    maxsim: rank_hits(dedup=True) trên kết quả search theo view. Query còn thiếu sản phẩm sau
+    dedup (nhiều view cùng sản phẩm chiếm chỗ) được search lại với k lớn hơn.
+    """
+    ranked = rank_hits(snap, D, I, top_k, threshold=threshold, dedup=True)
+    pending = np.arange(len(vectors))
+    k = I.shape[1]
+    while True:
+        # Còn thiếu mà kết quả cuối vẫn là row thật và đạt threshold: có thể còn sản phẩm khác
+        pending = np.array([
+            n for m, n in enumerate(pending)
+            if len(ranked[n][0]) < top_k and I.shape[1] >= k > 0 and I[m, -1] >= 0
+            and (threshold is None or D[m, -1] >= threshold)
+        ], dtype=np.int64)
+        if len(pending) == 0 or k >= snap.ntotal:
+            return ranked
+        k = min(k * PRODUCT_REFETCH_GROWTH, snap.ntotal)
+        D, I = search_vectors(snap, vectors[pending], k, filters)
+        for n, hits in zip(pending, rank_hits(snap, D, I, top_k, threshold=threshold, dedup=True)):
+            ranked[n] = hits
 
-# === Hàm tiền xử lý ảnh cho CLIP ===
-def preprocess_image(image_path):
-    """Tiền xử lý ảnh sản phẩm 3D cho CLIP"""
-    try:
-        image = Image.open(image_path).convert("RGB")
-        # CLIP processor sẽ tự động resize về 224x224
-        return image
-    except Exception as e:
-        print(f"❌ Lỗi preprocess ảnh {image_path}: {e}")
-        return None
+def product_hits(snap, vectors, top_k, threshold, mode, D=None, I=None, filters=None):
+    """Kết quả theo sản phẩm cho query ảnh (/search, /search-batch); có filters thì luôn dùng maxsim"""
+    if mode != "maxsim" and not filters:
+        return product_search(snap, vectors, top_k, threshold, mode)
+    if D is None:
+        D, I = search_vectors(snap, vectors, top_k * 5, filters)
+    return product_view_hits(snap, vectors, D, I, top_k, threshold, filters)
 
-# === Hàm trích xuất đặc trưng CLIP ===
-@lru_cache(maxsize=1000)
-def extract_feature_clip(image_path):
-    """Trích xuất đặc trưng CLIP cho ảnh sản phẩm 3D"""
-    start_time = time.time()
-    try:
-        load_models_if_needed()
-        
-        image = preprocess_image(image_path)
-        if image is None:
-            return np.zeros(512, dtype=np.float32)
-        
-        # CLIP preprocessing
-        inputs = clip_processor(images=image, return_tensors="pt").to(DEVICE)
-        
-        with torch.no_grad():
-            # Get image features from CLIP
-            image_features = clip_model.get_image_features(**inputs)
-            # L2 normalization cho cosine similarity
-            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        
-        result = image_features.cpu().numpy().squeeze().astype(np.float32)
-        
-        elapsed = time.time() - start_time
-        print(f"⚡ CLIP feature extraction: {elapsed:.2f}s")
-        return result
-    except Exception as e:
-        print(f"❌ Lỗi trích xuất đặc trưng CLIP: {e}")
-        return np.zeros(512, dtype=np.float32)
+# === Đồng bộ giữa các worker process ===
+# Các worker (gunicorn) dùng chung DATA_DIR: mọi thao tác ghi nằm trong write_lock (flock)
+# và được ghi vào mutation log trước. Worker khác bắt kịp bằng cách tail log (trước mỗi
+# request và trong thread bảo trì); chỉ nạp lại toàn bộ từ checkpoint khi log đã bị cắt
+# qua lsn của mình, sau /reset, hoặc (thread bảo trì) khi leader vừa ghi base mới.
+SYNC_INTERVAL_SECONDS = float(os.environ.get("SYNC_INTERVAL_SECONDS", 1))
 
-# === Hàm trích xuất text features ===
-def extract_text_feature(text):
-    """Trích xuất đặc trưng từ text query"""
-    try:
-        load_models_if_needed()
-        
-        inputs = clip_processor(text=[text], return_tensors="pt", padding=True).to(DEVICE)
-        
-        with torch.no_grad():
-            text_features = clip_model.get_text_features(**inputs)
-            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-        
-        return text_features.cpu().numpy().squeeze().astype(np.float32)
-    except Exception as e:
-        print(f"❌ Lỗi trích xuất text features: {e}")
-        return np.zeros(512, dtype=np.float32)
+synced_checkpoint = disk_signature(CHECKPOINT_PATH)
+disk_base_id = loaded_base_id  # base_id trong checkpoint mới nhất đã đọc
 
-# === Hàm tối ưu index ===
-def optimize_index_if_needed():
-    """Chuyển sang IndexIVFFlat khi có đủ dữ liệu"""
-    global index
-    
-    if len(image_paths) >= 100 and isinstance(index, faiss.IndexFlatIP):
-        print("🔄 Tối ưu index sang IndexIVFFlat...")
-        try:
-            quantizer = faiss.IndexFlatIP(512)  # CLIP 512-dim
-            nlist = int(np.sqrt(len(image_paths)))
-            nlist = max(10, min(nlist, 100))
-            
-            new_index = faiss.IndexIVFFlat(quantizer, 512, nlist, faiss.METRIC_INNER_PRODUCT)
-            
-            all_vectors = []
-            for path in image_paths:
-                vec = extract_feature_clip(path).reshape(1, -1)
-                all_vectors.append(vec)
-            
-            training_data = np.vstack(all_vectors)
-            new_index.train(training_data)
-            new_index.add(training_data)
-            
-            index = new_index
-            index.nprobe = max(1, nlist // 4)
-            
-            faiss.write_index(index, INDEX_PATH)
-            print(f"✅ Đã tối ưu index với {nlist} clusters")
-        except Exception as e:
-            print(f"❌ Lỗi tối ưu index: {e}")
+def sync_with_disk(reload_base=False):
+    """Áp dụng các thao tác mà process khác đã ghi xuống đĩa; không có gì mới thì chỉ tốn vài stat"""
+    if (disk_signature(CHECKPOINT_PATH) == synced_checkpoint and not mutation_log.changed()
+            and not (reload_base and disk_base_id != loaded_base_id)):
+        return
+    with write_lock:
+        catch_up_with_disk(reload_base)
 
-def save_metadata():
-    """Lưu metadata vào file JSON"""
-    try:
-        with open(METADATA_PATH, 'w', encoding='utf-8') as f:
-            json.dump(product_metadata, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"❌ Lỗi lưu metadata: {e}")
+def catch_up_with_disk(reload_base=False):
+    """Phần chậm của sync_with_disk, gọi trong write_lock (cũng là on_acquire của write_lock)"""
+    global synced_checkpoint, disk_base_id
+    checkpoint_signature = disk_signature(CHECKPOINT_PATH)
+    if checkpoint_signature != synced_checkpoint:
+        checkpoint = read_checkpoint()
+        if checkpoint.get("generation") != checkpoint_generation or checkpoint.get("lsn", 0) > mutation_log.lsn:
+            reload_from_disk()
+            return
+        synced_checkpoint = checkpoint_signature
+        disk_base_id = checkpoint.get("base_id")
+        mutation_log.read_inode = None  # log vừa được thay: đọc lại từ đầu, bỏ lsn đã áp dụng
+    if reload_base and disk_base_id != loaded_base_id:
+        reload_from_disk()  # leader đã ghi base mới (compaction/optimize)
+        return
+    records = mutation_log.read_new()
+    if records and records[0]["lsn"] != mutation_log.lsn + 1:
+        reload_from_disk()  # hụt thao tác
+        return
+    if records:
+        embedding_store.refresh()
+    for record in records:
+        apply_logged_mutation(record)
+        mutation_log.lsn = record["lsn"]
+
+def reload_from_disk():
+    """Nạp lại toàn bộ snapshot từ checkpoint + log trên đĩa"""
+    global saved_base_version, index_tuning, loaded_base_id, checkpoint_generation, synced_checkpoint, disk_base_id
+    with write_lock, checkpoint_lock.hold(shared=True):
+        synced_checkpoint = disk_signature(CHECKPOINT_PATH)
+        checkpoint = read_checkpoint()
+        new_snapshot, base_saved = load_snapshot(checkpoint, previous=snapshot, apply_metadata=False)
+        attribute_columns.clear()
+        publish(new_snapshot)
+        invalidate_product_index()
+        rebuild_lookup_maps(new_snapshot)
+        saved_base_version = new_snapshot.base_version if base_saved else None
+        index_tuning = checkpoint.get("tuning", {})
+        loaded_base_id = disk_base_id = checkpoint.get("base_id")
+        checkpoint_generation = checkpoint.get("generation")
+        load_neighbor_table()
+    print(f"🔄 Đã nạp lại index từ đĩa (lsn={mutation_log.lsn}, {new_snapshot.live_count()} sản phẩm)")
+
+if not OFFLINE_TOOL:
+    write_lock.on_acquire = catch_up_with_disk
+
+def init_worker_process():
+    """
+    Gọi trong worker sau khi fork (gunicorn post_fork): đặt số thread, mở lại các fd / kết
+    nối SQLite không được dùng chung giữa các process rồi bắt kịp các thao tác ghi sau preload.
+    """
+    global clip_encoder, preprocess_pool
+    configure_threads(TORCH_THREADS, FAISS_THREADS)
+    if clip_encoder is not None and not clip_encoder.fork_safe:
+        clip_encoder = None  # dựng lại từ artifact đã export, với số thread của worker
+    # Master có thể đã dùng pool (kiểm tra INT8 lúc nạp model): thread không qua fork, pool
+    # thừa hưởng sẽ nhận việc mà không bao giờ chạy -> tạo pool mới cho worker
+    preprocess_pool = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="clip-preprocess")
+    for lock in (write_lock.file_lock, checkpoint_lock, maintenance_leader_lock):
+        lock.reopen()
+    mutation_log.reopen()
+    product_metadata.reopen()
+    embedding_cache.reopen()
+    text_query_log.reopen()
+    sync_manifest.reopen()
+    if clip_encoder is None:
+        threading.Thread(target=preload_models, daemon=True).start()  # GPU: mỗi worker tự nạp
+    start_maintenance_thread()
+    sync_with_disk()
+
+@app.before_request
+def sync_before_request():
+    if request.endpoint != 'liveness':
+        sync_with_disk()
 
 # === API ===
 
@@ -181,21 +3391,46 @@ def status():
     models_loaded = {
         "clip_processor": clip_processor is not None,
         "clip_model": clip_model is not None,
+        "clip_encoder": clip_encoder is not None,
     }
     
-    index_type = "IndexIVFFlat" if isinstance(index, faiss.IndexIVFFlat) else "IndexFlatIP"
-    
     return jsonify({
         "service": "3D Product Image Search",
         "model": "CLIP ViT-B/32",
         "device": str(DEVICE),
-        "index_size": len(image_paths),
-        "index_type": index_type,
+        "inference_backend": clip_encoder.name if clip_encoder is not None else None,
+        "quantization": quantization_report,
+        "index_size": snapshot.live_count(),
+        "index_type": index_type_name(),
         "feature_dim": 512,
         "models_loaded": models_loaded,
         "memory_usage": f"{torch.cuda.memory_allocated() / 1024**2:.1f}MB" if torch.cuda.is_available() else "N/A"
     })
 
+@app.route('/healthz')
+def liveness():
+    """Liveness: process còn nhận request (không phụ thuộc model đã nạp hay chưa)"""
+    return jsonify({"status": "alive", "pid": os.getpid()})
+
+@app.route('/readyz')
+def readiness():
+    """Readiness: 503 cho tới khi CLIP nạp xong, load balancer chưa chuyển traffic tới worker"""
+    models_loaded = {
+        "clip_processor": clip_processor is not None,
+        "clip_model": clip_model is not None,
+        "clip_encoder": clip_encoder is not None,
+    }
+    ready = all(models_loaded.values())
+    snap = snapshot
+    return jsonify({
+        "status": "ready" if ready else "loading",
+        "pid": os.getpid(),
+        "models_loaded": models_loaded,
+        "index_size": snap.live_count(),
+        "index_version": snap.version,
+        "lsn": mutation_log.lsn,
+    }), 200 if ready else 503
+
 @app.route('/add', methods=['POST'])
 def add_product():
     """Thêm sản phẩm mới vào index"""
@@ -207,12 +3442,15 @@ def add_product():
     file = request.files['image']
     filename = file.filename
     save_path = os.path.join(STORAGE_DIR, filename)
-    file.save(save_path)
 
-    # Trích xuất đặc trưng CLIP
-    vec = extract_feature_clip(save_path).astype("float32").reshape(1, -1)
-    index.add(vec)
-    image_paths.append(save_path)
+    # Trích xuất đặc trưng CLIP trước khi ghi file: ảnh lỗi (vector 0) không được vào index
+    # và không ghi đè ảnh cũ cùng tên
+    image_buffer = load_upload_image(file)
+    vec = extract_feature_clip(image_buffer).astype("float32").reshape(1, -1)
+    if not vec.any():
+        return jsonify({"error": "Không đọc được file ảnh"}), 400
+    with open(save_path, 'wb') as f:
+        f.write(image_buffer.getvalue())
 
     # Lưu metadata
     metadata = {
@@ -229,14 +3467,8 @@ def add_product():
         except:
             pass
     
-    product_metadata[save_path] = metadata
-
-    if len(image_paths) % 5 == 0:
-        faiss.write_index(index, INDEX_PATH)
-        np.save(PATHS_PATH, np.array(image_paths))
-        save_metadata()
-        print(f"💾 Đã lưu index với {len(image_paths)} sản phẩm")
-        optimize_index_if_needed()
+    add_rows(vec, [save_path], [metadata])
+    request_maintenance()  # checkpoint/optimize chạy nền, thao tác đã nằm trong log
     
     elapsed = time.time() - start_time
     print(f"✅ Thêm sản phẩm: {elapsed:.2f}s")
@@ -248,13 +3480,14 @@ def add_product():
 
 @app.route('/add-batch', methods=['POST'])
 def add_products_batch():
-    """Thêm nhiều sản phẩm cùng lúc"""
-    start_time = time.time()
-    
+    """
+    Thêm nhiều sản phẩm cùng lúc: tạo job import và trả ngay job_id (202), theo dõi bằng
+    GET /jobs/<job_id>. Hàng đợi đầy -> 429, thử lại sau Retry-After giây.
+    """
     if 'images' not in request.files:
         return jsonify({"error": "Không có file nào được gửi"}), 400
     
-    files = request.files.getlist('images')
+    files = [file for file in request.files.getlist('images') if file.filename != '']
     if len(files) == 0:
         return jsonify({"error": "Không có file nào được gửi"}), 400
     
@@ -265,66 +3498,112 @@ def add_products_batch():
         except:
             pass
     
-    saved_files = []
-    for file in files:
-        if file.filename == '':
-            continue
-            
-        filename = file.filename
-        save_path = os.path.join(STORAGE_DIR, filename)
-        file.save(save_path)
-        saved_files.append((save_path, filename))
-    
-    def process_products():
-        added_paths = []
-        vectors = []
-        
-        batch_size = min(10, len(saved_files))
-        
-        for i in range(0, len(saved_files), batch_size):
-            batch_files = saved_files[i:i+batch_size]
-            batch_vectors = []
-            batch_paths = []
-            
-            for save_path, filename in batch_files:
-                try:
-                    vec = extract_feature_clip(save_path).astype("float32").reshape(1, -1)
-                    batch_vectors.append(vec)
-                    batch_paths.append(save_path)
-                    added_paths.append(save_path)
-                    
-                    metadata = metadata_mapping.get(filename, {})
-                    metadata['image_path'] = save_path
-                    product_metadata[save_path] = metadata
-                    
-                except Exception as e:
-                    print(f"❌ Lỗi xử lý {filename}: {e}")
-            
-            if batch_vectors:
-                vectors.extend(batch_vectors)
-                image_paths.extend(batch_paths)
-        
-        if vectors:
-            index.add(np.vstack(vectors))
-            faiss.write_index(index, INDEX_PATH)
-            np.save(PATHS_PATH, np.array(image_paths))
-            save_metadata()
-            print(f"💾 Đã lưu index batch với {len(image_paths)} sản phẩm")
-            optimize_index_if_needed()
-        
-        elapsed = time.time() - start_time
-        print(f"✅ Thêm batch {len(added_paths)} sản phẩm: {elapsed:.2f}s")
-    
-    import threading
-    thread = threading.Thread(target=process_products)
-    thread.daemon = True
-    thread.start()
-    
+    job = IngestJob(len(files), metadata_mapping)
+    if not ingest_queue.submit(job):
+        response = jsonify({"error": "Hàng đợi import đang đầy, thử lại sau", "retry_after": 5})
+        response.headers["Retry-After"] = "5"
+        return response, 429
+
+    # Mỗi file vào pipeline ngay khi ghi xong (job có thể đã bắt đầu embed)
+    try:
+        for file in files:
+            save_path = os.path.join(STORAGE_DIR, file.filename)
+            try:
+                file.save(save_path)
+            except Exception as e:
+                job.fail_file(file.filename, str(e))
+                continue
+            job.feed(save_path)
+    finally:
+        job.close_input()
+
     return jsonify({
-        "message": f"Đang xử lý {len(saved_files)} sản phẩm...",
+        "message": f"Đang xử lý {len(files)} sản phẩm...",
         "status": "processing",
-        "total": len(saved_files)
-    })
+        "total": len(files),
+        "job_id": job.id,
+        "status_url": f"/jobs/{job.id}",
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Tiến độ job import: processed/total, ảnh/s, danh sách file lỗi"""
+    job = ingest_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Không tìm thấy job"}), 404
+    return jsonify(job)
+
+@app.route('/reload', methods=['POST'])
+def reload_storage():
+    """
+    Đồng bộ index với thư mục ảnh: tombstone file đã mất ngay, file mới / đổi cỡ hoặc mtime được
+    giao cho một job import (202 + job_id; file nội dung không đổi tính là skipped trong job).
+    {"dry_run": true} chỉ trả về chênh lệch. Xóa hàng loạt trả về 409, không đổi gì, trừ khi
+    gửi {"allow_mass_delete": true}.
+    """
+    options = request.get_json(silent=True) or {}
+    start_time = time.time()
+    diff = diff_storage()
+    to_embed = {**diff["added"], **diff["modified"]}
+    summary = {
+        "added": len(diff["added"]),
+        "modified": len(diff["modified"]),
+        "removed": len(diff["removed"]),
+        "adopted": len(diff["adopted"]),
+        "unchanged": diff["unchanged"],
+        "failed": diff["failed"],
+        "diff_seconds": round(time.time() - start_time, 3),
+    }
+    mass_delete = mass_delete_reason(diff)
+    if options.get("dry_run"):
+        return jsonify({
+            **summary,
+            "dry_run": True,
+            "mass_delete": mass_delete,
+            "files": {
+                "added": [os.path.basename(path) for path in diff["added"]],
+                "modified": [os.path.basename(path) for path in diff["modified"]],
+                "removed": [os.path.basename(path) for path in diff["removed"]],
+            },
+        })
+    if mass_delete and not options.get("allow_mass_delete"):
+        print(f"⚠️ /reload bị từ chối: {mass_delete}")
+        return jsonify({
+            **summary,
+            "error": mass_delete,
+            "stored": diff["stored"],
+            "hint": 'Kiểm tra thư mục ảnh; nếu đúng là cần xóa, gửi lại với {"allow_mass_delete": true}',
+        }), 409
+
+    job = None
+    if to_embed:
+        # File đổi nội dung giữ metadata cũ; job chỉ nhận khi hàng đợi còn chỗ
+        metadata_mapping = {os.path.basename(path): metadata for path, metadata in product_metadata.get_many(diff["modified"]).items()}
+        before_embed, on_added, on_failed = sync_job_hooks(to_embed)
+        job = IngestJob(len(to_embed), metadata_mapping, on_added=on_added, before_embed=before_embed, on_failed=on_failed)
+        if not ingest_queue.submit(job):
+            response = jsonify({"error": "Hàng đợi import đang đầy, thử lại sau", "retry_after": 5})
+            response.headers["Retry-After"] = "5"
+            return response, 429
+
+    if diff["removed"]:
+        delete_paths(diff["removed"])
+        request_maintenance()
+    sync_manifest.remove(diff["removed"] + diff["stale"])
+    sync_manifest.record(diff["adopted"])
+
+    if job is None:
+        return jsonify({**summary, "message": "Index đã khớp với thư mục ảnh" if not diff["removed"] else "Đã đồng bộ"})
+    for path in to_embed:
+        job.feed(path)
+    job.close_input()
+    print(f"🔄 /reload: {summary}")
+    return jsonify({
+        **summary,
+        "message": f"Đang embed {len(to_embed)} ảnh mới/đã đổi...",
+        "job_id": job.id,
+        "status_url": f"/jobs/{job.id}",
+    }), 202
 
 @app.route('/search', methods=['POST'])
 def search_product():
@@ -334,17 +3613,19 @@ def search_product():
     """
     start_time = time.time()
     
-    if index.ntotal == 0:
+    if snapshot.ntotal == 0:
         return jsonify([])
 
     if 'image' not in request.files:
         return jsonify({"error": "Thiếu file ảnh"}), 400
 
     file = request.files['image']
-    temp_path = f"temp_query_{int(time.time() * 1000)}.jpg"
     
     top_k = int(request.form.get('top_k', 10))
     threshold = float(request.form.get('threshold', 0.6))  # CLIP: threshold cao hơn (0.6 vs 0.5)
+    mode = request.form.get('product_mode', PRODUCT_SEARCH_MODE)
+    if mode not in PRODUCT_SEARCH_MODES:
+        return jsonify({"error": f"product_mode phải là một trong {', '.join(PRODUCT_SEARCH_MODES)}"}), 400
     
     filters = {}
     if 'filters' in request.form:
@@ -352,70 +3633,32 @@ def search_product():
             filters = json.loads(request.form['filters'])
         except:
             pass
+    # Search theo view (maxsim, hoặc khi có filters); theo sản phẩm thì chỉ cần vector query
+    view_k = top_k * 5 if mode == "maxsim" or filters else 0
     
     try:
-        file.save(temp_path)
-        
-        # Trích xuất đặc trưng CLIP
-        vec = extract_feature_clip(temp_path).astype("float32").reshape(1, -1)
-        
-        # Search với CLIP features
-        k = min(top_k * 5, index.ntotal)
-        D, I = index.search(vec, k=k)
-
-        # BƯỚC 1: Thu thập kết quả và deduplication (chỉ giữ best score per product_id)
-        seen_products = {}  # Track best score for each product_id
-        
-        for idx, (i, score) in enumerate(zip(I[0], D[0])):
-            if i >= len(image_paths):
-                continue
-                
-            if score < threshold:
-                continue
-            
-            img_path = image_paths[i]
-            metadata = product_metadata.get(img_path, {})
-            
-            # Apply filters
-            if filters:
-                skip = False
-                for key, value in filters.items():
-                    if key in metadata and metadata[key] != value:
-                        skip = True
-                        break
-                if skip:
-                    continue
-            
-            # Deduplication: Chỉ giữ ảnh có original_score cao nhất cho mỗi product_id
-            product_id = metadata.get('product_id', img_path)  # Fallback to path if no product_id
-            
-            if product_id not in seen_products or score > seen_products[product_id]['original_score']:
-                seen_products[product_id] = {
-                    "path": img_path,
-                    "original_score": float(score),
-                    "metadata": metadata
-                }
+        image_buffer = load_upload_image(file)
+        cache_key = embedding_cache_key(image_buffer.getvalue())
+        vec = embedding_cache.get(cache_key)
         
-        # BƯỚC 2: Tạo results với true CLIP scores (không boost)
-        results = []
-        
-        for product_data in seen_products.values():
-            original_score = product_data['original_score']
+        if vec is not None:
+            # Ảnh đã gặp: bỏ qua CLIP, search thẳng
+            vec = vec.reshape(1, -1)
+            snap = snapshot
+            D, I = search_vectors(snap, vec, view_k, filters) if view_k else (None, None)
+        else:
+            image = preprocess_image(image_buffer)
+            if image is None:
+                return jsonify({"error": "Không đọc được file ảnh"}), 400
             
-            results.append({
-                "path": product_data['path'],
-                "score": float(original_score),  # Sử dụng score gốc từ CLIP
-                "original_score": original_score,
-                "metadata": product_data['metadata']
-            })
-        
-        results.sort(key=lambda x: x['score'], reverse=True)
-        
-        for idx, result in enumerate(results[:top_k]):
-            result['rank'] = idx + 1
-        
-        results = results[:top_k]
-        print(results)
+            # Trích xuất đặc trưng CLIP + search, gom batch với các request đồng thời
+            snap, vec, D, I = search_batcher.search(image, view_k, filters)
+            embedding_cache.put(cache_key, vec)
+
+        # filters đã được áp dụng trong lúc search (pre-filter); mỗi product_id chỉ giữ ảnh có
+        # score CLIP cao nhất (score gốc, không boost)
+        ranked = product_hits(snap, vec, top_k, threshold, mode, D, I, filters)
+        results = result_dicts(hit_results(snap, ranked)[0], ranked=True)
         
         elapsed = time.time() - start_time
         print(f"🔍 CLIP Search: {elapsed:.2f}s, found {len(results)} results")
@@ -424,12 +3667,6 @@ def search_product():
     except Exception as e:
         print(f"❌ Lỗi tìm kiếm: {e}")
         return jsonify({"error": str(e)}), 500
-    finally:
-        if os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
 
 @app.route('/recommend', methods=['POST'])
 def recommend_product():
@@ -446,53 +3683,36 @@ def recommend_product():
     if not product_id and not filename:
         return jsonify({"error": "Cần cung cấp product_id hoặc filename"}), 400
 
-    # 1. Tìm đường dẫn ảnh của sản phẩm mục tiêu
-    target_path = None
-    
-    # Cách đơn giản: Tìm trong product_metadata
-    for path, meta in product_metadata.items():
-        if (product_id and meta.get('product_id') == product_id) or \
-           (filename and os.path.basename(path) == filename):
-            target_path = path
-            break
+    # 1. Tìm row của sản phẩm mục tiêu (lookup O(1) theo product_id / tên file)
+    snap = snapshot
+    target_id = None
+    product_ids = product_to_ids.get(str(product_id)) if product_id else None
+    if product_ids:
+        target_id = min(product_ids)
+    elif filename:
+        target_id = filename_to_id.get(filename)
             
-    if not target_path or not os.path.exists(target_path):
+    if target_id is None or not snap.is_live(target_id):
         return jsonify({"error": "Không tìm thấy sản phẩm trong cơ sở dữ liệu"}), 404
+    target_path = snap.paths[target_id]
 
     try:
-        # 2. Lấy vector của sản phẩm mục tiêu
-        vec = extract_feature_clip(target_path).astype("float32").reshape(1, -1)
-        
-        # 3. Search 
-        k = min(top_k + 1, index.ntotal)
-        D, I = index.search(vec, k=k)
+        # 2. Hàng xóm tính sẵn; row chưa có trong bảng thì search bằng vector trong embedding store
+        neighbors = similar_rows(snap, target_id, top_k)
+        if neighbors is not None:
+            I, D = neighbors[0][None], neighbors[1][None]
+        else:
+            D, I = search_index(snap, embedding_store.get([target_id]), top_k + 1)
         
-        results = []
-        for i, score in zip(I[0], D[0]):
-            if i >= len(image_paths):
-                continue
-                
-            img_path = image_paths[i]
-            
-            # Bỏ qua chính sản phẩm đang query
-            if img_path == target_path:
-                continue
-                
-            metadata = product_metadata.get(img_path, {})
-            
-            results.append({
-                "path": img_path,
-                "score": float(score),
-                "metadata": metadata
-            })
-            
-            if len(results) >= top_k:
-                break
+        # Bỏ qua chính sản phẩm đang query
+        ranked = rank_hits(snap, D, I, top_k, exclude=target_id)
+        results = result_dicts(hit_results(snap, ranked)[0])
         
         elapsed = time.time() - start_time
         return jsonify({
             "source_product": product_metadata.get(target_path),
             "recommendations": results,
+            "precomputed": neighbors is not None,
             "time": elapsed
         })
         
@@ -512,7 +3732,8 @@ def search_by_text():
     """
     start_time = time.time()
     
-    if index.ntotal == 0:
+    snap = snapshot
+    if snap.ntotal == 0:
         return jsonify([])
     
     data = request.get_json()
@@ -524,29 +3745,14 @@ def search_by_text():
         return jsonify({"error": "Thiếu query text"}), 400
     
     try:
-        # Trích xuất text features
+        # Trích xuất text features (cache theo query đã chuẩn hóa)
+        text_query_log.record(normalize_text_query(query))
         text_vec = extract_text_feature(query).reshape(1, -1)
         
         # Search
-        k = min(top_k * 3, index.ntotal)
-        D, I = index.search(text_vec, k=k)
+        D, I = search_index(snap, text_vec, top_k * 3)
         
-        results = []
-        for i, score in zip(I[0], D[0]):
-            if i >= len(image_paths) or score < threshold:
-                continue
-            
-            img_path = image_paths[i]
-            metadata = product_metadata.get(img_path, {})
-            
-            results.append({
-                "path": img_path,
-                "score": float(score),
-                "metadata": metadata
-            })
-            
-            if len(results) >= top_k:
-                break
+        results = result_dicts(hit_results(snap, rank_hits(snap, D, I, top_k, threshold=threshold))[0])
         
         elapsed = time.time() - start_time
         print(f"🔍 Text Search '{query}': {elapsed:.2f}s, {len(results)} results")
@@ -560,48 +3766,136 @@ def search_by_text():
         print(f"❌ Lỗi text search: {e}")
         return jsonify({"error": str(e)}), 500
 
+# === Batch search ===
+# Nhiều query trong một request: embed cả batch một lần, một index.search nhiều query, hậu
+# xử lý cho cả ma trận kết quả và đọc metadata một lần cho mọi query.
+SEARCH_BATCH_MAX_QUERIES = int(os.environ.get("SEARCH_BATCH_MAX_QUERIES", 256))
+
+def batch_results(snap, D, I, threshold, top_k, dedup):
+    """Kết quả từng query của batch: dedup=True giống /search, dedup=False giống /search-by-text"""
+    ranked = rank_hits(snap, D, I, top_k, threshold=threshold, dedup=dedup)
+    return [result_dicts(hits, ranked=dedup) for hits in hit_results(snap, ranked)]
+
+def batch_query_ids(raw, defaults):
+    """Id của từng query: JSON list do client gửi hoặc mặc định; None nếu không phải list / sai số lượng / trùng"""
+    parsed = json.loads(raw) if raw else defaults
+    if not isinstance(parsed, list):
+        return None
+    query_ids = [str(q) for q in parsed]
+    if len(query_ids) != len(defaults) or len(set(query_ids)) != len(query_ids):
+        return None
+    return query_ids
+
+@app.route('/search-batch', methods=['POST'])
+def search_batch():
+    """
+    Tìm kiếm nhiều ảnh trong một request (kết quả mỗi query giống /search)
+    Form-data:
+    - images: các file ảnh (lặp lại key)
+    - query_ids: JSON list id cho từng ảnh (mặc định: tên file, trùng thì dùng số thứ tự)
+    - top_k, threshold, filters, product_mode: như /search, áp dụng cho mọi query
+    """
+    start_time = time.time()
+
+    files = request.files.getlist('images')
+    if not files:
+        return jsonify({"error": "Thiếu file ảnh"}), 400
+    if len(files) > SEARCH_BATCH_MAX_QUERIES:
+        return jsonify({"error": f"Tối đa {SEARCH_BATCH_MAX_QUERIES} ảnh mỗi request"}), 400
+
+    names = [file.filename for file in files]
+    defaults = names if all(names) and len(set(names)) == len(names) else [str(n) for n in range(len(files))]
+    try:
+        query_ids = batch_query_ids(request.form.get('query_ids'), defaults)
+    except ValueError:
+        query_ids = None
+    if query_ids is None:
+        return jsonify({"error": "query_ids phải là JSON list không trùng, mỗi ảnh một id"}), 400
+
+    top_k = int(request.form.get('top_k', 10))
+    threshold = float(request.form.get('threshold', 0.6))
+    mode = request.form.get('product_mode', PRODUCT_SEARCH_MODE)
+    if mode not in PRODUCT_SEARCH_MODES:
+        return jsonify({"error": f"product_mode phải là một trong {', '.join(PRODUCT_SEARCH_MODES)}"}), 400
+    filters = {}
+    if 'filters' in request.form:
+        try:
+            filters = json.loads(request.form['filters'])
+        except:
+            pass
+
+    try:
+        vectors, ok = embed_query_images([file.read() for file in files])
+        results = {query_id: [] for query_id in query_ids}
+        snap = snapshot
+        if snap.ntotal > 0 and ok.any():
+            ranked = product_hits(snap, vectors[ok], top_k, threshold, mode, filters=filters)
+            for n, hits in zip(np.flatnonzero(ok), hit_results(snap, ranked)):
+                results[query_ids[n]] = result_dicts(hits, ranked=True)
+        errors = {query_ids[n]: "Không đọc được file ảnh" for n in np.flatnonzero(~ok)}
+        for query_id in errors:
+            del results[query_id]
+
+        elapsed = time.time() - start_time
+        print(f"🔍 CLIP Batch Search: {len(files)} query, {elapsed:.2f}s")
+        return jsonify({"results": results, "errors": errors, "total_queries": len(files)})
+    except Exception as e:
+        print(f"❌ Lỗi batch search: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/search-by-text-batch', methods=['POST'])
+def search_by_text_batch():
+    """
+    Tìm kiếm nhiều text query trong một request (kết quả mỗi query giống /search-by-text)
+    Body JSON:
+    - queries: list text (id = số thứ tự) hoặc object {query_id: text}
+    - top_k, threshold: như /search-by-text
+    - filters: lọc theo metadata như /search (tùy chọn)
+    """
+    start_time = time.time()
+
+    data = request.get_json() or {}
+    queries = data.get('queries') or []
+    if isinstance(queries, dict):
+        query_ids, texts = [str(q) for q in queries], list(queries.values())
+    else:
+        query_ids, texts = [str(n) for n in range(len(queries))], list(queries)
+    if not texts or not all(isinstance(text, str) and text for text in texts):
+        return jsonify({"error": "queries phải là list hoặc object các text không rỗng"}), 400
+    if len(texts) > SEARCH_BATCH_MAX_QUERIES:
+        return jsonify({"error": f"Tối đa {SEARCH_BATCH_MAX_QUERIES} query mỗi request"}), 400
+
+    top_k = int(data.get('top_k', 10))
+    threshold = float(data.get('threshold', 0.6))
+    filters = data.get('filters') or {}
+
+    try:
+        for text in texts:
+            text_query_log.record(normalize_text_query(text))
+        results = {query_id: [] for query_id in query_ids}
+        snap = snapshot
+        if snap.ntotal > 0:
+            D, I = search_vectors(snap, extract_text_features(texts), top_k * 3, filters)
+            results = dict(zip(query_ids, batch_results(snap, D, I, threshold, top_k, dedup=False)))
+
+        elapsed = time.time() - start_time
+        print(f"🔍 Text Batch Search: {len(texts)} query, {elapsed:.2f}s")
+        return jsonify({"results": results, "total_queries": len(texts)})
+    except Exception as e:
+        print(f"❌ Lỗi text batch search: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/delete', methods=['POST'])
 def delete_product():
-    """Xóa sản phẩm khỏi index"""
-    global index, image_paths
-    
+    """Xóa sản phẩm khỏi index (tombstone O(1), compaction dọn index sau)"""
     filename = request.json.get('filename')
     if not filename:
         return jsonify({"error": "Thiếu tên file"}), 400
 
-    idx_to_remove = -1
-    for i, path in enumerate(image_paths):
-        if os.path.basename(path) == filename:
-            idx_to_remove = i
-            break
-
-    if idx_to_remove == -1:
+    if delete_row(filename) is None:
         return jsonify({"error": "Không tìm thấy file"}), 404
 
-    removed_path = image_paths.pop(idx_to_remove)
-    
-    if removed_path in product_metadata:
-        del product_metadata[removed_path]
-    
-    # Rebuild index
-    if image_paths:
-        new_index = faiss.IndexFlatIP(512)
-        
-        all_vectors = []
-        for path in image_paths:
-            vec = extract_feature_clip(path).reshape(1, -1)
-            all_vectors.append(vec)
-        
-        if all_vectors:
-            new_index.add(np.vstack(all_vectors))
-        
-        index = new_index
-    else:
-        index = faiss.IndexFlatIP(512)
-
-    faiss.write_index(index, INDEX_PATH)
-    np.save(PATHS_PATH, np.array(image_paths))
-    save_metadata()
+    request_maintenance()
 
     file_path = os.path.join(STORAGE_DIR, filename)
     if os.path.exists(file_path):
@@ -615,26 +3909,40 @@ def delete_product():
 @app.route('/reset', methods=['POST'])
 def reset_index():
     """Reset toàn bộ hệ thống"""
-    global index, image_paths, product_metadata
-
-    if os.path.exists(INDEX_PATH): 
-        os.remove(INDEX_PATH)
-    if os.path.exists(PATHS_PATH): 
-        os.remove(PATHS_PATH)
-    if os.path.exists(METADATA_PATH):
-        os.remove(METADATA_PATH)
-
-    for file in os.listdir(STORAGE_DIR):
-        path = os.path.join(STORAGE_DIR, file)
-        if os.path.isfile(path): 
-            try:
+    global saved_base_version, index_tuning, loaded_base_id, disk_base_id, checkpoint_generation, synced_checkpoint
+
+    with save_lock, write_lock, checkpoint_lock.hold():
+        for path in (INDEX_PATH, DELTA_INDEX_PATH, PATH_TABLE_PATH, PATHS_PATH, DELETED_PATH, METADATA_PATH, NEIGHBORS_PATH, NEIGHBORS_META_PATH):
+            if os.path.exists(path):
                 os.remove(path)
-            except Exception as e:
-                print(f"❌ Lỗi xóa file {path}: {e}")
+        load_neighbor_table()
+        mutation_log.reset()
+        embedding_store.reset()
+        # Generation mới: các worker process khác thấy và nạp lại từ trạng thái rỗng
+        checkpoint_generation = uuid.uuid4().hex
+        write_checkpoint({"lsn": 0, "rows": 0, "time": time.time(), "tuning": {}, "generation": checkpoint_generation})
+        synced_checkpoint = disk_signature(CHECKPOINT_PATH)
+        loaded_base_id = disk_base_id = None
+
+        for file in os.listdir(STORAGE_DIR):
+            path = os.path.join(STORAGE_DIR, file)
+            if os.path.isfile(path): 
+                try:
+                    os.remove(path)
+                except Exception as e:
+                    print(f"❌ Lỗi xóa file {path}: {e}")
 
-    index = faiss.IndexFlatIP(512)  # CLIP 512-dim
-    image_paths = []
-    product_metadata = {}
+        # Snapshot mới có list paths riêng: request đang đọc snapshot cũ không bị ảnh hưởng
+        publish(IndexSnapshot(new_flat_index(), new_flat_index(), PathTable(), np.zeros(0, dtype=bool)))  # CLIP 512-dim
+        saved_base_version = None
+        index_tuning = {}
+        product_metadata.clear()
+        sync_manifest.clear()
+        filename_to_id.clear()
+        product_to_ids.clear()
+        product_of_row.clear()
+        attribute_columns.clear()
+        invalidate_product_index()
     
     return jsonify({"message": "Đã reset toàn bộ hệ thống (CLIP ready)"})
 
@@ -683,6 +3991,8 @@ def get_stats():
     📊 API lấy thống kê hệ thống cho báo cáo
     Metrics: latency, throughput, score distribution, index info
     """
+    snap = snapshot
+    pindex = product_index
     latencies = search_stats["latencies"]
     results_counts = search_stats["results_count"]
     
@@ -707,9 +4017,6 @@ def get_stats():
     else:
         gpu_memory = gpu_memory_max = 0
     
-    # Index statistics
-    index_type = "IndexIVFFlat" if isinstance(index, faiss.IndexIVFFlat) else "IndexFlatIP"
-    
     return jsonify({
         "model_info": {
             "name": "CLIP ViT-B/32",
@@ -719,10 +4026,24 @@ def get_stats():
             "device": str(DEVICE),
         },
         "index_info": {
-            "type": index_type,
-            "total_vectors": index.ntotal,
-            "total_products": len(image_paths),
+            "type": index_type_name(snap.base),
+            "total_vectors": snap.ntotal,
+            "delta_vectors": snap.delta.ntotal,
+            "total_products": snap.live_count(),
+            "pending_tombstones": len(snap.pending),
+            "snapshot_version": snap.version,
+            "tuning": index_tuning,
+            "codec": index_codec(snap.base),
+            "rejected_codecs": index_tuning.get("rejected_codecs", []),
+            "bytes_per_vector": index_bytes_per_vector(snap.base),
+            "recall_loss": index_tuning.get("recall_loss", 0.0),
             "dimension": 512,
+            "product_search_mode": PRODUCT_SEARCH_MODE,
+            "product_index": {
+                "products": len(pindex.keys),
+                "views": len(pindex.rows),
+                "rows_since_build": max(0, snap.n_rows - pindex.watermark),
+            } if pindex is not None else None,
         },
         "search_performance": {
             "total_searches": search_stats["total_searches"],
@@ -736,15 +4057,37 @@ def get_stats():
             },
             "avg_results_per_search": round(avg_results, 2),
             "throughput_qps": round(1000 / avg_latency, 2) if avg_latency > 0 else 0,
+            "micro_batching": {
+                "batches": search_batcher.batches,
+                "queries": search_batcher.queries,
+                "avg_batch_size": round(search_batcher.queries / search_batcher.batches, 2) if search_batcher.batches else 0,
+            },
         },
         "score_distribution": search_stats["score_distribution"],
         "memory_usage": {
             "gpu_current_mb": round(gpu_memory, 2),
             "gpu_peak_mb": round(gpu_memory_max, 2),
-            "cache_size": extract_feature_clip.cache_info().currsize if hasattr(extract_feature_clip, 'cache_info') else 0,
-        }
+            "cache_size": len(embedding_cache.entries),
+        },
+        "embedding_cache": embedding_cache.stats(),
+        "text_embedding_cache": dict(text_embedding_cache.stats(), precomputed=text_precomputed),
     })
 
+@app.route('/quantization-check', methods=['POST'])
+def quantization_check():
+    """
+    🧪 Chạy thử INT8 trên ảnh của catalog (không đổi encoder đang dùng): cosine drift,
+    độ trùng top-10 và tốc độ so với fp32. Dùng để quyết định có bật CLIP_QUANTIZE=int8.
+    """
+    load_models_if_needed()
+    if DEVICE.type == 'cuda':
+        return jsonify({"error": "INT8 chỉ hỗ trợ CPU"}), 400
+    base = clip_encoder.base if isinstance(clip_encoder, Int8ImageEncoder) else clip_encoder
+    report = check_quantization(base, Int8ImageEncoder(base, clip_model))
+    report["thresholds"] = {"mean_cosine": QUANTIZE_MIN_COSINE, "topk_overlap": QUANTIZE_MIN_TOPK_OVERLAP}
+    report["enabled"] = isinstance(clip_encoder, Int8ImageEncoder)
+    return jsonify(report)
+
 @app.route('/benchmark', methods=['POST'])
 def run_benchmark():
     """
@@ -757,12 +4100,14 @@ def run_benchmark():
     num_queries = int(data.get('num_queries', 10))
     top_k = int(data.get('top_k', 10))
     
-    if index.ntotal < 5:
+    snap = snapshot
+    if snap.ntotal < 5:
         return jsonify({"error": "Cần ít nhất 5 sản phẩm trong index để benchmark"}), 400
     
     # Random sample queries from existing products
-    sample_size = min(num_queries, len(image_paths))
-    sample_indices = np.random.choice(len(image_paths), sample_size, replace=False)
+    live_ids = snap.live_row_ids()
+    sample_size = min(num_queries, len(live_ids))
+    sample_indices = np.random.choice(live_ids, sample_size, replace=False)
     
     latencies = []
     all_scores = []
@@ -770,7 +4115,7 @@ def run_benchmark():
     recall_results = []
     
     for idx in sample_indices:
-        query_path = image_paths[idx]
+        query_path = snap.paths[idx]
         query_metadata = product_metadata.get(query_path, {})
         query_category = query_metadata.get('category', '')
         
@@ -778,28 +4123,21 @@ def run_benchmark():
         
         # Extract features and search
         vec = extract_feature_clip(query_path).astype("float32").reshape(1, -1)
-        k = min(top_k + 1, index.ntotal)
-        D, I = index.search(vec, k=k)
+        D, I = search_index(snap, vec, top_k + 1)
         
         elapsed_ms = (time.time() - start_time) * 1000
         latencies.append(elapsed_ms)
         
         # Collect scores (excluding self)
-        scores = []
-        same_category_count = 0
-        for i, score in zip(I[0], D[0]):
-            if i >= len(image_paths):
-                continue
-            if image_paths[i] == query_path:
-                continue
-            scores.append(float(score))
-            
-            # Check if same category (for Precision calculation)
-            result_meta = product_metadata.get(image_paths[i], {})
-            if result_meta.get('category', '') == query_category and query_category:
-                same_category_count += 1
+        hits = hit_results(snap, rank_hits(snap, D, I, top_k, exclude=idx))[0]
+        scores = [score for _, score, _ in hits]
+        
+        # Check if same category (for Precision calculation)
+        same_category_count = sum(
+            1 for _, _, result_meta in hits if result_meta.get('category', '') == query_category and query_category
+        )
         
-        all_scores.extend(scores[:top_k])
+        all_scores.extend(scores)
         
         # Precision@K = relevant / retrieved
         if query_category:
@@ -822,7 +4160,7 @@ def run_benchmark():
         "benchmark_config": {
             "num_queries": sample_size,
             "top_k": top_k,
-            "index_size": index.ntotal,
+            "index_size": snap.ntotal,
         },
         "latency_results": {
             "average_ms": round(avg_latency, 2),
@@ -846,7 +4184,7 @@ def run_benchmark():
             "name": "CLIP ViT-B/32 (OpenAI)",
             "embedding_dim": 512,
             "similarity_metric": "Cosine Similarity",
-            "index_type": "FAISS IndexFlatIP" if isinstance(index, faiss.IndexFlatIP) else "FAISS IndexIVFFlat",
+            "index_type": f"FAISS {index_type_name(snap.base)}",
         }
     })
 
@@ -862,42 +4200,31 @@ def evaluate_single_query():
         return jsonify({"error": "Thiếu file ảnh"}), 400
     
     file = request.files['image']
-    temp_path = f"temp_eval_{int(time.time() * 1000)}.jpg"
     top_k = int(request.form.get('top_k', 10))
     
     try:
-        # Step 1: Save file
-        start_save = time.time()
-        file.save(temp_path)
-        save_time = (time.time() - start_save) * 1000
-        
-        # Step 2: Feature extraction
+        # Step 1: Feature extraction (decode ảnh trong bộ nhớ + CLIP)
         start_extract = time.time()
-        vec = extract_feature_clip(temp_path).astype("float32").reshape(1, -1)
+        vec = extract_feature_clip(load_upload_image(file)).astype("float32").reshape(1, -1)
         extract_time = (time.time() - start_extract) * 1000
         
-        # Step 3: FAISS search
+        # Step 2: FAISS search
         start_search = time.time()
-        k = min(top_k * 3, index.ntotal)
-        D, I = index.search(vec, k=k)
+        snap = snapshot
+        D, I = search_index(snap, vec, top_k * 3)
         search_time = (time.time() - start_search) * 1000
         
-        # Step 4: Post-processing
+        # Step 3: Post-processing
         start_post = time.time()
-        results = []
-        scores = []
-        for i, score in zip(I[0], D[0]):
-            if i >= len(image_paths) or len(results) >= top_k:
-                continue
-            scores.append(float(score))
-            metadata = product_metadata.get(image_paths[i], {})
-            results.append({
-                "rank": len(results) + 1,
-                "score": round(float(score), 4),
-                "path": image_paths[i],
-                "product_id": metadata.get('product_id', ''),
-                "category": metadata.get('category', ''),
-            })
+        hits = hit_results(snap, rank_hits(snap, D, I, top_k))[0]
+        scores = [score for _, score, _ in hits]
+        results = [{
+            "rank": rank,
+            "score": round(score, 4),
+            "path": path,
+            "product_id": metadata.get('product_id', ''),
+            "category": metadata.get('category', ''),
+        } for rank, (path, score, metadata) in enumerate(hits, 1)]
         post_time = (time.time() - start_post) * 1000
         
         total_time = (time.time() - start_total) * 1000
@@ -917,7 +4244,6 @@ def evaluate_single_query():
         
         return jsonify({
             "timing_breakdown_ms": {
-                "file_save": round(save_time, 2),
                 "feature_extraction": round(extract_time, 2),
                 "faiss_search": round(search_time, 2),
                 "post_processing": round(post_time, 2),
@@ -929,12 +4255,18 @@ def evaluate_single_query():
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        if os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
+
+if SERVE_PREFORK:
+    # Master của gunicorn: nạp CLIP trước khi fork để các worker dùng chung trọng số
+    # (copy-on-write); GPU thì mỗi worker tự nạp (CUDA không được khởi tạo trước fork).
+    # Kết nối SQLite đóng lại, mỗi worker mở kết nối riêng trong init_worker_process.
+    if DEVICE.type != 'cuda':
+        load_models_if_needed()
+        precompute_text_embeddings()
+    product_metadata.close()
+    embedding_cache.close()
+    text_query_log.close()
+    sync_manifest.close()
 
 if __name__ == '__main__':
     import threading
@@ -942,6 +4274,8 @@ if __name__ == '__main__':
     preload_thread.daemon = True
     preload_thread.start()
     
+    start_maintenance_thread()
+    
     print("🚀 Starting 3D Product Image Search Service (CLIP)...")
     print(f"📁 Storage directory: {STORAGE_DIR}")
     print(f"🔧 Device: {DEVICE}")
@@ -0,0 +1,248 @@
+"""
+Dựng lại index offline từ ảnh trên đĩa, không qua HTTP:
+
+    python build_index.py                          # mọi ảnh trong product_images/
+    python build_index.py --manifest list.jsonl    # mỗi dòng: path, hoặc {"path": ..., "metadata": {...}}
+    python build_index.py --workers 4 --shard-size 2048
+
+Ảnh được chia thành shard; một process pool embed từng shard theo batch và ghi kết quả vào
+--work-dir ngay khi xong, nên chạy lại đúng lệnh sau khi bị ngắt sẽ chỉ embed các shard còn
+thiếu (--restart để làm lại từ đầu). Đủ shard thì index được dựng và tune như trong service
+(chọn Flat/HNSW/IVF theo cỡ catalog), rồi toàn bộ trạng thái trong DATA_DIR được thay trong một
+lần giữ write_lock + checkpoint_lock với generation mới: service đang chạy (mọi worker) tự nạp
+lại. Chạy với cùng DATA_DIR và biến môi trường như service. Ảnh thêm qua API trong lúc build
+không có trong index mới. app được import ở chế độ CLIP_OFFLINE_TOOL: chỉ dùng các hàm của
+service, không nạp / replay / checkpoint snapshot đang phục vụ trong DATA_DIR.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+os.environ["CLIP_OFFLINE_TOOL"] = "1"
+import app
+
+def list_images(manifest):
+    """[(path, metadata)] theo thứ tự ổn định; service tra ảnh theo tên file nên bỏ ảnh trùng tên"""
+    entries = []
+    if manifest:
+        with open(manifest, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line) if line.startswith('{') else {"path": line}
+                entries.append((os.path.abspath(entry["path"]), entry.get("metadata") or {}))
+    else:
+        entries = [(path, {}) for path in app.storage_images()]
+
+    seen = set()
+    images = []
+    for path, metadata in entries:
+        name = os.path.basename(path)
+        if name in seen:
+            print(f"⚠️ Bỏ qua {path}: trùng tên file với ảnh khác")
+            continue
+        seen.add(name)
+        images.append((path, metadata))
+    return images
+
+def load_plan(work_dir, manifest, shard_size, restart):
+    """Danh sách ảnh + cỡ shard của lần build; giữ nguyên giữa các lần chạy để resume"""
+    plan_path = os.path.join(work_dir, "plan.json")
+    if restart and os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    if os.path.exists(plan_path):
+        with open(plan_path, 'r', encoding='utf-8') as f:
+            plan = json.load(f)
+        if plan["model"] == app.EMBED_MODEL_TAG:
+            print(f"↩️ Tiếp tục build dở ({len(plan['images'])} ảnh) trong {work_dir}")
+            return plan
+        print("⚠️ Build dở dùng model khác, làm lại từ đầu")
+        shutil.rmtree(work_dir)
+
+    os.makedirs(work_dir, exist_ok=True)
+    plan = {"images": list_images(manifest), "shard_size": shard_size, "model": app.EMBED_MODEL_TAG, "created": time.time()}
+
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(plan, f, ensure_ascii=False)
+
+    app.atomic_write(plan_path, write)
+    return plan
+
+def shard_path(work_dir, shard):
+    return os.path.join(work_dir, f"shard_{shard:05d}.npz")
+
+# === Embed (process pool) ===
+
+def init_worker(threads):
+    """Process con sau fork: số thread riêng, thread pool decode mới (thread không qua fork)"""
+    app.configure_threads(threads, 1)
+    if app.clip_encoder is not None and not app.clip_encoder.fork_safe:
+        app.clip_encoder = None  # dựng lại từ artifact đã export, với số thread của process
+    app.preprocess_pool = ThreadPoolExecutor(max_workers=app.PREPROCESS_WORKERS, thread_name_prefix="clip-preprocess")
+
+def embed_shard(task):
+    """Embed một shard rồi ghi (vị trí trong plan, vectors) của các ảnh thành công"""
+    shard, start, paths, work_dir = task
+    rows, vectors = [], []
+    position = {path: start + n for n, path in enumerate(paths)}
+    for ok_paths, batch_vectors, _ in app.iter_feature_batches(paths):
+        rows.extend(position[path] for path in ok_paths)
+        vectors.append(batch_vectors)
+    vectors = np.vstack(vectors) if vectors else np.zeros((0, app.FEATURE_DIM), dtype=np.float32)
+    app.atomic_write(shard_path(work_dir, shard), lambda tmp_path: np.savez(
+        tmp_path, rows=np.array(rows, dtype=np.int64), vectors=vectors.astype(np.float32, copy=False),
+    ))
+    return shard, len(rows), len(paths) - len(rows)
+
+def embed_all(plan, work_dir, workers):
+    images, shard_size = plan["images"], plan["shard_size"]
+    n_shards = (len(images) + shard_size - 1) // shard_size
+    tasks = [
+        (shard, shard * shard_size, [path for path, _ in images[shard * shard_size:(shard + 1) * shard_size]], work_dir)
+        for shard in range(n_shards) if not os.path.exists(shard_path(work_dir, shard))
+    ]
+    print(f"🧩 {n_shards} shard, còn {len(tasks)} shard cần embed, {workers} process")
+    if not tasks:
+        return n_shards
+
+    # Nạp CLIP một lần trước khi fork (như master gunicorn): 1 thread để thread pool
+    # OpenMP/torch chưa được tạo lúc fork, mỗi process con đặt lại số thread của nó
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    if workers > 1:
+        app.configure_threads(1, 1)
+    app.load_models_if_needed()
+
+    start_time = time.time()
+    done = embedded = failed = 0
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.get_context("fork").Pool(workers, initializer=init_worker, initargs=(threads,))
+        results = pool.imap_unordered(embed_shard, tasks)
+    else:
+        results = map(embed_shard, tasks)
+    try:
+        for shard, ok, bad in results:
+            done += 1
+            embedded += ok
+            failed += bad
+            elapsed = time.time() - start_time
+            rate = embedded / elapsed if elapsed > 0 else 0.0
+            eta = (len(tasks) - done) * elapsed / done
+            print(f"📦 Shard {shard}: {ok} ảnh ({bad} lỗi) - {done}/{len(tasks)}, {rate:.1f} ảnh/s, còn ~{eta:.0f}s")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        app.configure_threads(app.TORCH_THREADS, app.FAISS_THREADS)
+    print(f"✅ Embed xong {embedded} ảnh ({failed} lỗi) trong {time.time() - start_time:.1f}s")
+    return n_shards
+
+# === Dựng index ===
+
+def merge_shards(plan, work_dir, n_shards):
+    """Gộp shard theo thứ tự plan: row id mới = thứ tự trong kết quả"""
+    rows, vectors = [], []
+    for shard in range(n_shards):
+        with np.load(shard_path(work_dir, shard)) as data:
+            rows.append(data["rows"])
+            vectors.append(data["vectors"])
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    vectors = np.vstack(vectors) if vectors else np.zeros((0, app.FEATURE_DIM), dtype=np.float32)
+    return [plan["images"][row] for row in rows], vectors
+
+def build_staged_index(paths, staged_embeddings):
+    """
+    Dựng + tune base trên embeddings đã stage. Các hàm dựng index của service đọc vector từ
+    app.embedding_store nên trỏ tạm nó sang file stage (chỉ trong process này).
+    """
+    n = len(paths)
+    family = app.choose_index_family(n)
+    tuning = {}
+    store = app.embedding_store
+    app.embedding_store = app.EmbeddingStore(staged_embeddings)
+    try:
+        staged = app.IndexSnapshot(app.new_flat_index(), app.new_flat_index(), app.PathTable(paths), np.zeros(n, dtype=bool))
+        base = app.tuned_base_builder(family, tuning)(staged)
+    finally:
+        app.embedding_store = store
+    print(f"🏗️ Đã dựng index {tuning.get('type')} cho {n} ảnh ({tuning.get('build_seconds')}s, recall {tuning.get('recall')})")
+    return base, tuning
+
+def install(base, paths, metadatas, staged_embeddings, tuning):
+    """
+    Thay toàn bộ trạng thái trong DATA_DIR. Giữ save_lock + write_lock + checkpoint_lock như
+    /reset: worker không ghi hay nạp lại giữa chừng; manifest với generation mới ghi sau cùng.
+    Bị ngắt giữa bước này thì chạy lại lệnh: các shard vẫn còn nên chỉ dựng + thay lại.
+    """
+    n = len(paths)
+    with app.save_lock, app.write_lock, app.checkpoint_lock.hold():
+        os.replace(staged_embeddings, app.EMBEDDINGS_PATH)
+        app.fsync_dir(os.path.dirname(app.EMBEDDINGS_PATH))
+        app.embedding_store.refresh()
+        app.atomic_write(app.INDEX_PATH, lambda tmp_path: faiss.write_index(base, tmp_path))
+        app.atomic_write(app.DELTA_INDEX_PATH, lambda tmp_path: faiss.write_index(app.new_flat_index(), tmp_path))
+        app.atomic_write(app.PATH_TABLE_PATH, lambda tmp_path: app.PathTable(paths).write(tmp_path, n))
+        app.atomic_write(app.DELETED_PATH, lambda tmp_path: np.save(tmp_path, np.zeros(n, dtype=bool)))
+        for path in (app.PATHS_PATH, app.ROWS_PATH, app.METADATA_PATH, app.NEIGHBORS_PATH, app.NEIGHBORS_META_PATH):
+            if os.path.exists(path):
+                os.remove(path)
+        app.mutation_log.reset()
+        app.product_metadata.replace_all(zip(paths, metadatas))
+        app.sync_manifest.clear()  # row id đã đổi hết: /reload kế tiếp nhận lại các file
+        app.write_checkpoint({
+            "lsn": 0,
+            "rows": n,
+            "time": time.time(),
+            "tuning": tuning,
+            "base_id": uuid.uuid4().hex,
+            "generation": uuid.uuid4().hex,
+        })
+
+def main():
+    parser = argparse.ArgumentParser(description="Dựng lại FAISS index CLIP offline từ ảnh trên đĩa")
+    parser.add_argument("--manifest", help="file JSON lines: path hoặc {\"path\", \"metadata\"} (mặc định: duyệt STORAGE_DIR)")
+    parser.add_argument("--workers", type=int, default=1 if app.DEVICE.type == 'cuda' else max(1, (os.cpu_count() or 1) // app.TORCH_THREADS),
+                        help="số process embed (mặc định: số core / TORCH_THREADS; 1 trên GPU)")
+    parser.add_argument("--shard-size", type=int, default=1024, help="số ảnh mỗi shard (đơn vị resume)")
+    parser.add_argument("--work-dir", default=os.path.join(app.DATA_DIR, "index_build"), help="thư mục shard tạm")
+    parser.add_argument("--restart", action="store_true", help="bỏ build dở, làm lại từ đầu")
+    parser.add_argument("--keep-work-dir", action="store_true", help="giữ shard sau khi thay index")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    plan = load_plan(args.work_dir, args.manifest, args.shard_size, args.restart)
+    if not plan["images"]:
+        raise SystemExit("❌ Không có ảnh nào để index")
+    n_shards = embed_all(plan, args.work_dir, max(1, args.workers))
+
+    images, vectors = merge_shards(plan, args.work_dir, n_shards)
+    if not images:
+        raise SystemExit("❌ Không embed được ảnh nào")
+    paths = [path for path, _ in images]
+    staged_embeddings = os.path.join(args.work_dir, os.path.basename(app.EMBEDDINGS_PATH))
+    app.atomic_write(staged_embeddings, vectors.tofile)
+    del vectors
+    base, tuning = build_staged_index(paths, staged_embeddings)
+
+    # Metadata cũ của ảnh vẫn giữ (product_id, category...), metadata trong manifest ghi đè
+    app.migrate_legacy_metadata()
+    existing = app.product_metadata.get_many(paths)
+    metadatas = [{**existing.get(path, {}), **metadata, "image_path": path} for path, metadata in images]
+
+    install(base, paths, metadatas, staged_embeddings, tuning)
+    if not args.keep_work_dir:
+        shutil.rmtree(args.work_dir, ignore_errors=True)
+    print(f"🎉 Đã thay index: {len(paths)} ảnh trong {time.time() - start_time:.1f}s; service đang chạy sẽ tự nạp lại")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+# Cấu hình gunicorn cho production: gunicorn -c gunicorn.conf.py app:app
+# - preload_app: master nạp CLIP + index một lần rồi fork, các worker dùng chung trọng số
+#   và page mmap của index (copy-on-write) thay vì mỗi worker tự nạp một bản.
+# - Mỗi worker nhiều thread (gthread); TORCH_THREADS/FAISS_THREADS là số thread mỗi worker.
+# - Reload êm: kill -HUP <pid master> -> worker mới được fork và bắt kịp index trên đĩa,
+#   worker cũ xử lý nốt request đang chạy rồi mới thoát. Thay đổi index (thêm/xóa,
+#   compaction) được các worker tự đồng bộ qua DATA_DIR, không cần reload.
+import os
+
+os.environ["SERVE_PREFORK"] = "1"
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5001)}"
+workers = int(os.environ.get("WEB_WORKERS", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 8))
+preload_app = True
+timeout = int(os.environ.get("WEB_TIMEOUT", 120))
+graceful_timeout = 30
+
+def post_fork(server, worker):
+    import app
+    app.init_worker_process()
@@ -2,10 +2,25 @@ import faiss
 import numpy as np
 import os
 import json
+import sqlite3
 
-INDEX_PATH = "faiss_index_3d_products_clip.idx"
-PATHS_PATH = "product_paths_clip.npy"
-METADATA_PATH = "product_metadata.json"
+DATA_DIR = os.environ.get("DATA_DIR", ".")
+INDEX_PATH = os.path.join(DATA_DIR, "faiss_index_3d_products_clip.idx")
+PATHS_PATH = os.path.join(DATA_DIR, "product_paths_clip.npy")
+PATH_TABLE_PATH = os.path.join(DATA_DIR, "product_paths_clip.strtab")
+METADATA_PATH = os.path.join(DATA_DIR, "product_metadata.json")
+METADATA_DB_PATH = os.path.join(DATA_DIR, "product_metadata.sqlite")
+MUTATION_LOG_PATH = os.path.join(DATA_DIR, "index_mutations.log")
+CHECKPOINT_PATH = os.path.join(DATA_DIR, "index_checkpoint.json")
+
+def read_path_table(path, limit):
+    """Đọc `limit` path đầu từ string table (xem PathTable trong app.py)"""
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    count = int(data[8:16].view(np.int64)[0])
+    blob_start = 16 + 8 * (count + 1)
+    offsets = data[16:blob_start].view(np.int64)
+    blob = data[blob_start:]
+    return count, [blob[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8') for i in range(min(limit, count))]
 
 def inspect():
     print(f"--- Inspecting {INDEX_PATH} ---")
@@ -22,7 +37,18 @@ def inspect():
     else:
         print("Index file not found.")
 
-    print(f"\n--- Inspecting {PATHS_PATH} ---")
+    print(f"\n--- Inspecting {PATH_TABLE_PATH} ---")
+    if os.path.exists(PATH_TABLE_PATH):
+        try:
+            count, first = read_path_table(PATH_TABLE_PATH, 5)
+            print(f"Number of paths: {count}")
+            print(f"First 5 paths: {first}")
+        except Exception as e:
+            print(f"Error reading path table: {e}")
+    else:
+        print("Path table not found.")
+
+    print(f"\n--- Inspecting {PATHS_PATH} (legacy) ---")
     if os.path.exists(PATHS_PATH):
         try:
             paths = np.load(PATHS_PATH, allow_pickle=True)
@@ -33,7 +59,23 @@ def inspect():
     else:
         print("Paths file not found.")
 
-    print(f"\n--- Inspecting {METADATA_PATH} ---")
+    print(f"\n--- Inspecting {METADATA_DB_PATH} ---")
+    if os.path.exists(METADATA_DB_PATH):
+        try:
+            conn = sqlite3.connect(METADATA_DB_PATH)
+            count = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+            print(f"Number of metadata entries: {count}")
+            first = conn.execute("SELECT path, data FROM products LIMIT 1").fetchone()
+            if first:
+                print(f"First entry key: {first[0]}")
+                print(f"First entry value: {json.loads(first[1])}")
+            conn.close()
+        except Exception as e:
+            print(f"Error reading metadata: {e}")
+    else:
+        print("Metadata database not found.")
+
+    print(f"\n--- Inspecting {METADATA_PATH} (legacy) ---")
     if os.path.exists(METADATA_PATH):
         try:
             with open(METADATA_PATH, 'r', encoding='utf-8') as f:
@@ -48,5 +90,18 @@ def inspect():
     else:
         print("Metadata file not found.")
 
+    print(f"\n--- Inspecting {MUTATION_LOG_PATH} ---")
+    if os.path.exists(CHECKPOINT_PATH):
+        with open(CHECKPOINT_PATH, 'r', encoding='utf-8') as f:
+            print(f"Last checkpoint: {json.load(f)}")
+    else:
+        print("Checkpoint manifest not found.")
+    if os.path.exists(MUTATION_LOG_PATH):
+        with open(MUTATION_LOG_PATH, 'rb') as f:
+            pending_ops = sum(1 for _ in f)
+        print(f"Operations not yet checkpointed: {pending_ops}")
+    else:
+        print("Mutation log not found.")
+
 if __name__ == "__main__":
     inspect()